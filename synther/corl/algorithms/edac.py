@@ -37,7 +37,7 @@ from tqdm import trange
 
 from synther.corl.shared.buffer import prepare_replay_buffer, StateNormalizer, RewardNormalizer, DiffusionConfig
 from synther.corl.shared.logger import Logger
-from synther.diffusion.utils import make_inputs
+from synther.diffusion.utils import make_inputs, sample_weights
 
 def set_pole_length(
     file_path = os.path.join(tmp_dir, 'dm_control/suite/cartpole.xml'), 
@@ -65,6 +65,7 @@ class TrainConfig:
     dataset: str = "dm-cartpole-test-length0.025-0.35-v0"
     context_aware: int = 0
     diffuser: bool = True
+    uniform: bool = False  # sample the real rows with reward-rebalancing weights
     pole_length: Optional[float] = None  #half pole length. 0.045 defalt
     cond: list = None  
     cond_dim: int = None
@@ -515,6 +516,8 @@ def train(config: TrainConfig):
     action_dim = eval_env.action_space.shape[0]
 
     dataset = make_inputs(config.dataset, original=True, context=False)
+    if config.uniform:
+        dataset['sample_weights'] = sample_weights(config.dataset)
     state_normalizer, replay_buffer = prepare_replay_buffer(
         state_dim=state_dim,
         action_dim=action_dim,
@@ -527,6 +530,8 @@ def train(config: TrainConfig):
         cond_dim=config.cond_dim,
         context_aware=config.context_aware,
         context=config.pole_length,
+        cond=config.cond,
+        seed=config.seed,
     )
 
     # Actor & Critic setup
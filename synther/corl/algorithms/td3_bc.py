@@ -36,7 +36,7 @@ import wandb
 
 from synther.corl.shared.buffer import prepare_replay_buffer, RewardNormalizer, StateNormalizer, DiffusionConfig, DiffusionGenerator
 from synther.corl.shared.logger import Logger
-from synther.diffusion.utils import make_inputs
+from synther.diffusion.utils import make_inputs, sample_weights
 from dm_control import suite
 
 
@@ -66,6 +66,7 @@ class TrainConfig:
     context_aware: int = 0
     diffuser: bool = True
     segment: Optional[str] = None
+    uniform: bool = False  # sample the real rows with reward-rebalancing weights
     pole_length: Optional[float] = None  #half pole length. 0.045 defalt
     percentile: Optional[int] = None
     cond: list = None  
@@ -431,6 +432,8 @@ def train(config: TrainConfig):
         env = DMCGym("cartpole", "swingup", task_kwargs={'random':config.seed})
         inputs = make_inputs(config.dataset, original=True, context=False, segment=config.segment)
         dataset = inputs
+        if config.uniform:
+            dataset['sample_weights'] = sample_weights(config.dataset, segment=config.segment)
         import re
         match = re.search(r'length(.+?)-v0', config.dataset)
         if match:
@@ -464,6 +467,8 @@ def train(config: TrainConfig):
         cond_dim=config.cond_dim,
         context_aware=config.context_aware,
         context=config.pole_length,
+        cond=config.cond,
+        seed=config.seed,
         percentile=config.percentile,
         env=suite.load(domain_name="cartpole", task_name="swingup"),
     )
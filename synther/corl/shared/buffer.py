@@ -1,29 +1,52 @@
 # Shared functions for the CORL algorithms.
 from typing import Union
 import os
+import pickle
+import time
 from dataclasses import dataclass
 from typing import Dict, List, Optional
 
 import gin
-import gym
 import numpy as np
 import torch
 from typing import Tuple
 
 from synther.diffusion.norm import MinMaxNormalizer
 from synther.diffusion.utils import make_inputs, construct_diffusion_model
-from synther.diffusion.elucidated_diffusion import split_diffusion_samples
-
-from dmc2gymnasium import DMCGym
+from synther.diffusion.elucidated_diffusion import get_latest_model_file, split_diffusion_samples
+from synther.diffusion.verification import calculate_diffusion_loss
+from synther.diffusion.artifact import ema_state_dict, is_sampling_artifact, load_sampler_settings, \
+    model_from_artifact
+from synther.corl.shared.filtering import BoundaryFilter, DynamicsErrorFilter, FilterPipeline, dynamics_errors, \
+    iter_chunks, load_columns
+from synther.corl.shared.novelty import NoveltyFilter, NoveltyIndex
+from synther.corl.shared.sample_cache import COLUMNS, SampleCache
+from synther.corl.shared.sum_tree import SumTree
 
 TensorBatch = List[torch.Tensor]
 
 
 @dataclass
 class DiffusionConfig:
-    path: Optional[str] = None  # Path to model checkpoints or .npz file with diffusion samples
+    # Path to a model checkpoint, an EMA artifact (ema-*.pt), an .npz file with diffusion samples or the address of a
+    # sampling service (unix:///path/to.sock or tcp://host:port)
+    path: Optional[str] = None
     num_steps: int = 128  # Number of diffusion steps
     sample_limit: int = -1  # If not -1, limit the number of diffusion samples to this number
+    sampler: str = 'stochastic'  # Diffusion sampler, 'stochastic' or 'deterministic'
+    cache_dir: Optional[str] = None  # If set (and sample_limit != -1), share generated samples across runs
+    cache_size_gb: float = 20.  # Size limit of the sample cache
+    early_exit_tol: Optional[float] = None  # Freeze samples once their per-step update falls below this
+    watch: bool = False  # Reload newer checkpoints from the folder of `path` while the diffusion model trains
+    watch_interval: float = 60.  # Seconds between checks for a newer checkpoint
+    tuned_sampler: bool = False  # Use num_steps and sampler from the sampler.json next to the model, if present
+    verify_backend: str = 'mujoco'  # Dynamics check for percentile filtering, 'mujoco' or 'analytic'
+    filter_fit_rows: Optional[int] = None  # Fit filter percentiles on this many sampled rows instead of all of them
+    novelty_percentile: Optional[float] = None  # Drop .npz samples above this percentile of nearest-neighbour novelty
+    max_novelty: Optional[float] = None  # Or above this novelty, in units of the typical real neighbour distance
+    novelty_k: int = 5  # Number of real neighbours for the novelty
+    priority: Optional[str] = None  # 'dynamics' or 'novelty': down-weight .npz samples instead of dropping them
+    priority_temperature: float = 1.  # Priorities are exp(-score / temperature), with score 1 for a typical sample
 
 def compute_mean_std(states: np.ndarray, eps: float) -> Tuple[np.ndarray, np.ndarray]:
     mean = states.mean(0, keepdims=True)
@@ -137,6 +160,8 @@ class ReplayBuffer(ReplayBufferBase):
         # self._contexts = torch.zeros(
         #     (buffer_size, state_dim), dtype=torch.float32, device=device
         # )
+        # Set by set_priorities, sampling is uniform until then.
+        self._priorities: Optional[SumTree] = None
         
     @property
     def empty(self):
@@ -176,11 +201,32 @@ class ReplayBuffer(ReplayBufferBase):
         self._dones[:n_transitions] = self._to_tensor(data["terminals"][..., None])
         # self._contexts[:n_transitions] = self._to_tensor(data["contexts"])
         self._pointer = n_transitions
+        # Per-row weights from sample_weights replace the oversampled copies of rare reward bins.
+        if "sample_weights" in data:
+            self.set_priorities(data["sample_weights"])
 
         print(f"Dataset size: {n_transitions}")
 
+    # Sample transitions in proportion to their priority from now on. Priorities can be replaced or updated at any
+    # time without touching the stored transitions, rows added later start at the largest priority seen so far.
+    def set_priorities(self, priorities: np.ndarray, indices: Optional[np.ndarray] = None):
+        if self._priorities is None:
+            self._priorities = SumTree(self._buffer_size)
+        if indices is None:
+            full = np.zeros(self._buffer_size)
+            full[:len(priorities)] = priorities
+            self._priorities.set(full)
+        else:
+            self._priorities.update(indices, priorities)
+
+    def clear_priorities(self):
+        self._priorities = None
+
     def _sample(self, batch_size: int, **kwargs) -> TensorBatch:
-        indices = np.random.randint(0, self._pointer, size=batch_size)
+        if self._priorities is not None:
+            indices = self._priorities.sample(batch_size)
+        else:
+            indices = np.random.randint(0, self._pointer, size=batch_size)
         # indices = np.random.randint(0, self._pointer-batch_size, size=1)
         # indices = np.arange(indices[0], indices[0]+batch_size)
         states = self._states[indices]
@@ -211,6 +257,8 @@ class ReplayBuffer(ReplayBufferBase):
         self._rewards[self._pointer: self._pointer + batch_size] = rewards
         self._next_states[self._pointer: self._pointer + batch_size] = next_states
         self._dones[self._pointer: self._pointer + batch_size] = dones
+        if self._priorities is not None:
+            self._priorities.update(np.arange(self._pointer, self._pointer + batch_size), self._priorities.max_priority)
         self._pointer += batch_size
 
 
@@ -228,34 +276,50 @@ class DiffusionGenerator(ReplayBufferBase):
             reward_normalizer: Optional[RewardNormalizer] = None,
             state_normalizer: Optional[StateNormalizer] = None,
             cond_dim: Optional[int] = None,
+            sampler: str = 'stochastic',
+            early_exit_tol: Optional[float] = None,
+            watch: bool = False,  # swap in newer checkpoints from the same folder while training runs
+            watch_interval: float = 60.,  # seconds between checks for a newer checkpoint
     ):
         super().__init__(
             device, reward_normalizer, state_normalizer,
         )
         # Create the environment
         if env_name == 'cartpole':
+            from dmc2gymnasium import DMCGym
             self.env = DMCGym("cartpole", "swingup")
             # self.env = gym.wrappers.RecordEpisodeStatistics(self.env)
             # inputs = make_inputs("dm-cartpole-test-length-all-v0")
-            inputs = dataset
         else:
+            import gym
             self.env = gym.make(env_name)
-            inputs = make_inputs(self.env)
-        inputs = torch.from_numpy(inputs).float()
-        self.diffusion = construct_diffusion_model(inputs=inputs, cond_dim=cond_dim).to(device)
-
-        data = torch.load(diffusion_path)
-        if use_ema:
-            ema_dict = data['ema']
-            ema_dict = {k: v for k, v in ema_dict.items() if k.startswith('ema_model')}
-            ema_dict = {k.replace('ema_model.', ''): v for k, v in ema_dict.items()}
-            self.diffusion.load_state_dict(ema_dict)
+
+        # EMA-only artifacts (ema-*.pt) carry their own config and normalizer and are memory-mapped. Full training
+        # checkpoints need the gin config and the dataset to rebuild the model.
+        data = self._load_checkpoint(diffusion_path)
+        self.use_ema = use_ema
+        if is_sampling_artifact(data):
+            self.diffusion = model_from_artifact(data, device=device)
         else:
-            self.diffusion.load_state_dict(data['model'])
+            inputs = dataset if env_name == 'cartpole' else make_inputs(self.env)
+            inputs = torch.from_numpy(inputs).float()
+            self.diffusion = construct_diffusion_model(inputs=inputs, cond_dim=cond_dim).to(device)
+            self.diffusion.load_state_dict(self._weights(data))
         self.diffusion.eval()
+
+        # Checkpoints of the same kind (model-*.pt or ema-*.pt) written to the folder after this one are loaded
+        # between cache refills, so RL training can start while the diffusion model is still training.
+        self.watch = watch
+        self.watch_folder = os.path.dirname(os.path.abspath(diffusion_path))
+        self.watch_pattern = 'ema-*.pt' if os.path.basename(diffusion_path).startswith('ema-') else 'model-*.pt'
+        self.watch_interval = watch_interval
+        self._loaded_mtime = os.path.getmtime(diffusion_path)
+        self._last_poll = time.monotonic()
         # Clamp samples if normalizer is MinMaxNormalizer
         self.clamp_samples = isinstance(self.diffusion.normalizer, MinMaxNormalizer)
         self.num_steps = num_steps
+        self.sampler = sampler
+        self.early_exit_tol = early_exit_tol
 
         # Batching of diffusion samples
         self.batch_parallelism = batch_parallelism
@@ -276,11 +340,47 @@ class DiffusionGenerator(ReplayBufferBase):
         else:
             self.replay_buffer = None
 
+    # Checkpoints and artifacts are memory-mapped and unpickled with weights_only, both at start and on reload.
+    @staticmethod
+    def _load_checkpoint(path: str) -> Dict:
+        return torch.load(path, map_location='cpu', mmap=True, weights_only=True)
+
+    def _weights(self, data: Dict) -> Dict[str, torch.Tensor]:
+        if is_sampling_artifact(data):
+            return data['state_dict']
+        return ema_state_dict(data) if self.use_ema else data['model']
+
+    # Load the newest checkpoint in the watched folder if it is newer than the current weights. The file is read
+    # completely before any weight is replaced, so a failed or partial read keeps the current model.
+    def _maybe_reload(self):
+        if not self.watch or time.monotonic() - self._last_poll < self.watch_interval:
+            return
+        self._last_poll = time.monotonic()
+        latest = get_latest_model_file(self.watch_folder, self.watch_pattern)
+        if latest is None or os.path.getmtime(latest) <= self._loaded_mtime:
+            return
+        mtime = os.path.getmtime(latest)
+        try:
+            weights = self._weights(self._load_checkpoint(latest))
+        except (OSError, RuntimeError, EOFError, KeyError, pickle.UnpicklingError) as e:
+            print(f'Skipping checkpoint {latest}: {e}')
+            return
+        # The adaptive noise sampler state only exists in some checkpoints and does not affect sampling.
+        weights = {k: v for k, v in weights.items() if not k.startswith('sigma_sampler.')}
+        missing, unexpected = self.diffusion.load_state_dict(weights, strict=False)
+        assert not unexpected and all(k.startswith('sigma_sampler.') for k in missing), \
+            f'Checkpoint {latest} does not match the model'
+        self._loaded_mtime = mtime
+        print(f'Reloaded diffusion weights from {latest}.')
+
     def _sample_from_diffusion(self, batch_size: int, **kwargs) -> TensorBatch:
+        self._maybe_reload()
         sampled_outputs = self.diffusion.sample(
             batch_size=batch_size,
             num_sample_steps=self.num_steps,
             clamp=self.clamp_samples,
+            sampler=self.sampler,
+            early_exit_tol=self.early_exit_tol,
             **kwargs,
         )
         x = split_diffusion_samples(sampled_outputs, self.env)
@@ -315,77 +415,11 @@ class DiffusionGenerator(ReplayBufferBase):
             self.cache_pointer += batch_size
             return batch
 
-from tqdm import trange
-from dm_control import suite
-
-def _flatten_obs(obs, dtype=np.float32):
-    obs_pieces = []
-    for v in obs.values():
-        flat = np.array([v]) if np.isscalar(v) else v.ravel()
-        obs_pieces.append(flat)
-    return np.concatenate(obs_pieces, axis=0).astype(dtype)
-
-def reset_to_state(env, state):
-    env._reset_next_step = False
-    env._step_count = 0
-    with env._physics.reset_context():
-        env._physics.named.data.qpos[:] = np.array([state[0], state[1]])
-        env._physics.named.data.qvel[:] = np.array([state[2], state[3]])
-    env._task.after_step(env._physics)
-    
-def calculate_diffusion_loss(diffusion_dataset, env, range = None):
-    if range is None:
-        range = diffusion_dataset["observations"].shape[0]
-    reward_loss = np.zeros((range, 1))
-    observation_loss = np.zeros((range, diffusion_dataset["observations"].shape[1]))
-
-    # for transition in trange(diffusion_dataset["observations"].shape[0]):
-    for transition in trange(range):
-        index = np.ones(diffusion_dataset["observations"].shape[1], dtype=bool)
-        index[2] = False
-        observation = diffusion_dataset["observations"][transition]
-        state = observation[index]
-        # state[1] = np.arccos(state[1].clip(-1, 1))
-        state[1] = np.arctan2(observation[2], observation[1])
-        action = diffusion_dataset["actions"][transition]
-        reward = diffusion_dataset["rewards"][transition]
-        next_observation = diffusion_dataset["next_observations"][transition]
-
-        # if transition == 0:
-        #     print(observation, action, reward, next_observation)
-        reset_to_state(env, state)
-        timestamp = env.step(action)
-        reward_true = timestamp.reward
-        next_observation_true = _flatten_obs(timestamp.observation)
-        reward_loss[transition, :] = np.abs(reward - reward_true)
-        observation_loss[transition, :] = np.abs(next_observation - next_observation_true)
-    return observation_loss, reward_loss
-
 def filter_data(loss, percentile):
-    pos1_percentile = np.percentile(loss[:, 0], percentile)
-
-    pos2_percentile = np.percentile(loss[:, 1], percentile)
-
-    pos3_percentile = np.percentile(loss[:, 2], percentile)
-
-    vel1_percentile = np.percentile(loss[:, 3], percentile)
-
-    vel2_percentile = np.percentile(loss[:, 4], percentile)
-
-    reward_percentile = np.percentile(loss[:, 5], percentile)
-
-    filtered_out_indices = np.where((loss[:, 0] >= pos1_percentile) & 
-                                     (loss[:, 1] >= pos2_percentile) &
-                                     (loss[:, 2] >= pos3_percentile) &
-                                        (loss[:, 3] >= vel1_percentile) &
-                                        (loss[:, 4] >= vel2_percentile) &
-                                        (loss[:, 5] >= reward_percentile))[0]
-    indices = np.where((loss[:, 0] <= pos1_percentile) &
-                                     (loss[:, 1] <= pos2_percentile) &
-                                     (loss[:, 2] <= pos3_percentile) &
-                                        (loss[:, 3] <= vel1_percentile) &
-                                        (loss[:, 4] <= vel2_percentile) &
-                                        (loss[:, 5] <= reward_percentile))[0]
+    # Per-column thresholds of the position, velocity and reward errors.
+    thresholds = np.percentile(loss, percentile, axis=0)
+    filtered_out_indices = np.flatnonzero((loss >= thresholds).all(axis=1))
+    indices = np.flatnonzero((loss <= thresholds).all(axis=1))
     # indices = np.where((loss[:, 0] <= 0.005) &
     #                                  (loss[:, 1] <= 0.005) &
     #                                  (loss[:, 2] <= 0.005) &
@@ -394,29 +428,94 @@ def filter_data(loss, percentile):
     #                                     (loss[:, 5] <= 0.001))[0]
     return filtered_out_indices, indices
 
+# Rejection of off-manifold samples by their nearest-neighbour distance to the real data, see novelty.py.
+def novelty_filters(dataset, diffusion_config: DiffusionConfig, context: Optional[float] = None) -> List[NoveltyFilter]:
+    if diffusion_config.novelty_percentile is None and diffusion_config.max_novelty is None:
+        return []
+    index = NoveltyIndex(dataset, k=diffusion_config.novelty_k, default_context=context)
+    return [NoveltyFilter(index, percentile=diffusion_config.novelty_percentile,
+                          max_novelty=diffusion_config.max_novelty)]
+
+# Sampling priorities in (0, 1] of synthetic transitions for ReplayBuffer.set_priorities. Dynamics errors are scaled by
+# their per-column median and averaged, novelty is already relative to the typical real neighbour distance.
+def synthetic_priorities(
+        diffusion_dataset,
+        real_dataset,
+        diffusion_config: DiffusionConfig,
+        env=None,
+        context: Optional[float] = None,
+        chunk_size: int = 100000,
+) -> np.ndarray:
+    assert diffusion_config.priority in ('dynamics', 'novelty'), f'Unknown priority: {diffusion_config.priority}'
+    chunks = iter_chunks(diffusion_dataset, chunk_size)
+    if diffusion_config.priority == 'novelty':
+        index = NoveltyIndex(real_dataset, k=diffusion_config.novelty_k, default_context=context)
+        scores = np.concatenate([index.novelty(chunk) for chunk in chunks])
+    else:
+        errors = np.concatenate([dynamics_errors(chunk, env, diffusion_config.verify_backend) for chunk in chunks])
+        scores = (errors / (np.median(errors, axis=0) + 1e-8)).mean(axis=1)
+    return np.exp(-scores / diffusion_config.priority_temperature)
+
 def filter_by_boundary(training_dataset, diffusion_dataset):
-    indices = np.arange(0,diffusion_dataset["observations"].shape[0])
-    for key in diffusion_dataset.keys():
-        if (key == "observations") | (key == "next_observations"):
-            boundary_Pos1 = (training_dataset[key][:,0].min(), training_dataset[key][:,0].max())
-            boundary_Pos2 = (training_dataset[key][:,1].min(), training_dataset[key][:,1].max())
-            boundary_Pos3 = (training_dataset[key][:,2].min(), training_dataset[key][:,2].max())
-            boundary_Vel1 = (training_dataset[key][:,3].min(), training_dataset[key][:,3].max())
-            boundary_Vel2 = (training_dataset[key][:,4].min(), training_dataset[key][:,4].max())
-            
-            filtered_indices = np.where(((diffusion_dataset[key][:,0] >= boundary_Pos1[0]) & (diffusion_dataset[key][:,0] <= boundary_Pos1[1])) &
-                                ((diffusion_dataset[key][:,1] >= boundary_Pos2[0]) & (diffusion_dataset[key][:,1] <= boundary_Pos2[1])) &
-                                ((diffusion_dataset[key][:,2] >= boundary_Pos3[0]) & (diffusion_dataset[key][:,2] <= boundary_Pos3[1])))[0]
-                                # ((diffusion_dataset[key][:,3] >= boundary_Vel1[0]) & (diffusion_dataset[key][:,3] <= boundary_Vel1[1])) &
-                                # ((diffusion_dataset[key][:,4] >= boundary_Vel2[0]) & (diffusion_dataset[key][:,4] <= boundary_Vel2[1]))
-            
-        else:
-            boundary = (training_dataset[key].min(), training_dataset[key].max())
-            filtered_indices = np.where((diffusion_dataset[key] >= boundary[0]) & (diffusion_dataset[key] <= boundary[1]))[0]
-        
-        indices = np.intersect1d(indices, filtered_indices)
-    
-    return {key: diffusion_dataset[key][indices] for key in diffusion_dataset.keys()}
+    keep = BoundaryFilter(training_dataset, keys=list(diffusion_dataset))(diffusion_dataset)
+    return {key: diffusion_dataset[key][keep] for key in diffusion_dataset.keys()}
+
+# Fixed-size synthetic dataset from a diffusion checkpoint, generated once and shared through the sample cache.
+def cached_diffusion_replay_buffer(
+        state_dim: int,
+        action_dim: int,
+        env_name: str,
+        dataset,
+        diffusion_config: DiffusionConfig,
+        cond_dim: Optional[int],
+        cond: Optional[List[float]],
+        seed: int,
+        buffer_args: dict,
+) -> ReplayBuffer:
+    cache = SampleCache(diffusion_config.cache_dir, max_size_gb=diffusion_config.cache_size_gb)
+    num_samples = diffusion_config.sample_limit
+    sampler = diffusion_config.sampler
+    if diffusion_config.early_exit_tol is not None:
+        sampler = f'{sampler}+early_exit={diffusion_config.early_exit_tol}'
+    key = cache.key(diffusion_config.path, cond, diffusion_config.num_steps, sampler, seed, num_samples)
+
+    def generate():
+        generator = DiffusionGenerator(
+            env_name=env_name,
+            dataset=dataset,
+            diffusion_path=diffusion_config.path,
+            use_ema=True,
+            num_steps=diffusion_config.num_steps,
+            cond_dim=cond_dim,
+            sampler=diffusion_config.sampler,
+            early_exit_tol=diffusion_config.early_exit_tol,
+            device=buffer_args['device'],
+        )
+        cond_tensor = torch.tensor(cond, dtype=torch.float32)[:, None] if cond is not None else None
+        batch_size = 100000
+        columns = [[] for _ in range(5)]
+        # Fork the RNG so the samples depend only on the seed and the caller's random state is left untouched.
+        devices = [torch.cuda.current_device()] if torch.cuda.is_available() else []
+        with torch.random.fork_rng(devices=devices):
+            torch.manual_seed(seed)
+            for start in range(0, num_samples, batch_size):
+                batch = generator._sample_from_diffusion(min(batch_size, num_samples - start), cond=cond_tensor)
+                for column, values in zip(columns, batch):
+                    column.append(values.cpu().numpy())
+        return {name: np.concatenate(column).astype(np.float32)
+                for name, column in zip(('observations', 'actions', 'rewards', 'next_observations', 'terminals'),
+                                        columns)}
+
+    samples = cache.get_or_create(key, generate)
+    replay_buffer = ReplayBuffer(
+        state_dim=state_dim,
+        action_dim=action_dim,
+        buffer_size=num_samples,
+        **buffer_args,
+    )
+    replay_buffer.load_dataset(samples)
+    return replay_buffer
+
 
 def prepare_replay_buffer(
         state_dim: int,
@@ -433,17 +532,39 @@ def prepare_replay_buffer(
         context: float = 1.0,
         percentile: Optional[int] = None,
         env = None,
-        
+        cond: Optional[List[float]] = None,
+        seed: int = 0,
 ):
+    # Imported here, the service module builds on this one.
+    from synther.corl.shared.sampling_service import DiffusionServiceClient, is_service_address
+
     buffer_args = {
         'reward_normalizer': reward_normalizer,
         'state_normalizer': state_normalizer,
         'device': device,
         }
-    if diffusion_config.path is not None and context_aware:
+    # Sampling weights of the real rows (see sample_weights). They only apply where the buffer holds the real rows,
+    # buffers of synthetic rows only sample with synthetic priorities.
+    dataset = dict(dataset)
+    real_weights = dataset.pop('sample_weights', None)
+    if is_service_address(diffusion_config.path):
+        print(f'Sampling from diffusion service at {diffusion_config.path}.')
+        client = DiffusionServiceClient(diffusion_config.path, cond=cond, **buffer_args)
+        if diffusion_config.sample_limit != -1:
+            columns = client.request(diffusion_config.sample_limit)
+            client.close()
+            replay_buffer = ReplayBuffer(
+                state_dim=state_dim,
+                action_dim=action_dim,
+                buffer_size=diffusion_config.sample_limit,
+                **buffer_args,
+            )
+            replay_buffer.load_dataset(dict(zip(COLUMNS, columns)))
+        else:
+            replay_buffer = client
+    elif diffusion_config.path is not None and context_aware:
         print(f'Loading diffusion dataset from {diffusion_config.path}.')
-        diffusion_dataset = np.load(diffusion_config.path)
-        diffusion_dataset = {key: diffusion_dataset[key] for key in diffusion_dataset.files}
+        diffusion_dataset = load_columns(diffusion_config.path)
         
 
 
@@ -451,6 +572,7 @@ def prepare_replay_buffer(
             diffusion_dataset[key] = diffusion_dataset[key][:dataset['rewards'].shape[0]]
         diffusion_length = diffusion_dataset['rewards'].shape[0]
             
+        filters = novelty_filters(dataset, diffusion_config, context)
         if percentile is not None:
             range = diffusion_dataset['rewards'].shape[0]
             # **********************************************************
@@ -461,7 +583,10 @@ def prepare_replay_buffer(
             # filtered_out_indices, indices = filter_data(erro, percentile)
             # diffusion_dataset = {key: diffusion_dataset[key][indices] for key in diffusion_dataset.keys()}
             # **********************************************************
-            diffusion_dataset = filter_by_boundary(dataset, diffusion_dataset)
+            filters.insert(0, BoundaryFilter(dataset, keys=list(diffusion_dataset)))
+        if filters:
+            pipeline = FilterPipeline(filters, fit_rows=diffusion_config.filter_fit_rows)
+            diffusion_dataset = pipeline.run(diffusion_dataset)
             print('Limited diffusion dataset to {} samples'.format(diffusion_dataset['rewards'].shape[0] / diffusion_length))
             
         # for key in dataset.keys():
@@ -472,6 +597,14 @@ def prepare_replay_buffer(
         if 'terminals' not in diffusion_dataset:
             diffusion_dataset['terminals'] = np.zeros((diffusion_dataset["rewards"].shape[0], dataset["contexts"].shape[1]), dtype=np.float32)
         # print(dataset['contexts'].shape, diffusion_dataset['contexts'].shape)
+        priorities = None
+        if diffusion_config.priority is not None or real_weights is not None:
+            # Real transitions keep full priority unless they carry sampling weights.
+            priorities = np.concatenate([
+                real_weights if real_weights is not None else np.ones(dataset['rewards'].shape[0]),
+                synthetic_priorities(diffusion_dataset, dataset, diffusion_config, env, context)
+                if diffusion_config.priority is not None else np.ones(diffusion_dataset['rewards'].shape[0]),
+            ])
         for key in diffusion_dataset.keys():
             dataset[key] = np.concatenate([dataset[key], diffusion_dataset[key]], axis=0)
         # print(dataset['contexts'].shape, diffusion_dataset['contexts'].shape)
@@ -488,6 +621,8 @@ def prepare_replay_buffer(
             **buffer_args,
         )
         replay_buffer.load_dataset(dataset, context_aware=context_aware)
+        if priorities is not None:
+            replay_buffer.set_priorities(priorities)
         # replay_buffer.load_d4rl_dataset(diffusion_dataset, context_aware=context_aware)
     elif diffusion_config.path is None:
         print('Loading true dataset.')
@@ -508,20 +643,21 @@ def prepare_replay_buffer(
             **buffer_args,
         )
         replay_buffer.load_dataset(dataset, context_aware=context_aware)
+        if real_weights is not None:
+            replay_buffer.set_priorities(real_weights)
     elif diffusion_config.path.endswith(".npz"):
         print(f'Loading diffusion dataset from {diffusion_config.path}.')
-        diffusion_dataset = np.load(diffusion_config.path)
-        diffusion_dataset = {key: diffusion_dataset[key] for key in diffusion_dataset.files}
+        diffusion_dataset = load_columns(diffusion_config.path)
         
         diffusion_length = diffusion_dataset['rewards'].shape[0]
+        # Generated rows are checked against the pole they were conditioned on, chunk by chunk.
+        filters = novelty_filters(dataset, diffusion_config, context)
         if percentile is not None:
-            range = diffusion_dataset['rewards'].shape[0]
-            if env is None:
-                env = suite.load(domain_name="cartpole", task_name="swingup")
-            observation_erro, reward_erro = calculate_diffusion_loss(diffusion_dataset, env, range)
-            erro = np.concatenate([observation_erro, reward_erro], axis=1)
-            filtered_data, indices = filter_data(erro, percentile)
-            diffusion_dataset = {key: diffusion_dataset[key][indices] for key in diffusion_dataset.keys()}
+            filters.append(DynamicsErrorFilter(percentile=percentile, env=env, backend=diffusion_config.verify_backend))
+        if filters:
+            pipeline = FilterPipeline(filters, fit_rows=diffusion_config.filter_fit_rows)
+            diffusion_dataset = pipeline.run(
+                diffusion_dataset, max_rows=diffusion_config.sample_limit if diffusion_config.sample_limit != -1 else None)
             print('Limited diffusion dataset to {} samples'.format(diffusion_dataset['rewards'].shape[0] / diffusion_length))
             
         if 'contexts' not in diffusion_dataset:
@@ -533,7 +669,7 @@ def prepare_replay_buffer(
                 diffusion_dataset[key] = diffusion_dataset[key][:diffusion_config.sample_limit]
             print('Limited diffusion dataset to {} samples'.format(diffusion_config.sample_limit))
 
-        dataset = diffusion_dataset
+        real_dataset, dataset = dataset, diffusion_dataset
         state_mean_buffer, state_std_buffer = compute_mean_std(dataset["observations"], eps=1e-3)
         
         buffer_args = {
@@ -548,22 +684,47 @@ def prepare_replay_buffer(
             **buffer_args,
         )
         replay_buffer.load_dataset(dataset, context_aware=context_aware)
+        if diffusion_config.priority is not None:
+            replay_buffer.set_priorities(synthetic_priorities(dataset, real_dataset, diffusion_config, env, context))
     elif diffusion_config.path.endswith(".pt"):
         print('Loading diffusion model.')
         # Load gin config from the same directory.
         gin_path = os.path.join(os.path.dirname(diffusion_config.path), 'config.gin')
         gin.parse_config_file(gin_path, skip_unknown=True)
-
-        replay_buffer = DiffusionGenerator(
-            env_name=env_name,
-            dataset = dataset,
-            diffusion_path=diffusion_config.path,
-            use_ema=True,
-            num_steps=diffusion_config.num_steps,
-            max_samples=diffusion_config.sample_limit,
-            cond_dim=cond_dim,
-            **buffer_args,
-        )
+        if diffusion_config.tuned_sampler:
+            settings = load_sampler_settings(diffusion_config.path)
+            if settings is not None:
+                diffusion_config.num_steps = settings['num_steps']
+                diffusion_config.sampler = settings['sampler']
+                print(f"Using tuned sampler: {settings['sampler']}, {settings['num_steps']} steps.")
+
+        if diffusion_config.cache_dir is not None and diffusion_config.sample_limit != -1:
+            replay_buffer = cached_diffusion_replay_buffer(
+                state_dim=state_dim,
+                action_dim=action_dim,
+                env_name=env_name,
+                dataset=dataset,
+                diffusion_config=diffusion_config,
+                cond_dim=cond_dim,
+                cond=cond,
+                seed=seed,
+                buffer_args=buffer_args,
+            )
+        else:
+            replay_buffer = DiffusionGenerator(
+                env_name=env_name,
+                dataset = dataset,
+                diffusion_path=diffusion_config.path,
+                use_ema=True,
+                num_steps=diffusion_config.num_steps,
+                max_samples=diffusion_config.sample_limit,
+                cond_dim=cond_dim,
+                sampler=diffusion_config.sampler,
+                early_exit_tol=diffusion_config.early_exit_tol,
+                watch=diffusion_config.watch,
+                watch_interval=diffusion_config.watch_interval,
+                **buffer_args,
+            )
     else:
         raise ValueError("Unknown diffusion_path format")
     
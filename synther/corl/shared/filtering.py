@@ -0,0 +1,263 @@
+# Chunked filtering of synthetic transition datasets.
+# Filters compute their statistics once (training bounds, percentile thresholds fitted in a pass over the synthetic
+# rows, or over an evenly spaced sample of them) and then map each chunk of rows to a boolean keep mask. The pipeline
+# reads the chunks in order, runs each filter only on the rows the previous ones kept, and appends the survivors to an
+# output store, so memory stays bounded by the chunk size, the survivors and one score per row for percentile fits.
+import os
+import pathlib
+import struct
+import zipfile
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Union
+
+import numpy as np
+
+Columns = Dict[str, np.ndarray]
+
+
+# Columns of an .npz file as read-only memory maps. np.savez stores members uncompressed, so each array can be mapped
+# at its offset in the archive. Compressed archives are read into memory.
+def load_columns(path: str) -> Columns:
+    if os.path.isdir(path):
+        return {p.stem: np.load(p, mmap_mode='r') for p in sorted(pathlib.Path(path).glob('*.npy'))}
+    with zipfile.ZipFile(path) as zf:
+        infos = zf.infolist()
+    if any(info.compress_type != zipfile.ZIP_STORED for info in infos):
+        data = np.load(path)
+        return {key: data[key] for key in data.files}
+    columns = {}
+    with open(path, 'rb') as f:
+        for info in infos:
+            f.seek(info.header_offset)
+            local_header = f.read(30)
+            name_len, extra_len = struct.unpack('<HH', local_header[26:30])
+            f.seek(info.header_offset + 30 + name_len + extra_len)
+            version = np.lib.format.read_magic(f)
+            if version == (1, 0):
+                shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+            else:
+                shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+            columns[info.filename[:-len('.npy')]] = np.memmap(
+                path, dtype=dtype, mode='r', offset=f.tell(), shape=shape, order='F' if fortran_order else 'C')
+    return columns
+
+
+def iter_chunks(columns: Columns, chunk_size: int):
+    num_rows = len(columns['rewards'])
+    for start in range(0, num_rows, chunk_size):
+        yield {k: np.asarray(v[start:start + chunk_size]) for k, v in columns.items()}
+
+
+# Absolute next-state and reward errors [N, obs_dim + 1] of the physics check (see synther.diffusion.verification).
+# Rows are checked against their own pole size when the data has contexts.
+def dynamics_errors(chunk: Columns, env=None, backend: str = 'mujoco') -> np.ndarray:
+    from synther.diffusion.verification import calculate_diffusion_loss
+
+    observation_err, reward_err = calculate_diffusion_loss(
+        chunk, env, pole_size=chunk.get('contexts'), backend=backend)
+    return np.concatenate([observation_err, reward_err], axis=1)
+
+
+class ChunkFilter:
+    # Statistics that depend on the synthetic data are fitted before streaming, on chunks covering every row (cache
+    # set, so per-row results can be kept for the filtering pass) or on a sample of the rows.
+    def fit(self, chunks: Iterable[Columns], cache: bool = False):
+        pass
+
+    # Boolean mask of the rows of the chunk to keep.
+    def __call__(self, chunk: Columns) -> np.ndarray:
+        raise NotImplementedError
+
+    # Keep mask of a chunk whose rows are `rows` of the full data.
+    def mask(self, chunk: Columns, rows: np.ndarray) -> np.ndarray:
+        return self(chunk)
+
+
+# Axis-aligned bounding box of the training data, as in filter_by_boundary: the positions of observations and next
+# observations (the first three columns) and every other column must lie within the training range.
+class BoundaryFilter(ChunkFilter):
+    def __init__(self, training_dataset: Columns, keys: Optional[Sequence[str]] = None, num_position_dims: int = 3):
+        keys = keys if keys is not None else list(training_dataset)
+        self.bounds = {}
+        for key in keys:
+            values = np.asarray(training_dataset[key])
+            if key in ('observations', 'next_observations'):
+                values = values[:, :num_position_dims]
+                self.bounds[key] = (values.min(axis=0), values.max(axis=0), num_position_dims)
+            else:
+                self.bounds[key] = (values.min(), values.max(), None)
+
+    def __call__(self, chunk: Columns) -> np.ndarray:
+        keep = np.ones(len(next(iter(chunk.values()))), dtype=bool)
+        for key, (low, high, num_dims) in self.bounds.items():
+            if key not in chunk:
+                continue
+            values = chunk[key][:, :num_dims] if num_dims is not None else chunk[key]
+            inside = (values >= low) & (values <= high)
+            keep &= inside.reshape(len(keep), -1).all(axis=1)
+        return keep
+
+
+# Keeps rows whose per-row scores are all at or below a threshold, either fixed or the given percentile of each score
+# column over the fitted rows (as filter_data does over the whole dataset). When every row was scored to fit the
+# percentile, the filtering pass reuses those scores instead of computing them again.
+class ScoreFilter(ChunkFilter):
+    def __init__(
+            self,
+            score_fn: Callable[[Columns], np.ndarray],  # chunk -> [N, num_scores]
+            percentile: Optional[float] = None,
+            max_score: Union[None, float, Sequence[float]] = None,
+    ):
+        assert (percentile is None) != (max_score is None), 'Set exactly one of percentile and max_score'
+        self.score_fn = score_fn
+        self.percentile = percentile
+        self.threshold = np.asarray(max_score, dtype=np.float64) if max_score is not None else None
+        self.cached_scores = None
+
+    def _scores(self, chunk: Columns) -> np.ndarray:
+        scores = np.asarray(self.score_fn(chunk))
+        return scores.reshape(scores.shape[0], -1)
+
+    def fit(self, chunks: Iterable[Columns], cache: bool = False):
+        self.cached_scores = None
+        if self.percentile is None:
+            return
+        scores = np.concatenate([self._scores(chunk) for chunk in chunks])
+        self.threshold = np.percentile(scores, self.percentile, axis=0)
+        if cache:
+            self.cached_scores = scores
+
+    def __call__(self, chunk: Columns) -> np.ndarray:
+        return (self._scores(chunk) <= self.threshold).all(axis=1)
+
+    def mask(self, chunk: Columns, rows: np.ndarray) -> np.ndarray:
+        if self.cached_scores is None:
+            return self(chunk)
+        return (self.cached_scores[rows] <= self.threshold).all(axis=1)
+
+
+class DynamicsErrorFilter(ScoreFilter):
+    def __init__(self, percentile: Optional[float] = None, max_score=None, env=None, backend: str = 'mujoco'):
+        super().__init__(self._errors, percentile=percentile, max_score=max_score)
+        self.env = env
+        self.backend = backend
+
+    def _errors(self, chunk: Columns) -> np.ndarray:
+        return dynamics_errors(chunk, self.env, self.backend)
+
+
+# Negative log-likelihood of the transitions under a diffusion model, so a percentile of 90 drops the 10% least likely.
+class LikelihoodFilter(ScoreFilter):
+    def __init__(self, diffusion, percentile: Optional[float] = None, max_score=None, batch_size: int = 10000):
+        super().__init__(self._negative_log_likelihood, percentile=percentile, max_score=max_score)
+        self.diffusion = diffusion
+        self.batch_size = batch_size
+
+    def _negative_log_likelihood(self, chunk: Columns) -> np.ndarray:
+        import torch
+
+        inputs = np.concatenate([chunk['observations'], chunk['actions'], chunk['rewards'].reshape(-1, 1),
+                                 chunk['next_observations']], axis=1)
+        if self.diffusion.event_shape[0] == inputs.shape[1] + 1:
+            inputs = np.concatenate([inputs, chunk['terminals'].reshape(-1, 1)], axis=1)
+        conditional = getattr(self.diffusion.net, 'conditional', False)
+        scores = []
+        for start in range(0, inputs.shape[0], self.batch_size):
+            x = torch.as_tensor(inputs[start:start + self.batch_size], dtype=torch.float32,
+                                device=self.diffusion.device)
+            cond = None
+            if conditional:
+                cond = torch.as_tensor(chunk['contexts'][start:start + self.batch_size], dtype=torch.float32,
+                                       device=self.diffusion.device).reshape(x.shape[0], -1)
+            log_likelihood, _ = self.diffusion.log_likelihood(x, cond=cond)
+            scores.append(-log_likelihood.cpu().numpy())
+        return np.concatenate(scores)
+
+
+class MemoryStore:
+    def __init__(self):
+        self.chunks: Dict[str, List[np.ndarray]] = {}
+
+    def append(self, chunk: Columns):
+        for key, values in chunk.items():
+            self.chunks.setdefault(key, []).append(values)
+
+    def close(self) -> Columns:
+        return {key: np.concatenate(values) for key, values in self.chunks.items()}
+
+
+# Survivors are appended to raw files and converted to a directory of .npy columns (the sample cache layout) on close,
+# which returns them memory-mapped.
+class NpyStore:
+    def __init__(self, directory: str):
+        self.directory = pathlib.Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.files = {}
+        self.meta = {}
+
+    def append(self, chunk: Columns):
+        for key, values in chunk.items():
+            values = np.ascontiguousarray(values)
+            if key not in self.files:
+                self.files[key] = open(self.directory / f'{key}.bin', 'wb')
+                self.meta[key] = [values.dtype, values.shape[1:], 0]
+            values.tofile(self.files[key])
+            self.meta[key][2] += values.shape[0]
+
+    def close(self) -> Columns:
+        columns = {}
+        for key, f in self.files.items():
+            f.close()
+            dtype, row_shape, num_rows = self.meta[key]
+            raw_path, npy_path = self.directory / f'{key}.bin', self.directory / f'{key}.npy'
+            out = np.lib.format.open_memmap(npy_path, mode='w+', dtype=dtype, shape=(num_rows, *row_shape))
+            if num_rows:
+                out[:] = np.memmap(raw_path, dtype=dtype, mode='r', shape=(num_rows, *row_shape))
+            out.flush()
+            del out
+            os.remove(raw_path)
+            columns[key] = np.load(npy_path, mmap_mode='r')
+        return columns
+
+
+class FilterPipeline:
+    def __init__(
+            self,
+            filters: Sequence[ChunkFilter],
+            chunk_size: int = 100000,
+            # Evenly spaced rows used to fit percentile thresholds, an approximation that keeps no per-row scores and
+            # only scores the rows earlier filters kept. None fits on every row, exactly, and filters with those scores.
+            fit_rows: Optional[int] = None,
+    ):
+        self.filters = list(filters)
+        self.chunk_size = chunk_size
+        self.fit_rows = fit_rows
+
+    def run(self, columns: Columns, store=None, max_rows: Optional[int] = None) -> Columns:
+        store = store if store is not None else MemoryStore()
+        num_rows = len(columns['rewards'])
+        columns = {k: v for k, v in columns.items() if len(v) == num_rows}
+
+        if self.fit_rows is None or num_rows <= self.fit_rows:
+            for f in self.filters:
+                f.fit(iter_chunks(columns, self.chunk_size), cache=True)
+        else:
+            sample_idx = np.unique(np.linspace(0, num_rows - 1, self.fit_rows).astype(np.int64))
+            sample = {k: np.asarray(v[sample_idx]) for k, v in columns.items()}
+            for f in self.filters:
+                f.fit([sample])
+
+        kept = 0
+        for start, chunk in zip(range(0, num_rows, self.chunk_size), iter_chunks(columns, self.chunk_size)):
+            alive = np.arange(len(chunk['rewards']))
+            for f in self.filters:
+                if alive.size == 0:
+                    break
+                alive = alive[f.mask({k: v[alive] for k, v in chunk.items()}, start + alive)]
+            if max_rows is not None:
+                alive = alive[:max_rows - kept]
+            store.append({k: v[alive] for k, v in chunk.items()})
+            kept += alive.size
+            if max_rows is not None and kept >= max_rows:
+                break
+        print(f'Kept {kept} of {num_rows} synthetic transitions.')
+        return store.close()
@@ -0,0 +1,89 @@
+# Nearest-neighbour novelty of synthetic transitions with respect to the real data.
+# Real transitions are standardized and indexed per pole-length context in a KD-tree (scipy's cKDTree). The novelty
+# of a synthetic row is the mean distance to its k nearest real neighbours in the closest context, in units of the
+# typical distance between real neighbours, so values well above 1 are off the data manifold.
+from typing import Dict, Optional, Sequence
+
+import numpy as np
+
+from synther.corl.shared.filtering import Columns, ScoreFilter
+from synther.diffusion.context_index import ContextIndex
+
+FEATURE_KEYS = ('observations', 'actions', 'rewards', 'next_observations')
+
+
+def _features(data: Columns, keys: Sequence[str]) -> np.ndarray:
+    num_rows = len(data[keys[0]])
+    return np.concatenate([np.asarray(data[k], dtype=np.float32).reshape(num_rows, -1) for k in keys], axis=1)
+
+
+# Distances [N, k] to the k nearest indexed points, queried on all cores.
+def _query(tree, queries: np.ndarray, k: int) -> np.ndarray:
+    k = min(k, tree.n)
+    distances, _ = tree.query(queries, k=k, workers=-1)
+    return distances.reshape(queries.shape[0], k)
+
+
+class NoveltyIndex:
+    def __init__(
+            self,
+            dataset: Columns,  # real transitions
+            k: int = 5,
+            keys: Sequence[str] = FEATURE_KEYS,
+            context_key: str = 'contexts',
+            reference_rows: int = 10000,  # real rows used to measure the typical neighbour distance
+            default_context: Optional[float] = None,  # for synthetic rows without a context, defaults to the first
+            leafsize: int = 32,
+    ):
+        # Imported here, so importing the CORL buffer does not pay for scipy.spatial.
+        from scipy.spatial import cKDTree
+
+        self.k = k
+        self.keys = tuple(keys)
+        self.context_key = context_key
+        features = _features(dataset, self.keys)
+        self.mean = features.mean(axis=0)
+        self.std = features.std(axis=0) + 1e-6
+        features = (features - self.mean) / self.std
+
+        if context_key in dataset:
+            contexts = np.asarray(dataset[context_key]).reshape(features.shape[0], -1)[:, 0]
+        else:
+            contexts = np.zeros(features.shape[0], dtype=np.float32)
+        context_index = ContextIndex(contexts)
+        self.contexts = context_index.values
+        self.default_context = default_context if default_context is not None else self.contexts[0]
+        self.indices: Dict[float, object] = {}
+        reference = []
+        rng = np.random.default_rng(0)
+        for context, rows in context_index.groups():
+            points = features[rows]
+            self.indices[float(context)] = cKDTree(points, leafsize=leafsize)
+            # The nearest neighbour of a real row is itself, so it is queried with k + 1 and dropped.
+            rows = points[rng.choice(points.shape[0], min(points.shape[0], reference_rows), replace=False)]
+            reference.append(_query(self.indices[float(context)], rows, self.k + 1)[:, 1:].mean(axis=1))
+        self.reference_distance = float(np.median(np.concatenate(reference))) + 1e-6
+
+    # Novelty of each row [N]. Rows are matched to the closest real context, which may differ for unseen contexts.
+    def novelty(self, data: Columns) -> np.ndarray:
+        features = (_features(data, self.keys) - self.mean) / self.std
+        if self.context_key in data:
+            contexts = np.asarray(data[self.context_key]).reshape(features.shape[0], -1)[:, 0]
+        else:
+            contexts = np.full(features.shape[0], self.default_context)
+        nearest = self.contexts[np.abs(contexts[:, None] - self.contexts[None]).argmin(axis=1)]
+        distances = np.empty(features.shape[0])
+        for context, rows in ContextIndex(nearest).groups():
+            distances[rows] = _query(self.indices[float(context)], features[rows], self.k).mean(axis=1)
+        return distances / self.reference_distance
+
+    # Sampling weights that fade out novel rows: 1 on the manifold and exp(-(novelty - 1)) beyond it.
+    def weights(self, data: Columns) -> np.ndarray:
+        return np.exp(-np.clip(self.novelty(data) - 1, 0, None))
+
+
+# Rejects rows whose novelty is above a fixed value or above the given percentile of the synthetic data.
+class NoveltyFilter(ScoreFilter):
+    def __init__(self, index: NoveltyIndex, percentile: Optional[float] = None, max_novelty: Optional[float] = None):
+        super().__init__(index.novelty, percentile=percentile, max_score=max_novelty)
+        self.index = index
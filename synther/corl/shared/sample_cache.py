@@ -0,0 +1,142 @@
+# Content-addressed on-disk cache of synthetic transitions generated from diffusion checkpoints.
+import contextlib
+import fcntl
+import hashlib
+import json
+import os
+import pathlib
+import shutil
+import time
+from typing import Callable, Dict, Optional, Sequence
+
+import numpy as np
+
+COLUMNS = ('observations', 'actions', 'rewards', 'next_observations', 'terminals')
+
+
+# Hash of the checkpoint contents. Memoized per (path, size, mtime) so repeated runs skip re-reading the file.
+def checkpoint_hash(path: str, memo_dir: Optional[pathlib.Path] = None) -> str:
+    stat = os.stat(path)
+    memo_key = hashlib.sha1(f'{os.path.abspath(path)}:{stat.st_size}:{stat.st_mtime_ns}'.encode()).hexdigest()
+    memo_path = memo_dir / f'{memo_key}.hash' if memo_dir is not None else None
+    if memo_path is not None and memo_path.exists():
+        return memo_path.read_text()
+
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    value = digest.hexdigest()
+    if memo_path is not None:
+        memo_path.parent.mkdir(parents=True, exist_ok=True)
+        memo_path.write_text(value)
+    return value
+
+
+@contextlib.contextmanager
+def file_lock(path: pathlib.Path, blocking: bool = True):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, 'a') as f:
+        flags = fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB
+        try:
+            fcntl.flock(f, flags)
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+# Entries are directories of .npy columns. The first process to request a key generates and publishes it with an
+# atomic rename under a per-key lock, later processes memory-map the columns read-only. Least recently used entries
+# are evicted once the cache exceeds its size limit.
+class SampleCache:
+    def __init__(self, root: str, max_size_gb: float = 20.):
+        self.root = pathlib.Path(root).expanduser()
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.max_size = max_size_gb * 1024 ** 3
+
+    def key(
+            self,
+            checkpoint_path: str,
+            cond: Optional[Sequence[float]],
+            num_steps: int,
+            sampler: str,
+            seed: int,
+            num_samples: int,
+    ) -> str:
+        description = json.dumps({
+            'checkpoint': checkpoint_hash(checkpoint_path, self.root / 'hashes'),
+            'cond': None if cond is None else [float(c) for c in cond],
+            'num_steps': num_steps,
+            'sampler': sampler,
+            'seed': seed,
+            'num_samples': num_samples,
+        }, sort_keys=True)
+        return hashlib.sha1(description.encode()).hexdigest()
+
+    def _entry(self, key: str) -> pathlib.Path:
+        return self.root / 'entries' / key
+
+    def _lock(self, key: str) -> pathlib.Path:
+        return self.root / 'locks' / f'{key}.lock'
+
+    def _load(self, key: str) -> Dict[str, np.ndarray]:
+        entry = self._entry(key)
+        os.utime(entry)  # mark as recently used
+        return {column: np.load(entry / f'{column}.npy', mmap_mode='r') for column in COLUMNS
+                if (entry / f'{column}.npy').exists()}
+
+    def get(self, key: str) -> Optional[Dict[str, np.ndarray]]:
+        if not self._entry(key).exists():
+            return None
+        return self._load(key)
+
+    def get_or_create(self, key: str, generate: Callable[[], Dict[str, np.ndarray]]) -> Dict[str, np.ndarray]:
+        cached = self.get(key)
+        if cached is not None:
+            print(f'Loaded cached diffusion samples {key}.')
+            return cached
+
+        with file_lock(self._lock(key)):
+            # Another process may have filled the entry while we waited for the lock.
+            if not self._entry(key).exists():
+                print(f'Generating diffusion samples for cache entry {key}.')
+                data = generate()
+                tmp_dir = self.root / 'tmp' / f'{key}.{os.getpid()}'
+                tmp_dir.mkdir(parents=True, exist_ok=True)
+                for column, values in data.items():
+                    np.save(tmp_dir / f'{column}.npy', np.ascontiguousarray(values))
+                self._entry(key).parent.mkdir(parents=True, exist_ok=True)
+                os.rename(tmp_dir, self._entry(key))
+            data = self._load(key)
+        self.evict(keep=key)
+        return data
+
+    @staticmethod
+    def _size(entry: pathlib.Path) -> int:
+        return sum(f.stat().st_size for f in entry.iterdir())
+
+    # Remove least recently used entries until the cache fits its size limit. Entries that are being filled hold
+    # their lock and are skipped. Readers that already mapped an evicted entry keep their pages until they exit.
+    def evict(self, keep: Optional[str] = None):
+        entries_dir = self.root / 'entries'
+        if not entries_dir.exists():
+            return
+        with file_lock(self.root / 'locks' / 'evict.lock'):
+            entries = [(e.stat().st_mtime, self._size(e), e) for e in entries_dir.iterdir() if e.is_dir()]
+            total = sum(size for _, size, _ in entries)
+            for last_used, size, entry in sorted(entries, key=lambda x: x[0]):
+                if total <= self.max_size:
+                    break
+                if entry.name == keep:
+                    continue
+                with file_lock(self._lock(entry.name), blocking=False) as acquired:
+                    if not acquired:
+                        continue
+                    shutil.rmtree(entry, ignore_errors=True)
+                total -= size
+                print(f'Evicted cached diffusion samples {entry.name} ({size / 1024 ** 2:.1f} MB, '
+                      f'last used {time.ctime(last_used)}).')
@@ -0,0 +1,339 @@
+# Local diffusion sampling service.
+# One process holds the EMA model and serves every offline RL job on the node. Concurrent requests are merged into
+# large batches (with a per-row condition), and the split transitions are streamed back in chunks of at most
+# max_batch_size rows.
+# Usage: python -m synther.corl.shared.sampling_service --model results/ema-best.pt --address unix:///tmp/synther.sock
+# and set DiffusionConfig.path to the same address.
+import argparse
+import asyncio
+import json
+import os
+import socket
+import struct
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+import torch
+
+from synther.corl.shared.buffer import ReplayBufferBase, RewardNormalizer, StateNormalizer, TensorBatch
+
+ADDRESS_PREFIXES = ('unix://', 'tcp://')
+_PREFIX = struct.Struct('!II')  # header length, payload length
+
+
+def is_service_address(path: Optional[str]) -> bool:
+    return path is not None and path.startswith(ADDRESS_PREFIXES)
+
+
+def _parse_address(address: str) -> Tuple[str, object]:
+    if address.startswith('unix://'):
+        return 'unix', address[len('unix://'):]
+    host, port = address[len('tcp://'):].rsplit(':', 1)
+    return 'tcp', (host, int(port))
+
+
+# Messages are a JSON header followed by the raw bytes of the arrays it describes.
+def _encode(header: Dict, arrays: Sequence[np.ndarray] = ()) -> bytes:
+    arrays = [np.ascontiguousarray(a) for a in arrays]
+    header = dict(header, arrays=[[a.dtype.str, list(a.shape)] for a in arrays])
+    head = json.dumps(header).encode()
+    payload = b''.join(a.tobytes() for a in arrays)
+    return _PREFIX.pack(len(head), len(payload)) + head + payload
+
+
+def _decode(head: bytes, payload: bytes) -> Tuple[Dict, List[np.ndarray]]:
+    header = json.loads(head)
+    arrays, offset = [], 0
+    for dtype, shape in header.pop('arrays'):
+        count = int(np.prod(shape))
+        array = np.frombuffer(payload, dtype=np.dtype(dtype), count=count, offset=offset).reshape(shape)
+        arrays.append(array)
+        offset += array.nbytes
+    return header, arrays
+
+
+async def _read_message(reader: asyncio.StreamReader) -> Tuple[Dict, List[np.ndarray]]:
+    head_len, payload_len = _PREFIX.unpack(await reader.readexactly(_PREFIX.size))
+    head = await reader.readexactly(head_len)
+    return _decode(head, await reader.readexactly(payload_len))
+
+
+@dataclass
+class _Piece:
+    num_samples: int
+    cond: Optional[List[float]]
+    future: asyncio.Future
+
+
+class SamplingServer:
+    def __init__(
+            self,
+            diffusion,
+            env,  # only used for the observation and action sizes when splitting samples
+            num_steps: int = 128,
+            sampler: str = 'stochastic',
+            max_batch_size: int = 100000,
+            max_wait_ms: float = 20.,  # how long to wait for more requests before launching a batch
+    ):
+        from synther.diffusion.norm import MinMaxNormalizer
+
+        self.diffusion = diffusion.eval()
+        self.env = env
+        self.conditional = getattr(diffusion.net, 'conditional', False)
+        self.clamp_samples = isinstance(diffusion.normalizer, MinMaxNormalizer)
+        self.num_steps = num_steps
+        self.sampler = sampler
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1e3
+        # A single worker thread runs the model, so the event loop keeps accepting and merging requests meanwhile.
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.queue: Optional[asyncio.Queue] = None
+
+    def _generate(self, num_samples: int, cond: Optional[torch.Tensor]) -> List[np.ndarray]:
+        from synther.diffusion.elucidated_diffusion import split_diffusion_samples
+
+        with torch.no_grad():
+            samples = self.diffusion.sample(
+                batch_size=num_samples,
+                num_sample_steps=self.num_steps,
+                clamp=self.clamp_samples,
+                cond=cond,
+                disable_tqdm=True,
+                sampler=self.sampler,
+            )
+        x = split_diffusion_samples(samples.cpu().numpy(), self.env)
+        if len(x) == 4:
+            x = (*x, np.zeros_like(x[3][:, 0]))
+        return [np.asarray(v, dtype=np.float32) for v in x]
+
+    async def _run(self, pieces: List[_Piece]):
+        # Pieces of a request that already failed or disconnected are cancelled and not generated.
+        pieces = [p for p in pieces if not p.future.done()]
+        if not pieces:
+            return
+        num_samples = sum(p.num_samples for p in pieces)
+        cond = None
+        if self.conditional:
+            cond = torch.cat([torch.tensor(p.cond, dtype=torch.float32).expand(p.num_samples, -1) for p in pieces])
+        try:
+            columns = await asyncio.get_running_loop().run_in_executor(
+                self.executor, self._generate, num_samples, cond)
+        except Exception as e:
+            for p in pieces:
+                if not p.future.done():
+                    p.future.set_exception(e)
+            return
+        offset = 0
+        for p in pieces:
+            # A piece can be cancelled while its batch is generated, if its client disconnects.
+            if not p.future.done():
+                p.future.set_result([c[offset:offset + p.num_samples] for c in columns])
+            offset += p.num_samples
+
+    # Collect pieces until the batch is full or the oldest one has waited max_wait, then sample them together.
+    async def _batch_loop(self):
+        loop = asyncio.get_running_loop()
+        carry = None
+        while True:
+            first = carry if carry is not None else await self.queue.get()
+            carry = None
+            pieces, num_samples = [first], first.num_samples
+            deadline = loop.time() + self.max_wait
+            while num_samples < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    piece = await asyncio.wait_for(self.queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                if num_samples + piece.num_samples > self.max_batch_size:
+                    carry = piece
+                    break
+                pieces.append(piece)
+                num_samples += piece.num_samples
+            await self._run(pieces)
+
+    def _validate(self, header: Dict) -> Optional[str]:
+        if header.get('num_samples', 0) <= 0:
+            return 'num_samples must be positive'
+        if self.conditional and header.get('cond') is None:
+            return 'the model is conditional, cond is required'
+        if not self.conditional and header.get('cond') is not None:
+            return 'the model is unconditional, cond must be None'
+        return None
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        loop = asyncio.get_running_loop()
+        pieces = []
+        try:
+            while True:
+                try:
+                    header, _ = await _read_message(reader)
+                except asyncio.IncompleteReadError:
+                    break
+                error = self._validate(header)
+                if error is not None:
+                    writer.write(_encode({'error': error, 'last': True}))
+                    await writer.drain()
+                    continue
+
+                # Large requests are split so that they can be merged with others and streamed back in chunks.
+                num_samples, pieces = header['num_samples'], []
+                for start in range(0, num_samples, self.max_batch_size):
+                    piece = _Piece(min(self.max_batch_size, num_samples - start), header.get('cond'),
+                                   loop.create_future())
+                    pieces.append(piece)
+                    await self.queue.put(piece)
+                for i, piece in enumerate(pieces):
+                    try:
+                        columns = await piece.future
+                    except Exception as e:
+                        for rest in pieces[i + 1:]:
+                            rest.future.cancel()
+                        writer.write(_encode({'error': repr(e), 'last': True}))
+                        await writer.drain()
+                        break
+                    writer.write(_encode({'last': i == len(pieces) - 1}, columns))
+                    await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            # Drop the pieces still queued for a closed connection.
+            for piece in pieces:
+                piece.future.cancel()
+            writer.close()
+
+    async def serve(self, address: str):
+        self.queue = asyncio.Queue()
+        kind, target = _parse_address(address)
+        if kind == 'unix':
+            if os.path.exists(target):
+                os.unlink(target)
+            server = await asyncio.start_unix_server(self._handle, path=target)
+        else:
+            server = await asyncio.start_server(self._handle, host=target[0], port=target[1])
+        print(f'Sampling service listening on {address}.')
+        batcher = asyncio.create_task(self._batch_loop())
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            batcher.cancel()
+
+
+# Drop-in replay buffer that draws fresh diffusion samples from a sampling service. Like DiffusionGenerator it
+# fetches batch_size * batch_parallelism rows at a time, and the next block is requested as soon as the current one
+# arrives so the server generates while the learner trains.
+class DiffusionServiceClient(ReplayBufferBase):
+    def __init__(
+            self,
+            address: str,
+            cond: Optional[Sequence[float]] = None,  # default condition when sample() is called without one
+            batch_parallelism: int = 100,
+            device: str = "cpu",
+            reward_normalizer: Optional[RewardNormalizer] = None,
+            state_normalizer: Optional[StateNormalizer] = None,
+    ):
+        super().__init__(device, reward_normalizer, state_normalizer)
+        kind, target = _parse_address(address)
+        self.sock = socket.socket(socket.AF_UNIX if kind == 'unix' else socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.connect(target)
+        self.cond = self._cond_list(cond)
+        self.batch_parallelism = batch_parallelism
+        self.cache = []
+        self.cache_pointer = 0
+        self._inflight = None  # (num_samples, cond) of the prefetched request
+
+    @staticmethod
+    def _cond_list(cond) -> Optional[List[float]]:
+        if cond is None:
+            return None
+        return [float(c) for c in torch.as_tensor(cond).reshape(-1)]
+
+    def _recv_exact(self, n: int) -> bytearray:
+        buf = bytearray(n)
+        view, received = memoryview(buf), 0
+        while received < n:
+            count = self.sock.recv_into(view[received:])
+            if count == 0:
+                raise ConnectionError('Sampling service closed the connection')
+            received += count
+        return buf
+
+    def _send(self, num_samples: int, cond: Optional[List[float]]):
+        self.sock.sendall(_encode({'num_samples': num_samples, 'cond': cond}))
+
+    def _receive(self) -> List[np.ndarray]:
+        chunks = []
+        while True:
+            head_len, payload_len = _PREFIX.unpack(self._recv_exact(_PREFIX.size))
+            header, arrays = _decode(self._recv_exact(head_len), self._recv_exact(payload_len))
+            if 'error' in header:
+                raise RuntimeError(f'Sampling service error: {header["error"]}')
+            chunks.append(arrays)
+            if header['last']:
+                break
+        return [np.concatenate(column) for column in zip(*chunks)]
+
+    # Blocking request for a fixed number of samples.
+    def request(self, num_samples: int, cond=None) -> List[np.ndarray]:
+        if self._inflight is not None:
+            self._receive()  # drain the prefetched block to keep the stream in order
+            self._inflight = None
+        self._send(num_samples, self._cond_list(cond) if cond is not None else self.cond)
+        return self._receive()
+
+    def _sample(self, batch_size: int, cond=None, **kwargs) -> TensorBatch:
+        cond = self._cond_list(cond) if cond is not None else self.cond
+        if not self.cache or self.cache_pointer + batch_size > self.cache[0].shape[0]:
+            request = (batch_size * self.batch_parallelism, cond)
+            if self._inflight != request:
+                if self._inflight is not None:
+                    self._receive()  # prefetched with different settings
+                self._send(*request)
+            columns = self._receive()
+            self._send(*request)
+            self._inflight = request
+            self.cache = [torch.from_numpy(c).to(self._device) for c in columns]
+            self.cache_pointer = 0
+        batch = [x[self.cache_pointer: self.cache_pointer + batch_size] for x in self.cache]
+        self.cache_pointer += batch_size
+        return batch
+
+    def close(self):
+        self.sock.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model', type=str, required=True, help='EMA sampling artifact (ema-*.pt)')
+    parser.add_argument('--address', type=str, default='unix:///tmp/synther-diffusion.sock')
+    parser.add_argument('--env', type=str, default='cartpole')
+    parser.add_argument('--num_steps', type=int, default=128)
+    parser.add_argument('--sampler', type=str, default='stochastic')
+    parser.add_argument('--max_batch_size', type=int, default=100000)
+    parser.add_argument('--max_wait_ms', type=float, default=20.)
+    parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+    args = parser.parse_args()
+
+    from synther.diffusion.artifact import load_sampling_artifact
+
+    if args.env == 'cartpole':
+        from dmc2gymnasium import DMCGym
+        env = DMCGym("cartpole", "swingup")
+    else:
+        import gym
+        env = gym.make(args.env)
+
+    server = SamplingServer(
+        load_sampling_artifact(args.model, device=args.device),
+        env,
+        num_steps=args.num_steps,
+        sampler=args.sampler,
+        max_batch_size=args.max_batch_size,
+        max_wait_ms=args.max_wait_ms,
+    )
+    asyncio.run(server.serve(args.address))
@@ -0,0 +1,63 @@
+# Sum tree over per-transition priorities for proportional sampling.
+# The tree is one contiguous array: node i has children 2i and 2i + 1, the root is node 1 and the leaves start at
+# `capacity` (a power of two). Batched sampling and updates walk all rows down or up the tree together, one level
+# per NumPy operation, so both cost O(log n) vectorized steps.
+from typing import Optional
+
+import numpy as np
+
+
+class SumTree:
+    def __init__(self, size: int):
+        self.size = size
+        self.capacity = 1 << max(0, (size - 1).bit_length())
+        self.tree = np.zeros(2 * self.capacity, dtype=np.float64)
+        self.max_priority = 1.
+
+    @property
+    def total(self) -> float:
+        return float(self.tree[1])
+
+    @property
+    def priorities(self) -> np.ndarray:
+        return self.tree[self.capacity:self.capacity + self.size]
+
+    # Replace all priorities, rebuilding the inner nodes level by level in O(n).
+    def set(self, priorities: np.ndarray):
+        priorities = np.asarray(priorities, dtype=np.float64)
+        assert priorities.shape == (self.size,) and (priorities >= 0).all(), 'Expected one non-negative value per row'
+        self.tree[:] = 0.
+        self.tree[self.capacity:self.capacity + self.size] = priorities
+        start = self.capacity // 2
+        while start >= 1:
+            self.tree[start:2 * start] = self.tree[2 * start:4 * start:2] + self.tree[2 * start + 1:4 * start:2]
+            start //= 2
+        self.max_priority = max(float(priorities.max(initial=0.)), 1e-12)
+
+    def update(self, indices: np.ndarray, priorities: np.ndarray):
+        nodes = np.asarray(indices, dtype=np.int64) + self.capacity
+        priorities = np.broadcast_to(np.asarray(priorities, dtype=np.float64), nodes.shape)
+        assert (priorities >= 0).all(), 'Priorities must be non-negative'
+        self.tree[nodes] = priorities
+        self.max_priority = max(self.max_priority, float(priorities.max(initial=0.)))
+        # All leaves are on the same level, so the parents to refresh are too.
+        nodes = np.unique(nodes // 2)
+        while nodes.size and nodes[0] >= 1:
+            self.tree[nodes] = self.tree[2 * nodes] + self.tree[2 * nodes + 1]
+            nodes = np.unique(nodes[nodes > 1] // 2)
+
+    # Stratified proportional sampling: one uniform draw in each of batch_size equal slices of the total mass.
+    def sample(self, batch_size: int, rng: Optional[np.random.Generator] = None) -> np.ndarray:
+        assert self.total > 0, 'Cannot sample from a tree without priority mass'
+        # The global NumPy RNG by default, so seeding works as for uniform replay sampling.
+        u = rng.random(batch_size) if rng is not None else np.random.random(batch_size)
+        mass = (np.arange(batch_size) + u) * (self.total / batch_size)
+        nodes = np.ones(batch_size, dtype=np.int64)
+        while nodes[0] < self.capacity:
+            left = 2 * nodes
+            left_mass = self.tree[left]
+            # Rounding must not send a draw into an empty subtree.
+            go_right = (mass >= left_mass) & (self.tree[left + 1] > 0)
+            mass = np.where(go_right, mass - left_mass, mass)
+            nodes = np.where(go_right, left + 1, left)
+        return nodes - self.capacity
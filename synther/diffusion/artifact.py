@@ -0,0 +1,157 @@
+# EMA-only sampling artifacts.
+# A training checkpoint holds the online model, optimizer, EMA and scaler state, and rebuilding the sampler from it
+# needs the gin config and the training dataset for the normalizer. An artifact stores just the EMA weights
+# (normalizer buffers included) and the model config. It is written as an uncompressed torch zip file, so consumers
+# load it with mmap and processes opening the same file share its pages through the page cache.
+# Usage: python -m synther.diffusion.artifact best.pt best-ema.pt --gin_config_files config/resmlp_denoiser.gin
+import argparse
+import json
+import os
+from typing import Dict, Optional
+
+import gin
+import torch
+
+from synther.diffusion.denoiser_network import ResidualMLPDenoiser
+from synther.diffusion.elucidated_diffusion import ElucidatedDiffusion
+from synther.diffusion.norm import MinMaxNormalizer, Normalizer, normalizer_factory
+
+ARTIFACT_FORMAT = 'synther-ema-v1'
+# Tuned sampling settings written next to a model by benchmark_sampler.py.
+SAMPLER_SETTINGS_FILE = 'sampler.json'
+
+# ElucidatedDiffusion attributes needed for sampling.
+_SAMPLING_ATTRS = (
+    'num_sample_steps', 'sigma_min', 'sigma_max', 'sigma_data', 'rho',
+    'P_mean', 'P_std', 'S_churn', 'S_tmin', 'S_tmax', 'S_noise',
+)
+
+
+def model_config(diffusion: ElucidatedDiffusion) -> Dict:
+    normalizer = diffusion.normalizer
+    if isinstance(normalizer, MinMaxNormalizer):
+        normalizer_type, normalizer_kwargs = 'minmax', {}
+    elif isinstance(normalizer, Normalizer):
+        normalizer_type, normalizer_kwargs = 'standard', {'target_std': normalizer.target_std}
+    else:
+        raise ValueError(f'Unsupported normalizer: {type(normalizer).__name__}')
+    return {
+        'event_shape': list(diffusion.event_shape),
+        'denoiser': dict(diffusion.net.config),
+        'normalizer': normalizer_type,
+        'normalizer_kwargs': normalizer_kwargs,
+        'skip_dims': list(getattr(normalizer, 'skip_dims', [])),
+        'diffusion': {attr: getattr(diffusion, attr) for attr in _SAMPLING_ATTRS},
+    }
+
+
+# Strip the EMA wrapper prefix from a training checkpoint's EMA state dict.
+def ema_state_dict(checkpoint: Dict) -> Dict[str, torch.Tensor]:
+    return {k[len('ema_model.'):]: v for k, v in checkpoint['ema'].items() if k.startswith('ema_model.')}
+
+
+# The adaptive noise sampler only matters for training and is dropped from the artifact.
+def _sampling_state_dict(state_dict: Dict[str, torch.Tensor]) -> Dict[str, torch.Tensor]:
+    return {k: v.detach().cpu().contiguous() for k, v in state_dict.items() if not k.startswith('sigma_sampler.')}
+
+
+def export_sampling_artifact(
+        diffusion: ElucidatedDiffusion,
+        path: str,
+        state_dict: Optional[Dict[str, torch.Tensor]] = None,  # defaults to the weights of `diffusion`
+):
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    torch.save({
+        'format': ARTIFACT_FORMAT,
+        'config': model_config(diffusion),
+        'state_dict': _sampling_state_dict(state_dict if state_dict is not None else diffusion.state_dict()),
+    }, tmp_path)
+    os.replace(tmp_path, path)  # readers never see a partial file
+
+
+def is_sampling_artifact(data: Dict) -> bool:
+    return isinstance(data, dict) and data.get('format') == ARTIFACT_FORMAT
+
+
+# Build an untrained model from a config. The normalizer buffers are placeholders until weights are loaded.
+def model_from_config(config: Dict) -> ElucidatedDiffusion:
+    event_dim = config['event_shape'][0]
+    net = ResidualMLPDenoiser(**config['denoiser'])
+    normalizer = normalizer_factory(
+        config['normalizer'], torch.zeros(2, event_dim), skip_dims=config['skip_dims'],
+        **config['normalizer_kwargs'])
+    return ElucidatedDiffusion(
+        net=net,
+        normalizer=normalizer,
+        event_shape=config['event_shape'],
+        adaptive_noise=False,
+        **config['diffusion'],
+    )
+
+
+# Rebuild the model from an already loaded artifact. Modules are created on the meta device and the (memory-mapped)
+# tensors are assigned in place, so no weights are initialized or copied on CPU.
+def model_from_artifact(data: Dict, device: str = 'cpu') -> ElucidatedDiffusion:
+    assert is_sampling_artifact(data), 'Not a sampling artifact'
+    with torch.device('meta'):
+        diffusion = model_from_config(data['config'])
+    diffusion.load_state_dict(data['state_dict'], assign=True)
+    return diffusion.to(device).eval()
+
+
+def load_sampling_artifact(path: str, device: str = 'cpu') -> ElucidatedDiffusion:
+    data = torch.load(path, map_location='cpu', mmap=True, weights_only=True)
+    return model_from_artifact(data, device=device)
+
+
+def sampler_settings_path(model_path: str) -> str:
+    return os.path.join(os.path.dirname(os.path.abspath(model_path)), SAMPLER_SETTINGS_FILE)
+
+
+def save_sampler_settings(model_path: str, settings: Dict):
+    with open(sampler_settings_path(model_path), 'w') as f:
+        json.dump(settings, f, indent=2)
+
+
+def load_sampler_settings(model_path: str) -> Optional[Dict]:
+    path = sampler_settings_path(model_path)
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+# Convert an existing training checkpoint. The denoiser is rebuilt from the gin config with the event and
+# condition sizes read off the stored weights, the normalizer buffers come from the EMA state dict.
+def convert_checkpoint(checkpoint_path: str, out_path: str, normalizer_type: Optional[str] = None):
+    checkpoint = torch.load(checkpoint_path, map_location='cpu')
+    state_dict = ema_state_dict(checkpoint)
+    event_dim = state_dict['net.residual_mlp.final_linear.weight'].shape[0]
+    cond_dim = state_dict['net.proj.weight'].shape[1] - event_dim or None
+    if normalizer_type is None:
+        normalizer_type = 'minmax' if 'normalizer.min' in state_dict else 'standard'
+
+    diffusion = ElucidatedDiffusion(
+        net=ResidualMLPDenoiser(d_in=event_dim, cond_dim=cond_dim),
+        normalizer=normalizer_factory(normalizer_type, torch.zeros(2, event_dim)),
+        event_shape=[event_dim],
+        adaptive_noise=False,
+    )
+    # Loading checks that the gin config matches the stored weights.
+    state_dict = _sampling_state_dict(state_dict)
+    diffusion.load_state_dict(state_dict)
+    export_sampling_artifact(diffusion, out_path, state_dict=state_dict)
+    print(f'Exported EMA sampling artifact to {out_path}.')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('checkpoint', type=str)
+    parser.add_argument('out', type=str)
+    parser.add_argument('--gin_config_files', nargs='*', type=str, default=['config/resmlp_denoiser.gin'])
+    parser.add_argument('--gin_params', nargs='*', type=str, default=[])
+    parser.add_argument('--normalizer', type=str, default=None)
+    args = parser.parse_args()
+
+    gin.parse_config_files_and_bindings(args.gin_config_files, args.gin_params)
+    convert_checkpoint(args.checkpoint, args.out, normalizer_type=args.normalizer)
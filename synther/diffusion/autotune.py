@@ -0,0 +1,173 @@
+# Batch size autotuning for diffusion training and sampling under a memory budget.
+
+import copy
+import hashlib
+import json
+import os
+import pathlib
+import socket
+import time
+from typing import Optional, Sequence, Tuple
+
+import gin
+import torch
+
+TRAIN_CANDIDATES = (256, 512, 1024, 2048, 4096, 8192, 16384)
+SAMPLE_CANDIDATES = (1000, 5000, 10000, 25000, 50000, 100000, 200000)
+
+
+def _device_name(device: torch.device) -> str:
+    if device.type == 'cuda':
+        return torch.cuda.get_device_name(device)
+    return device.type
+
+
+# Cache key covering the model architecture, the probe settings and the machine.
+def _cache_key(model, mode: str, device: torch.device, extra: Tuple = ()) -> str:
+    description = repr((
+        repr(model.net),
+        list(model.event_shape),
+        type(model.normalizer).__name__,
+        mode,
+        extra,
+        socket.gethostname(),
+        _device_name(device),
+        torch.__version__,
+    ))
+    return hashlib.sha1(description.encode()).hexdigest()
+
+
+def _load_cache(path: pathlib.Path) -> dict:
+    if not path.exists():
+        return {}
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _store_cache(path: pathlib.Path, key: str, entry: dict):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    cache = _load_cache(path)
+    cache[key] = entry
+    tmp_path = path.with_suffix(f'.{os.getpid()}.tmp')
+    with open(tmp_path, 'w') as f:
+        json.dump(cache, f, indent=2)
+    os.replace(tmp_path, path)
+
+
+def _is_oom(e: RuntimeError) -> bool:
+    return 'out of memory' in str(e).lower()
+
+
+def _synchronize(device: torch.device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+
+
+def _random_cond(model, batch_size: int, device: torch.device):
+    if not getattr(model.net, 'conditional', False):
+        return None
+    cond_dim = model.net.proj.in_features - model.event_shape[0]
+    return torch.rand(batch_size, cond_dim, device=device)
+
+
+# Seconds per optimizer step on a throwaway copy of the model.
+def _probe_train(model, batch_size: int, device: torch.device, steps: int) -> float:
+    model = copy.deepcopy(model).to(device).train()
+    opt = torch.optim.AdamW(model.parameters(), lr=1e-4)
+    data = torch.randn(batch_size, *model.event_shape, device=device)
+    cond = _random_cond(model, batch_size, device)
+    for i in range(steps + 1):
+        if i == 1:
+            # The first step warms up kernels and allocator caches.
+            _synchronize(device)
+            start = time.perf_counter()
+        loss = model(data, cond=cond)
+        loss.backward()
+        opt.step()
+        opt.zero_grad()
+    _synchronize(device)
+    return (time.perf_counter() - start) / steps
+
+
+# Seconds per denoising step when sampling.
+def _probe_sample(model, batch_size: int, device: torch.device, steps: int) -> float:
+    model = model.to(device)
+    cond = _random_cond(model, 1, device)
+    model.sample(batch_size=batch_size, num_sample_steps=2, cond=cond, disable_tqdm=True)
+    _synchronize(device)
+    start = time.perf_counter()
+    model.sample(batch_size=batch_size, num_sample_steps=steps, cond=cond, disable_tqdm=True)
+    _synchronize(device)
+    return (time.perf_counter() - start) / steps
+
+
+# Probe throughput and peak memory of every candidate batch size and return the fastest one that fits the budget.
+# Results are cached per (model config, host), so the probe only runs once per machine.
+@gin.configurable
+def autotune_batch_size(
+        model,
+        mode: str = 'train',  # 'train' or 'sample'
+        device: Optional[torch.device] = None,
+        candidates: Optional[Sequence[int]] = None,
+        memory_budget_gb: Optional[float] = None,  # defaults to 90% of the device memory
+        probe_steps: int = 5,
+        cache_path: str = '~/.cache/synther/autotune.json',
+        max_batch_size: Optional[int] = None,
+) -> int:
+    assert mode in ('train', 'sample'), f'Unknown autotune mode: {mode}'
+    device = torch.device(device) if device is not None else model.device
+    candidates = sorted(candidates or (TRAIN_CANDIDATES if mode == 'train' else SAMPLE_CANDIDATES))
+    if max_batch_size is not None:
+        candidates = [c for c in candidates if c <= max_batch_size] or [min(candidates[0], max_batch_size)]
+
+    cache_path = pathlib.Path(cache_path).expanduser()
+    key = _cache_key(model, mode, device, (tuple(candidates), memory_budget_gb, probe_steps))
+    cached = _load_cache(cache_path).get(key)
+    if cached is not None:
+        print(f'Autotuned {mode} batch size (cached): {cached["batch_size"]}')
+        return cached['batch_size']
+
+    if memory_budget_gb is not None:
+        budget = memory_budget_gb * 1024 ** 3
+    elif device.type == 'cuda':
+        budget = 0.9 * torch.cuda.get_device_properties(device).total_memory
+    else:
+        budget = None
+
+    probe = _probe_train if mode == 'train' else _probe_sample
+    results = []
+    for batch_size in candidates:
+        if device.type == 'cuda':
+            torch.cuda.empty_cache()
+            torch.cuda.reset_peak_memory_stats(device)
+        try:
+            seconds = probe(model, batch_size, device, probe_steps)
+        except RuntimeError as e:
+            if not _is_oom(e):
+                raise
+            print(f'Batch size {batch_size}: out of memory')
+            break
+        # Peak memory is only tracked on CUDA devices.
+        peak = torch.cuda.max_memory_allocated(device) if device.type == 'cuda' else None
+        fits = budget is None or peak is None or peak <= budget
+        results.append({
+            'batch_size': batch_size,
+            'samples_per_sec': batch_size / seconds,
+            'peak_memory_gb': peak / 1024 ** 3 if peak is not None else None,
+            'fits': fits,
+        })
+        print(f'Batch size {batch_size}: {batch_size / seconds:.0f} samples/s, '
+              f'peak memory {results[-1]["peak_memory_gb"]} GB')
+        if not fits:
+            break
+
+    if device.type == 'cuda':
+        torch.cuda.empty_cache()
+    fitting = [r for r in results if r['fits']]
+    batch_size = max(fitting, key=lambda r: r['samples_per_sec'])['batch_size'] if fitting else candidates[0]
+    print(f'Autotuned {mode} batch size: {batch_size}')
+    _store_cache(cache_path, key, {'batch_size': batch_size, 'results': results})
+    return batch_size
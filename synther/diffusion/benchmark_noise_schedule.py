@@ -0,0 +1,122 @@
+# Compare the fixed log-normal noise schedule against adaptive noise-level importance sampling.
+import argparse
+import json
+import pathlib
+
+import gin
+import numpy as np
+import torch
+import wandb
+from dm_control import suite
+
+from synther.diffusion.elucidated_diffusion import Trainer, calculate_diffusion_loss
+from synther.diffusion.utils import make_inputs, construct_diffusion_model
+
+
+def dynamics_error(trainer: Trainer, conds, env) -> float:
+    errors = []
+    for cond in conds:
+        observations, actions, rewards, next_observations, terminals = trainer.generator.sample(
+            num_samples=trainer.generator.sample_batch_size,
+            cond=torch.tensor([cond], dtype=torch.float32)[:, None],
+        )
+        observation_err, reward_err = calculate_diffusion_loss(
+            {
+                "observations": observations,
+                "actions": actions,
+                "rewards": rewards,
+                "next_observations": next_observations,
+                "terminals": terminals,
+            },
+            env,
+            pole_size=cond,
+        )
+        errors.append(np.concatenate([observation_err, reward_err], axis=1).mean())
+    return float(np.mean(errors))
+
+
+def run(args, adaptive: bool) -> dict:
+    np.random.seed(args.seed)
+    torch.manual_seed(args.seed)
+    with gin.unlock_config():
+        gin.bind_parameter('ElucidatedDiffusion.adaptive_noise', adaptive)
+
+    train_inputs, train_contexts = make_inputs(args.train_dataset, context=True, segment=args.segment)
+    eval_inputs, eval_contexts = make_inputs(args.eval_dataset, context=True)
+    train_inputs, train_contexts = torch.from_numpy(train_inputs).float(), torch.from_numpy(train_contexts).float()
+    eval_dataset = torch.utils.data.TensorDataset(
+        torch.from_numpy(eval_inputs).float(), torch.from_numpy(eval_contexts).float())
+
+    results_folder = pathlib.Path(args.results_folder) / ('adaptive' if adaptive else 'fixed')
+    results_folder.mkdir(parents=True, exist_ok=True)
+
+    env = suite.load(domain_name="cartpole", task_name="swingup")
+    diffusion = construct_diffusion_model(inputs=train_inputs, cond_dim=train_contexts.shape[1])
+    trainer = Trainer(
+        diffusion,
+        train_dataset=torch.utils.data.TensorDataset(train_inputs, train_contexts),
+        test_dataset=eval_dataset,
+        results_folder=str(results_folder),
+        train_num_steps=args.train_num_steps,
+        env=env,
+    )
+
+    history = []
+    while trainer.step < args.train_num_steps:
+        data, context = next(trainer.dl)
+        trainer.train_on_batch(data, use_wandb=False, cond=context.to(trainer.accelerator.device))
+        if trainer.step % args.eval_interval == 0:
+            eval_loss = trainer.evaluate(accumulate_every=args.eval_batches)
+            # The dynamics error at every evaluation point gives an error-over-steps curve for both schedules.
+            history.append({'step': trainer.step, 'eval_loss': eval_loss,
+                            'dynamics_error': dynamics_error(trainer, args.conds, env)})
+    return {
+        'history': history,
+        'dynamics_error': history[-1]['dynamics_error'] if history and history[-1]['step'] == trainer.step
+        else dynamics_error(trainer, args.conds, env),
+    }
+
+
+def steps_to_target(history, target):
+    for entry in history:
+        if entry['eval_loss'] <= target:
+            return entry['step']
+    return None
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--train_dataset', type=str, default="train_dataset.npz")
+    parser.add_argument('--eval_dataset', type=str, default="eval_dataset.npz")
+    parser.add_argument('--segment', type=str, default=None)
+    parser.add_argument('--gin_config_files', nargs='*', type=str, default=['../config/resmlp_denoiser.gin'])
+    parser.add_argument('--gin_params', nargs='*', type=str, default=[])
+    parser.add_argument('--results_folder', type=str, default='./results_noise_schedule')
+    parser.add_argument('--train_num_steps', type=int, default=int(1e5))
+    parser.add_argument('--eval_interval', type=int, default=int(5e3))
+    parser.add_argument('--eval_batches', type=int, default=100)
+    parser.add_argument('--tolerance', type=float, default=0.01)  # relative slack on the target eval loss
+    parser.add_argument('--conds', type=float, nargs='+', default=[0.2, 0.4, 0.6])
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    gin.parse_config_files_and_bindings(args.gin_config_files, args.gin_params)
+    wandb.init(mode='disabled')
+
+    results = {'fixed': run(args, adaptive=False), 'adaptive': run(args, adaptive=True)}
+
+    # The target is the final eval loss of the fixed schedule.
+    target = results['fixed']['history'][-1]['eval_loss'] * (1 + args.tolerance)
+    for name, result in results.items():
+        result['steps_to_target'] = steps_to_target(result['history'], target)
+        for entry in result['history']:
+            print(f"{name} step {entry['step']}: eval loss {entry['eval_loss']:.4f}, "
+                  f"dynamics error {entry['dynamics_error']:.5f}")
+        print(f"{name}: final eval loss {result['history'][-1]['eval_loss']:.4f}, "
+              f"steps to {target:.4f}: {result['steps_to_target']}, "
+              f"dynamics error {result['dynamics_error']:.5f}")
+
+    results_folder = pathlib.Path(args.results_folder)
+    results_folder.mkdir(parents=True, exist_ok=True)
+    with open(results_folder / 'noise_schedule_benchmark.json', 'w') as f:
+        json.dump({'target_eval_loss': target, **results}, f, indent=2)
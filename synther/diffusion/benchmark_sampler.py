@@ -0,0 +1,193 @@
+# Sweep sampling step counts and sampler modes for a trained model and report throughput against fidelity.
+# Fidelity is the MuJoCo dynamics error of the generated transitions (calculate_diffusion_loss, with the pole set to
+# each condition) and the per-dimension Wasserstein-1 distance of the samples to a reference set.
+# With --student, cascade sampling (student above each handoff sigma, full model below) is added to the sweep.
+# Usage: python benchmark_sampler.py --model results/ema-best.pt --conds 0.2 0.4 --max_error 0.01 --write_back
+import argparse
+import csv
+import json
+import pathlib
+import time
+from typing import Dict, List, Optional
+
+import numpy as np
+import torch
+
+from synther.diffusion.artifact import load_sampling_artifact, save_sampler_settings, sampler_settings_path
+from synther.diffusion.elucidated_diffusion import SAMPLERS, split_diffusion_samples
+from synther.diffusion.norm import MinMaxNormalizer
+from synther.diffusion.verification import calculate_diffusion_loss
+
+
+def _synchronize(device: torch.device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+
+
+def generate(model, num_samples: int, batch_size: int, num_steps: int, sampler: str, cond: Optional[float],
+             student=None, handoff_sigma: float = 1.0):
+    device = model.device
+    cond = torch.tensor([[cond]], dtype=torch.float32) if cond is not None else None
+    clamp = isinstance(model.normalizer, MinMaxNormalizer)
+    samples = []
+    _synchronize(device)
+    start = time.perf_counter()
+    for offset in range(0, num_samples, batch_size):
+        samples.append(model.sample(
+            batch_size=min(batch_size, num_samples - offset),
+            num_sample_steps=num_steps,
+            clamp=clamp,
+            cond=cond,
+            disable_tqdm=True,
+            sampler=sampler,
+            student=student,
+            handoff_sigma=handoff_sigma,
+        ))
+    _synchronize(device)
+    seconds = time.perf_counter() - start
+    return torch.cat(samples).cpu().numpy(), num_samples / seconds
+
+
+# Mean absolute next-state and reward error of simulating the generated (s, a) pairs.
+def dynamics_error(samples: np.ndarray, split_env, pole_size: Optional[float]) -> float:
+    x = split_diffusion_samples(samples, split_env)
+    observation_err, reward_err = calculate_diffusion_loss(
+        {'observations': x[0], 'actions': x[1], 'rewards': x[2], 'next_observations': x[3]}, pole_size=pole_size)
+    return float(np.concatenate([observation_err, reward_err], axis=1).mean())
+
+
+# Per-dimension Wasserstein-1 distance between empirical marginals, in units of the reference standard deviation.
+def marginal_distance(samples: np.ndarray, reference: np.ndarray, num_quantiles: int = 200) -> float:
+    q = (np.arange(num_quantiles) + 0.5) / num_quantiles
+    scale = reference.std(axis=0) + 1e-6
+    distance = np.abs(np.quantile(samples, q, axis=0) - np.quantile(reference, q, axis=0)).mean(axis=0)
+    return float((distance / scale).mean())
+
+
+# A setting is on the front if no other setting is at least as fast and at least as accurate, and strictly better
+# in one of the three.
+def pareto_front(rows: List[Dict]) -> List[bool]:
+    def dominates(a, b):
+        no_worse = (a['samples_per_sec'] >= b['samples_per_sec'] and a['dynamics_error'] <= b['dynamics_error']
+                    and a['marginal_w1'] <= b['marginal_w1'])
+        better = (a['samples_per_sec'] > b['samples_per_sec'] or a['dynamics_error'] < b['dynamics_error']
+                  or a['marginal_w1'] < b['marginal_w1'])
+        return no_worse and better
+    return [not any(dominates(other, row) for other in rows) for row in rows]
+
+
+def reference_samples(args, model, conds) -> Dict:
+    if args.dataset is not None:
+        from synther.diffusion.utils import make_inputs
+
+        inputs, contexts = make_inputs(args.dataset, context=True)
+        from synther.diffusion.context_index import ContextIndex
+
+        context_index = ContextIndex(contexts)
+        values = context_index.values
+        references = {}
+        for cond in conds:
+            nearest = values[np.argmin(np.abs(values - cond))] if cond is not None else None
+            rows = inputs if nearest is None else inputs[context_index.select(values=[nearest])]
+            references[cond] = rows[np.random.permutation(rows.shape[0])[:args.num_samples]]
+        return references
+    # Without a dataset the most expensive setting serves as the reference.
+    torch.manual_seed(args.seed)
+    return {cond: generate(model, args.num_samples, args.batch_size, max(args.steps), 'stochastic', cond)[0]
+            for cond in conds}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model', type=str, required=True, help='EMA sampling artifact (ema-*.pt)')
+    parser.add_argument('--conds', type=float, nargs='*', default=[None])
+    parser.add_argument('--steps', type=int, nargs='+', default=[8, 16, 32, 64, 128])
+    parser.add_argument('--samplers', type=str, nargs='+', default=list(SAMPLERS))
+    parser.add_argument('--dataset', type=str, default=None, help='reference data for the marginal statistics')
+    parser.add_argument('--student', type=str, default=None, help='EMA artifact of a narrow cascade student')
+    parser.add_argument('--handoff_sigmas', type=float, nargs='+', default=[0.5, 2., 10.])
+    parser.add_argument('--num_samples', type=int, default=20000)
+    parser.add_argument('--num_verify', type=int, default=2000)  # rows simulated in MuJoCo per setting
+    parser.add_argument('--batch_size', type=int, default=20000)
+    parser.add_argument('--max_error', type=float, default=None, help='dynamics error threshold for write-back')
+    parser.add_argument('--max_marginal', type=float, default=None)
+    parser.add_argument('--write_back', action='store_true', help='store the cheapest setting in sampler.json')
+    parser.add_argument('--results_folder', type=str, default='./results_sampler')
+    parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    np.random.seed(args.seed)
+
+    from dmc2gymnasium import DMCGym
+
+    model = load_sampling_artifact(args.model, device=args.device)
+    student = load_sampling_artifact(args.student, device=args.device) if args.student is not None else None
+    # None is the single-model sampler.
+    handoffs = [None] + (args.handoff_sigmas if student is not None else [])
+    split_env = DMCGym("cartpole", "swingup")
+    references = reference_samples(args, model, args.conds)
+
+    rows = []
+    for sampler in args.samplers:
+        for num_steps in args.steps:
+            for handoff_sigma in handoffs:
+                speeds, errors, distances = [], [], []
+                for cond in args.conds:
+                    torch.manual_seed(args.seed)
+                    samples, samples_per_sec = generate(
+                        model, args.num_samples, args.batch_size, num_steps, sampler, cond,
+                        student=student if handoff_sigma is not None else None, handoff_sigma=handoff_sigma or 0.)
+                    speeds.append(samples_per_sec)
+                    errors.append(dynamics_error(samples[:args.num_verify], split_env, cond))
+                    distances.append(marginal_distance(samples, references[cond]))
+                rows.append({
+                    'sampler': sampler,
+                    'num_steps': num_steps,
+                    'handoff_sigma': handoff_sigma,
+                    'samples_per_sec': float(np.mean(speeds)),
+                    'dynamics_error': float(np.mean(errors)),
+                    'marginal_w1': float(np.mean(distances)),
+                })
+                print(rows[-1])
+
+    # Cascade rows are also reported relative to the single-model sampler with the same settings.
+    single = {(r['sampler'], r['num_steps']): r for r in rows if r['handoff_sigma'] is None}
+    for row in rows:
+        base = single[(row['sampler'], row['num_steps'])]
+        row['speedup'] = row['samples_per_sec'] / base['samples_per_sec']
+        row['error_change'] = row['dynamics_error'] - base['dynamics_error']
+
+    for row, on_front in zip(rows, pareto_front(rows)):
+        row['pareto'] = on_front
+    rows.sort(key=lambda r: -r['samples_per_sec'])
+    print(f"{'sampler':>14} {'steps':>6} {'handoff':>8} {'samples/s':>10} {'dyn. error':>11} {'marg. W1':>9} "
+          f"{'speedup':>8} pareto")
+    for row in rows:
+        handoff = '-' if row['handoff_sigma'] is None else f"{row['handoff_sigma']:g}"
+        print(f"{row['sampler']:>14} {row['num_steps']:>6} {handoff:>8} {row['samples_per_sec']:>10.0f} "
+              f"{row['dynamics_error']:>11.5f} {row['marginal_w1']:>9.4f} {row['speedup']:>7.2f}x "
+              f"{'*' if row['pareto'] else ''}")
+
+    results_folder = pathlib.Path(args.results_folder)
+    results_folder.mkdir(parents=True, exist_ok=True)
+    with open(results_folder / 'sampler_pareto.csv', 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=list(rows[0].keys()))
+        writer.writeheader()
+        writer.writerows(rows)
+
+    selected = None
+    if args.max_error is not None:
+        # Only single-model settings can be written back, consumers do not load a student.
+        feasible = [r for r in rows if r['handoff_sigma'] is None and r['dynamics_error'] <= args.max_error
+                    and (args.max_marginal is None or r['marginal_w1'] <= args.max_marginal)]
+        selected = max(feasible, key=lambda r: r['samples_per_sec']) if feasible else None
+        print(f'Cheapest setting within the thresholds: {selected}')
+    with open(results_folder / 'sampler_benchmark.json', 'w') as f:
+        json.dump({'model': args.model, 'conds': args.conds, 'rows': rows, 'selected': selected}, f, indent=2)
+
+    if args.write_back:
+        assert selected is not None, 'Nothing to write back, set --max_error to a reachable threshold'
+        save_sampler_settings(args.model, {'num_steps': selected['num_steps'], 'sampler': selected['sampler'],
+                                           'dynamics_error': selected['dynamics_error'],
+                                           'samples_per_sec': selected['samples_per_sec']})
+        print(f'Wrote {sampler_settings_path(args.model)}.')
@@ -0,0 +1,169 @@
+# Closed-form dm_control cartpole swingup step and reward on NumPy arrays or torch tensors.
+# Mirrors suite/cartpole.xml: RK4 with a 0.01s timestep, a 1kg cart on a slider with damping 5e-4, and a 0.1kg capsule
+# pole of length 1 hinged at the cart with damping 2e-6, driven by a motor with gear 10 and control range [-1, 1].
+# The pole inertia follows MuJoCo's capsule formula, so it changes with the capsule size the models are conditioned
+# on. The slider limits at +-1.8 are not modelled.
+# Usage: python -m synther.diffusion.cartpole_dynamics  (checks agreement with the MuJoCo simulation, as
+# tests/test_cartpole_dynamics.py does)
+import argparse
+import math
+import sys
+from typing import Tuple, Union
+
+import numpy as np
+import torch
+
+TIMESTEP = 0.01
+GRAVITY = 9.81
+CART_MASS = 1.
+POLE_MASS = .1
+POLE_HALF_LENGTH = .5
+DEFAULT_POLE_SIZE = .045
+SLIDER_DAMPING = 5e-4
+HINGE_DAMPING = 2e-6
+GEAR = 10.
+
+# Default gaussian sigmoid of dm_control's rewards.tolerance, value 0.1 at the margin.
+_GAUSSIAN_SCALE = math.sqrt(-2 * math.log(0.1))
+
+Array = Union[np.ndarray, torch.Tensor]
+
+
+def _xp(x):
+    return torch if isinstance(x, torch.Tensor) else np
+
+
+def _as_pole_size(pole_size, like: Array):
+    if pole_size is None:
+        return DEFAULT_POLE_SIZE
+    if np.isscalar(pole_size):
+        return float(pole_size)
+    if isinstance(like, torch.Tensor):
+        return torch.as_tensor(pole_size, dtype=like.dtype, device=like.device).reshape(like.shape[0])
+    return np.asarray(pole_size, dtype=like.dtype).reshape(like.shape[0])
+
+
+# Moment of inertia of the pole about its center of mass, perpendicular to the pole. MuJoCo splits the mass between
+# the cylinder and the two hemispherical caps by volume.
+def pole_inertia(pole_size):
+    height = 2 * POLE_HALF_LENGTH
+    sphere_mass = POLE_MASS * 4 * pole_size / (4 * pole_size + 3 * height)
+    cylinder_mass = POLE_MASS - sphere_mass
+    return (cylinder_mass * (3 * pole_size ** 2 + height ** 2) / 12 + 2 * sphere_mass * pole_size ** 2 / 5
+            + sphere_mass * height * (3 * pole_size + 2 * height) / 8)
+
+
+def _accelerations(xp, qpos, qvel, force, inertia):
+    sin, cos = xp.sin(qpos[:, 1]), xp.cos(qpos[:, 1])
+    ml = POLE_MASS * POLE_HALF_LENGTH
+    # Mass matrix [[a, b], [b, d]] of (cart position, pole angle).
+    a = CART_MASS + POLE_MASS
+    b = ml * cos
+    d = ml * POLE_HALF_LENGTH + inertia
+    f_cart = force - SLIDER_DAMPING * qvel[:, 0] + ml * sin * qvel[:, 1] ** 2
+    f_pole = ml * GRAVITY * sin - HINGE_DAMPING * qvel[:, 1]
+    det = a * d - b * b
+    return xp.stack([(d * f_cart - b * f_pole) / det, (a * f_pole - b * f_cart) / det], -1)
+
+
+# One environment step (a single RK4 physics step) of [N, 2] positions and velocities under [N, 1] actions.
+def step(qpos: Array, qvel: Array, actions: Array, pole_size=None) -> Tuple[Array, Array]:
+    xp = _xp(qpos)
+    inertia = pole_inertia(_as_pole_size(pole_size, qpos))
+    force = GEAR * xp.clip(actions[:, 0], -1, 1)
+    h = TIMESTEP
+    k1_q, k1_v = qvel, _accelerations(xp, qpos, qvel, force, inertia)
+    k2_q = qvel + h / 2 * k1_v
+    k2_v = _accelerations(xp, qpos + h / 2 * k1_q, k2_q, force, inertia)
+    k3_q = qvel + h / 2 * k2_v
+    k3_v = _accelerations(xp, qpos + h / 2 * k2_q, k3_q, force, inertia)
+    k4_q = qvel + h * k3_v
+    k4_v = _accelerations(xp, qpos + h * k3_q, k4_q, force, inertia)
+    next_qpos = qpos + h / 6 * (k1_q + 2 * k2_q + 2 * k3_q + k4_q)
+    next_qvel = qvel + h / 6 * (k1_v + 2 * k2_v + 2 * k3_v + k4_v)
+    return next_qpos, next_qvel
+
+
+# Smooth swingup reward of the state reached after the step. The control term uses the unclipped action, as MuJoCo
+# only clamps the control when applying it.
+def reward(qpos: Array, qvel: Array, actions: Array) -> Array:
+    xp = _xp(qpos)
+    upright = (xp.cos(qpos[:, 1]) + 1) / 2
+    centered = (1 + xp.exp(-0.5 * (qpos[:, 0] / 2 * _GAUSSIAN_SCALE) ** 2)) / 2
+    small_control = (4 + xp.clip(1 - actions[:, 0] ** 2, 0, None)) / 5
+    small_velocity = (1 + xp.exp(-0.5 * (qvel[:, 1] / 5 * _GAUSSIAN_SCALE) ** 2)) / 2
+    return upright * small_control * small_velocity * centered
+
+
+# Observations are [cart position, cos, sin, cart velocity, pole angular velocity].
+def state_from_observations(observations: Array) -> Tuple[Array, Array]:
+    xp = _xp(observations)
+    qpos = xp.stack([observations[:, 0], xp.arctan2(observations[:, 2], observations[:, 1])], -1)
+    return qpos, observations[:, 3:5]
+
+
+def observations_from_state(qpos: Array, qvel: Array) -> Array:
+    xp = _xp(qpos)
+    return xp.stack([qpos[:, 0], xp.cos(qpos[:, 1]), xp.sin(qpos[:, 1]), qvel[:, 0], qvel[:, 1]], -1)
+
+
+def transition(observations: Array, actions: Array, pole_size=None) -> Tuple[Array, Array]:
+    qpos, qvel = state_from_observations(observations)
+    actions = actions.reshape(actions.shape[0], -1)
+    next_qpos, next_qvel = step(qpos, qvel, actions, pole_size)
+    return observations_from_state(next_qpos, next_qvel), reward(next_qpos, next_qvel, actions)
+
+
+# Absolute errors of generated next observations [N, obs_dim] and rewards [N, 1], as in verification.py.
+def dynamics_error(
+        observations: Array,
+        actions: Array,
+        rewards: Array,
+        next_observations: Array,
+        pole_size: Union[None, float, Array] = None,  # one value, one per row, or None for the default pole
+) -> Tuple[Array, Array]:
+    if not isinstance(observations, torch.Tensor):
+        observations, actions = np.asarray(observations, dtype=np.float64), np.asarray(actions, dtype=np.float64)
+        rewards, next_observations = np.asarray(rewards), np.asarray(next_observations)
+    true_next_observations, true_rewards = transition(observations, actions, pole_size)
+    observation_err = abs(next_observations.reshape(true_next_observations.shape) - true_next_observations)
+    reward_err = abs(rewards.reshape(true_rewards.shape) - true_rewards)[:, None]
+    return observation_err, reward_err
+
+
+# Compare against the MuJoCo simulation from random states, including actions outside the control range.
+def check_against_suite(
+        num_states: int = 2000,
+        pole_sizes=(None, 0.2, 0.6),
+        atol: float = 1e-4,
+        seed: int = 0,
+) -> bool:
+    from synther.diffusion.verification import make_cartpole_env, pole_size_of, suite_step
+
+    rng = np.random.default_rng(seed)
+    qpos = np.stack([rng.uniform(-1.5, 1.5, num_states), rng.uniform(-np.pi, np.pi, num_states)], -1)
+    qvel = np.stack([rng.uniform(-3, 3, num_states), rng.uniform(-10, 10, num_states)], -1)
+    actions = rng.uniform(-1.2, 1.2, (num_states, 1))
+    ok = True
+    for pole_size in pole_sizes:
+        env = make_cartpole_env(pole_size)
+        pole_size = pole_size_of(env)  # the installed XML may have been edited by set_pole_length
+        mujoco_next_observations, mujoco_rewards = suite_step(env, qpos, qvel, actions)
+        observation_err, reward_err = dynamics_error(
+            observations_from_state(qpos, qvel), actions, mujoco_rewards, mujoco_next_observations, pole_size)
+        max_observation_err, max_reward_err = observation_err.max(axis=0), reward_err.max()
+        passed = max_observation_err.max() <= atol and max_reward_err <= atol
+        ok &= passed
+        print(f'{"ok  " if passed else "FAIL"} pole size {pole_size}: '
+              f'max observation error {np.array2string(max_observation_err, precision=2)}, '
+              f'max reward error {max_reward_err:.2e}')
+    return ok
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--num_states', type=int, default=2000)
+    parser.add_argument('--pole_sizes', type=float, nargs='*', default=[None, 0.2, 0.6])
+    parser.add_argument('--atol', type=float, default=1e-4)
+    args = parser.parse_args()
+    sys.exit(0 if check_against_suite(args.num_states, args.pole_sizes, args.atol) else 1)
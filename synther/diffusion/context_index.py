@@ -0,0 +1,76 @@
+# Index of dataset rows by their pole-length context.
+# Rows are grouped by context in sorted order with one offset per distinct value, so a set of values or an interval of
+# contexts resolves to a few contiguous runs with two binary searches each. When the rows themselves are stored in
+# context order (load_dataset_columns does this), a selection that is one run is a slice, and indexing the columns
+# with it returns views instead of copies. Otherwise selections are index arrays in the original row order.
+from typing import Dict, Iterator, Optional, Sequence, Tuple, Union
+
+import numpy as np
+
+Selection = Union[slice, np.ndarray]
+
+
+# Stable permutation that puts the rows in context order. Episodes have a single context, so they stay contiguous.
+def context_order(contexts: np.ndarray) -> np.ndarray:
+    contexts = np.asarray(contexts).reshape(len(contexts), -1)[:, 0]
+    return np.argsort(contexts, kind='stable')
+
+
+class ContextIndex:
+    def __init__(self, contexts: np.ndarray):
+        contexts = np.asarray(contexts).reshape(len(contexts), -1)[:, 0]
+        self.num_rows = contexts.shape[0]
+        self.is_sorted = bool(np.all(contexts[1:] >= contexts[:-1]))
+        # Position in context order -> row, None when they coincide.
+        self.order = None if self.is_sorted else np.argsort(contexts, kind='stable')
+        sorted_contexts = contexts if self.is_sorted else contexts[self.order]
+        starts = np.flatnonzero(np.r_[True, sorted_contexts[1:] != sorted_contexts[:-1]]) if self.num_rows else \
+            np.zeros(0, dtype=np.int64)
+        self.values = sorted_contexts[starts]
+        self.offsets = np.r_[starts, self.num_rows]
+
+    @property
+    def counts(self) -> np.ndarray:
+        return np.diff(self.offsets)
+
+    # Positions in context order of the rows with low < context < high, the open intervals of SEGMENTS.
+    def _interval(self, low: float, high: float) -> Tuple[int, int]:
+        first = np.searchsorted(self.values, low, side='right')
+        last = np.searchsorted(self.values, high, side='left')
+        return int(self.offsets[first]), int(self.offsets[max(first, last)])
+
+    def _value(self, value: float) -> Tuple[int, int]:
+        i = np.searchsorted(self.values, value)
+        if i == len(self.values) or self.values[i] != value:
+            return 0, 0
+        return int(self.offsets[i]), int(self.offsets[i + 1])
+
+    def select(
+            self,
+            ranges: Optional[Sequence[Tuple[float, float]]] = None,  # open (low, high) intervals
+            values: Optional[Sequence[float]] = None,  # exact context values
+    ) -> Selection:
+        spans = [self._interval(low, high) for low, high in ranges or ()]
+        spans += [self._value(value) for value in values or ()]
+        spans = sorted(span for span in spans if span[1] > span[0])
+        merged = []
+        for start, stop in spans:
+            if merged and start <= merged[-1][1]:
+                merged[-1][1] = max(merged[-1][1], stop)
+            else:
+                merged.append([start, stop])
+        if self.is_sorted and len(merged) <= 1:
+            return slice(*merged[0]) if merged else slice(0, 0)
+        positions = np.concatenate([np.arange(start, stop) for start, stop in merged]) if merged else \
+            np.zeros(0, dtype=np.int64)
+        return positions if self.is_sorted else np.sort(self.order[positions])
+
+    # Rows of every distinct context, in context order. The stable sort keeps each group in row order.
+    def groups(self) -> Iterator[Tuple[float, Selection]]:
+        for i, value in enumerate(self.values):
+            start, stop = int(self.offsets[i]), int(self.offsets[i + 1])
+            yield float(value), slice(start, stop) if self.is_sorted else self.order[start:stop]
+
+    @staticmethod
+    def take(columns: Dict[str, np.ndarray], selection: Selection) -> Dict[str, np.ndarray]:
+        return {key: values[selection] for key, values in columns.items()}
@@ -0,0 +1,110 @@
+# Coreset subsampling of transition datasets.
+
+from typing import Optional, Tuple
+
+import numpy as np
+import torch
+
+
+# Min squared distance of every point to a single center, computed in row chunks to bound temporary memory.
+def _center_distances(points: torch.Tensor, center: torch.Tensor, chunk_size: int) -> torch.Tensor:
+    out = torch.empty(points.shape[0], device=points.device)
+    for start in range(0, points.shape[0], chunk_size):
+        chunk = points[start:start + chunk_size]
+        out[start:start + chunk_size] = ((chunk - center) ** 2).sum(dim=1)
+    return out
+
+
+# Index of the closest center of every point, in row blocks so the block-by-centers distance matrix stays bounded.
+def _nearest_center(points: torch.Tensor, centers: torch.Tensor, max_elements: int = 1 << 26) -> torch.Tensor:
+    rows = max(1, max_elements // centers.shape[0])
+    out = torch.empty(points.shape[0], dtype=torch.long, device=points.device)
+    for start in range(0, points.shape[0], rows):
+        out[start:start + rows] = torch.cdist(points[start:start + rows], centers).argmin(dim=1)
+    return out
+
+
+# Greedy k-center selection. Every point is assigned to its closest center and the weight of a center is the number
+# of points it covers, so the weighted coreset keeps the mass of the original dataset.
+# The greedy loop is sequential, one distance update per center, so it costs O(k * n). With max_candidates the
+# centers are chosen among a random subset of that many rows (stochastic greedy) and all n points are assigned to
+# them afterwards in one batched pass, which bounds the sequential work at O(k * max_candidates).
+@torch.no_grad()
+def k_center_greedy(
+        points: torch.Tensor,
+        k: int,
+        chunk_size: int = 1 << 18,
+        generator: Optional[torch.Generator] = None,
+        max_candidates: Optional[int] = None,
+) -> Tuple[np.ndarray, np.ndarray]:
+    n = points.shape[0]
+    k = min(k, n)
+    candidates = None
+    if max_candidates is not None and n > max_candidates:
+        candidates = torch.randperm(n, generator=generator)[:max_candidates].to(points.device)
+        all_points, points = points, points[candidates]
+        k = min(k, max_candidates)
+    m = points.shape[0]
+    centers = torch.empty(k, dtype=torch.long, device=points.device)
+    centers[0] = torch.randint(m, (1,), generator=generator).item()
+    min_dist = _center_distances(points, points[centers[0]], chunk_size)
+    assignment = torch.zeros(m, dtype=torch.long, device=points.device)
+
+    for i in range(1, k):
+        centers[i] = torch.argmax(min_dist)
+        dist = _center_distances(points, points[centers[i]], chunk_size)
+        closer = dist < min_dist
+        assignment[closer] = i
+        min_dist = torch.minimum(min_dist, dist)
+
+    if candidates is not None:
+        centers = candidates[centers]
+        assignment = _nearest_center(all_points, all_points[centers])
+    weights = torch.bincount(assignment, minlength=k).float()
+    return centers.cpu().numpy(), weights.cpu().numpy()
+
+
+# Build a weighted coreset over normalized transitions, selected separately for every pole length so that the
+# state-space coverage of each context is preserved.
+def build_coreset(
+        inputs: np.ndarray,
+        contexts: Optional[np.ndarray] = None,
+        fraction: float = 0.1,
+        device: str = 'cpu',
+        chunk_size: int = 1 << 18,
+        seed: int = 0,
+        max_centers: Optional[int] = None,  # per context, bounds the sequential greedy passes
+        max_candidates: Optional[int] = 1 << 17,  # rows per context the centers are chosen from
+) -> Tuple[np.ndarray, np.ndarray]:
+    assert 0 < fraction <= 1, 'fraction must be in (0, 1]'
+    points = torch.as_tensor(np.asarray(inputs), dtype=torch.float32, device=device)
+    points = (points - points.mean(dim=0)) / (points.std(dim=0) + 1e-6)
+    generator = torch.Generator().manual_seed(seed)
+
+    if contexts is None:
+        groups = np.zeros(inputs.shape[0], dtype=np.int64)
+    else:
+        _, groups = np.unique(np.asarray(contexts).reshape(inputs.shape[0], -1), axis=0, return_inverse=True)
+        groups = groups.reshape(-1)
+
+    indices, weights = [], []
+    for group in np.unique(groups):
+        members = np.flatnonzero(groups == group)
+        k = max(1, int(round(fraction * members.shape[0])))
+        # Centers are chosen among the candidates, so there can be no more of them than candidates.
+        cap = min(c for c in (max_centers, max_candidates, k) if c is not None)
+        if cap < k:
+            print(f'Coreset: clipping {k} centers ({fraction:.3g} of {members.shape[0]} rows) to {cap} '
+                  f'for context group {group}.')
+            k = cap
+        centers, center_weights = k_center_greedy(
+            points[torch.from_numpy(members).to(device)], k, chunk_size=chunk_size, generator=generator,
+            max_candidates=max_candidates)
+        indices.append(members[centers])
+        weights.append(center_weights)
+
+    indices = np.concatenate(indices)
+    weights = np.concatenate(weights).astype(np.float32)
+    print(f'Coreset: kept {indices.shape[0]} of {inputs.shape[0]} transitions '
+          f'across {len(np.unique(groups))} contexts.')
+    return indices, weights
@@ -1,9 +1,14 @@
+import os
 import random
-import minari
 import numpy as np
+import torch
+from concurrent.futures import ThreadPoolExecutor
+from numpy.lib.stride_tricks import sliding_window_view
 from tqdm.auto import trange
-from torch.utils.data import IterableDataset
-from typing import Any, DefaultDict, Dict, List, Tuple
+from torch.utils.data import IterableDataset, get_worker_info
+from typing import Any, DefaultDict, Dict, Iterator, List, Optional, Sequence, Tuple
+
+from synther.diffusion.utils import DATASET_DIR, segment_mask
 
 def pad_along_axis(
     arr: np.ndarray, pad_to: int, axis: int = 0, fill_value: float = 0.0
@@ -27,6 +32,7 @@ def pad_along_axis(
 
 def load_trajectories(dataset_name: str) -> Tuple[List[DefaultDict[str, np.ndarray]], Dict[str, Any]]:
     
+    import minari
     dataset = minari.load_dataset(dataset_name, download=False)
     # dataset.set_seed(seed=TrainConfig().train_seed)
     states, actions, rewards, contexts, episode_lens = [], [], [], [], []
@@ -99,8 +105,12 @@ def load_trajectories(dataset_name: str) -> Tuple[List[DefaultDict[str, np.ndarr
     
     return states, actions, rewards, contexts, infos
 
+# Windows of seq_len (state, action, reward) steps from Minari episodes, as [input_dim, 3 * seq_len] sequences.
+# With batch_size set, every iteration yields a whole batch [batch_size, input_dim, 3 * seq_len] and its masks,
+# drawn and gathered with vectorized NumPy operations (use DataLoader(..., batch_size=None)).
 class SequenceDataset(IterableDataset):
-    def __init__(self, dataset_name: str, seq_len: int = 5, reward_scale: float = 1.0):
+    def __init__(self, dataset_name: str, seq_len: int = 5, reward_scale: float = 1.0,
+                 batch_size: Optional[int] = None):
         self.states, self.actions, self.rewards, self.contexts, self.infos = load_trajectories(dataset_name)
         
         # self.states_scale = self.infos["states_scale"]
@@ -161,6 +171,12 @@ class SequenceDataset(IterableDataset):
         
         self.total_episodes = self.infos["total_episodes"]
         self.episode_len = self.infos["episode_len"]
+        self.batch_size = batch_size
+        # Batch sampling: episodes are drawn by inverse CDF with the same length-proportional probabilities as
+        # sample_prob, then a start uniformly among the episode's valid starts.
+        self.episode_cdf = np.cumsum(self.sample_prob)
+        self.num_starts = self.episode_len - self.seq_len + 1
+        self._windows = None
 
         
     def recover_data(self, sequence):
@@ -224,8 +240,199 @@ class SequenceDataset(IterableDataset):
         return sequence , mask
         # return states, actions, rewards, contexts, time_steps, mask
 
+    # Strided [episodes, starts, input_dim, seq_len] views of the states, actions and rewards, built once. Arrays
+    # shorter than the longest episode are zero padded like the per-sample path pads its windows.
+    def _window_views(self):
+        if self._windows is None:
+            length = int(self.episode_len.max())
+            self._windows = [sliding_window_view(pad_along_axis(array, pad_to=length, axis=1), self.seq_len, axis=1)
+                             for array in (self.states, self.actions, self.rewards)]
+        return self._windows
+
+    # A batch of sequences [batch_size, input_dim, 3 * seq_len] laid out as in __prepare_sample, and masks
+    # [batch_size, seq_len].
+    def sample_batch(self, batch_size: int) -> Tuple[np.ndarray, np.ndarray]:
+        episodes_idx = np.minimum(np.searchsorted(self.episode_cdf, np.random.random(batch_size), side='right'),
+                                  self.total_episodes - 1)
+        start_idx = (np.random.random(batch_size) * self.num_starts[episodes_idx]).astype(np.int64)
+        states, actions, rewards = (view[episodes_idx, start_idx] for view in self._window_views())
+        # Steps interleave as s_0, a_0, r_0, s_1, ... along the last axis.
+        sequences = np.stack([states, actions, rewards * self.reward_scale], axis=-1)
+        sequences = sequences.reshape(batch_size, self.input_dim, 3 * self.seq_len)
+        masks = (start_idx[:, None] + np.arange(self.seq_len)) < self.states.shape[1]
+        return sequences, masks.astype(np.float64)
+
     def __iter__(self):
         while True:
+            if self.batch_size is not None:
+                yield self.sample_batch(self.batch_size)
+                continue
             episodes_idx = np.random.choice(self.infos["total_episodes"], p=self.sample_prob)
             start_idx = random.randint(0, self.infos["episode_len"][episodes_idx] - self.seq_len)
-            yield self.__prepare_sample(episodes_idx, start_idx)
\ No newline at end of file
+            yield self.__prepare_sample(episodes_idx, start_idx)
+
+
+# Streams (s, a, r, s') rows and their pole-length context directly from Minari storage (episode chunks), or from an
+# .npz dataset in DATASET_DIR (the source make_inputs reads) in blocks of block_rows rows. The members of an
+# uncompressed .npz are memory-mapped at their offsets in the archive, so only the blocks being read are paged in and
+# worker processes share those pages. Compressed archives cannot be mapped and are loaded whole.
+# Chunks are read by a thread pool while earlier chunks are consumed, rows pass through a shuffle buffer, so training
+# can start immediately and datasets do not need to fit in memory. With batch_size set (the Trainer sets it), whole
+# batches are yielded instead of single rows, for DataLoader(batch_size=None).
+class TransitionStream(IterableDataset):
+    def __init__(
+            self,
+            dataset_name: str,
+            episode_indices: Optional[Sequence[int]] = None,  # Minari episodes to stream
+            block_indices: Optional[Sequence[int]] = None,  # .npz row blocks to stream
+            segment: Optional[str] = None,
+            modelled_terminals: bool = False,
+            chunk_episodes: int = 16,  # episodes, or .npz blocks, read per storage request
+            num_threads: int = 4,
+            shuffle_buffer: int = 200000,  # rows held in the shuffle buffer
+            seed: int = 0,
+            batch_size: Optional[int] = None,
+            block_rows: int = 1000,  # rows per read unit of .npz datasets
+    ):
+        self.dataset_name = dataset_name
+        self.episode_indices = episode_indices
+        self.block_indices = block_indices
+        self.segment = segment
+        self.modelled_terminals = modelled_terminals
+        self.chunk_episodes = chunk_episodes
+        self.num_threads = num_threads
+        self.shuffle_buffer = shuffle_buffer
+        self.seed = seed
+        self.batch_size = batch_size
+        self.block_rows = block_rows
+        self.epoch = 0
+
+    def _load(self):
+        return self._load_npz() if self.dataset_name.endswith('.npz') else self._load_minari()
+
+    def _load_npz(self):
+        from synther.corl.shared.filtering import load_columns
+
+        columns = load_columns(os.path.join(DATASET_DIR, self.dataset_name))
+        num_blocks = -(-columns['rewards'].shape[0] // self.block_rows)
+        return columns, np.arange(num_blocks) if self.block_indices is None else np.asarray(self.block_indices)
+
+    def _load_minari(self):
+        import minari
+        dataset = minari.load_dataset(self.dataset_name, download=False)
+        if self.episode_indices is not None:
+            indices = np.asarray(self.episode_indices)
+        else:
+            # Same episode selection as make_inputs(minari=True).
+            indices = np.asarray(dataset.episode_indices)
+            indices = indices[np.arange(indices.shape[0]) % 500 >= 250]
+        return dataset, indices
+
+    def _column_rows(self, columns, blocks) -> Tuple[np.ndarray, np.ndarray]:
+        num_rows = columns['rewards'].shape[0]
+        rows = np.concatenate([np.arange(b * self.block_rows, min((b + 1) * self.block_rows, num_rows))
+                               for b in np.sort(blocks)])
+        inputs = [
+            columns['observations'][rows],
+            columns['actions'][rows],
+            columns['rewards'][rows][:, None],
+            columns['next_observations'][rows],
+        ]
+        if self.modelled_terminals:
+            inputs.append(columns['terminals'][rows][:, None])
+        inputs = np.concatenate(inputs, axis=1).astype(np.float32)
+        contexts = np.asarray(columns['contexts'][rows], dtype=np.float32).reshape(-1, 1)
+        return inputs, contexts
+
+    def _rows(self, dataset, indices) -> Tuple[np.ndarray, np.ndarray]:
+        if isinstance(dataset, dict):
+            inputs, contexts = self._column_rows(dataset, indices)
+            if self.segment is not None:
+                mask = segment_mask(contexts, self.segment)
+                inputs, contexts = inputs[mask], contexts[mask]
+            return inputs, contexts
+        inputs, contexts = [], []
+        for episode in dataset.iterate_episodes(episode_indices=indices):
+            columns = [
+                episode.observations[:-1],
+                episode.actions,
+                episode.rewards[:, None],
+                episode.observations[1:],
+            ]
+            if self.modelled_terminals:
+                columns.append(episode.terminations[:, None])
+            inputs.append(np.concatenate(columns, axis=1).astype(np.float32))
+            contexts.append(np.asarray(episode.infos['length'][:-1], dtype=np.float32).reshape(-1, 1))
+        inputs = np.concatenate(inputs)
+        contexts = np.concatenate(contexts)
+        if self.segment is not None:
+            mask = segment_mask(contexts, self.segment)
+            inputs, contexts = inputs[mask], contexts[mask]
+        return inputs, contexts
+
+    def _chunks(self, dataset, indices) -> Iterator[Tuple[np.ndarray, np.ndarray]]:
+        chunks = [indices[i:i + self.chunk_episodes] for i in range(0, len(indices), self.chunk_episodes)]
+        with ThreadPoolExecutor(max_workers=self.num_threads) as pool:
+            # Keep a bounded number of reads in flight.
+            pending = [pool.submit(self._rows, dataset, chunk) for chunk in chunks[:self.num_threads]]
+            for next_chunk in chunks[self.num_threads:] + [None] * len(pending):
+                rows = pending.pop(0).result()
+                if next_chunk is not None:
+                    pending.append(pool.submit(self._rows, dataset, next_chunk))
+                yield rows
+
+    # A bounded number of rows for fitting the normalizer without materializing the whole dataset.
+    def sample_inputs(self, num_rows: int = 500000) -> Tuple[np.ndarray, np.ndarray]:
+        dataset, indices = self._load()
+        rng = np.random.default_rng(self.seed)
+        inputs, contexts, total = [], [], 0
+        for x, c in self._chunks(dataset, rng.permutation(indices)):
+            inputs.append(x)
+            contexts.append(c)
+            total += x.shape[0]
+            if total >= num_rows:
+                break
+        return np.concatenate(inputs)[:num_rows], np.concatenate(contexts)[:num_rows]
+
+    def __iter__(self):
+        dataset, indices = self._load()
+        worker = get_worker_info()
+        if worker is not None:
+            # Workers receive a copy of the dataset, torch hands every worker a fresh seed per epoch.
+            worker_id, num_workers = worker.id, worker.num_workers
+            order_rng = np.random.default_rng((self.seed, worker.seed - worker_id))
+            rng = np.random.default_rng((self.seed, worker.seed))
+        else:
+            worker_id, num_workers = 0, 1
+            order_rng = rng = np.random.default_rng((self.seed, self.epoch))
+            self.epoch += 1
+        # All workers share the episode order of the epoch and take disjoint shards of it.
+        indices = order_rng.permutation(indices)[worker_id::num_workers]
+
+        buffer_inputs, buffer_contexts, size = [], [], 0
+        for x, c in self._chunks(dataset, indices):
+            buffer_inputs.append(x)
+            buffer_contexts.append(c)
+            size += x.shape[0]
+            if size < self.shuffle_buffer:
+                continue
+            # Emit a random half of the buffer and keep the rest to mix with later chunks.
+            x, c = np.concatenate(buffer_inputs), np.concatenate(buffer_contexts)
+            perm = rng.permutation(size)
+            keep, emit = perm[:self.shuffle_buffer // 2], perm[self.shuffle_buffer // 2:]
+            yield from self._emit(x, c, emit)
+            buffer_inputs, buffer_contexts, size = [x[keep]], [c[keep]], keep.shape[0]
+
+        if size > 0:
+            x, c = np.concatenate(buffer_inputs), np.concatenate(buffer_contexts)
+            yield from self._emit(x, c, rng.permutation(size))
+
+    # Rows of x and c in the given order, one at a time or batch_size at a time with a single gather per batch.
+    def _emit(self, x: np.ndarray, c: np.ndarray, order: np.ndarray):
+        if self.batch_size is None:
+            for i in order:
+                yield torch.from_numpy(x[i]), torch.from_numpy(c[i])
+            return
+        for start in range(0, order.shape[0], self.batch_size):
+            batch = order[start:start + self.batch_size]
+            yield torch.from_numpy(x[batch]), torch.from_numpy(c[batch])
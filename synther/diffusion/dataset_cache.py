@@ -0,0 +1,94 @@
+# On-disk columnar cache of the transition columns derived by make_inputs.
+# Each entry is a directory of .npy columns, keyed by the dataset name and the options that
+# change the derived rows. Entries are memory-mapped copy-on-write, so loading copies nothing and callers may still
+# modify the arrays in memory. An entry records the size and mtime of the source files and is rebuilt when they change.
+# Builds hold a per-entry lock, so concurrent processes build an entry once and never remove each other's files.
+# Set SYNTHER_DATASET_CACHE to choose the cache directory, or to 'off' to disable caching.
+import hashlib
+import json
+import os
+import pathlib
+import shutil
+from typing import Callable, Dict, List, Optional, Sequence
+
+import numpy as np
+
+from synther.corl.shared.sample_cache import file_lock
+
+CACHE_ENV = 'SYNTHER_DATASET_CACHE'
+DEFAULT_CACHE_DIR = '~/.cache/synther/datasets'
+# Bump when the conversion in make_inputs changes, so existing entries are rebuilt.
+CACHE_VERSION = 2  # 2: rows sorted by context
+
+
+def default_cache() -> Optional['DatasetCache']:
+    root = os.environ.get(CACHE_ENV, DEFAULT_CACHE_DIR)
+    if root.lower() in ('off', '0', 'false', ''):
+        return None
+    return DatasetCache(root)
+
+
+# Size and modification time of every file under the given paths.
+def source_fingerprint(paths: Sequence[str]) -> List:
+    fingerprint = []
+    for path in paths:
+        path = pathlib.Path(path).expanduser()
+        files = sorted(p for p in path.rglob('*') if p.is_file()) if path.is_dir() else [path]
+        for f in files:
+            if f.exists():
+                stat = f.stat()
+                fingerprint.append([str(f.resolve()), stat.st_size, stat.st_mtime_ns])
+    return fingerprint
+
+
+class DatasetCache:
+    def __init__(self, root: str):
+        self.root = pathlib.Path(root).expanduser()
+
+    def _entry(self, name: str, options: Dict) -> pathlib.Path:
+        description = json.dumps({'name': name, 'options': options, 'version': CACHE_VERSION}, sort_keys=True)
+        safe_name = ''.join(c if c.isalnum() or c in '-_.' else '_' for c in name)
+        return self.root / f'{safe_name}-{hashlib.sha1(description.encode()).hexdigest()[:16]}'
+
+    def _valid(self, entry: pathlib.Path, fingerprint: List) -> bool:
+        meta_path = entry / 'meta.json'
+        if not meta_path.exists():
+            return False
+        with open(meta_path) as f:
+            return json.load(f)['fingerprint'] == fingerprint
+
+    def get_or_create(
+            self,
+            name: str,
+            options: Dict,
+            sources: Sequence[str],  # files or directories the columns are derived from
+            build: Callable[[], Dict[str, np.ndarray]],
+    ) -> Dict[str, np.ndarray]:
+        entry = self._entry(name, options)
+        fingerprint = source_fingerprint(sources)
+        if self._valid(entry, fingerprint):
+            return self.load(entry)
+
+        with file_lock(self.root / 'locks' / f'{entry.name}.lock'):
+            # Another process may have built the entry while we waited for the lock.
+            if not self._valid(entry, fingerprint):
+                print(f'Building dataset cache entry {entry}.')
+                columns = build()
+                tmp = entry.parent / f'{entry.name}.{os.getpid()}.tmp'
+                tmp.mkdir(parents=True, exist_ok=True)
+                for key, values in columns.items():
+                    np.save(tmp / f'{key}.npy', np.ascontiguousarray(values))
+                # meta.json is written last, an entry without it is incomplete.
+                with open(tmp / 'meta.json', 'w') as f:
+                    json.dump({'name': name, 'options': options, 'fingerprint': fingerprint,
+                               'columns': list(columns)}, f)
+                if entry.exists():
+                    shutil.rmtree(entry)  # stale, readers keep their mapped pages
+                os.rename(tmp, entry)
+            return self.load(entry)
+
+    @staticmethod
+    def load(entry: pathlib.Path) -> Dict[str, np.ndarray]:
+        with open(entry / 'meta.json') as f:
+            keys = json.load(f)['columns']
+        return {key: np.load(entry / f'{key}.npy', mmap_mode='c') for key in keys}
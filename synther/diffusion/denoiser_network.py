@@ -114,6 +114,13 @@ class ResidualMLPDenoiser(nn.Module):
             cond_dim: Optional[int] = None,
     ):
         super().__init__()
+        # Constructor arguments, stored so the network can be rebuilt without gin (see artifact.py).
+        self.config = dict(
+            d_in=d_in, dim_t=dim_t, mlp_width=mlp_width, num_layers=num_layers,
+            learned_sinusoidal_cond=learned_sinusoidal_cond, random_fourier_features=random_fourier_features,
+            learned_sinusoidal_dim=learned_sinusoidal_dim, activation=activation, layer_norm=layer_norm,
+            cond_dim=cond_dim,
+        )
         self.residual_mlp = ResidualMLP(
             input_dim=dim_t,
             width=mlp_width,
@@ -5,28 +5,30 @@ Code was adapted from https://github.com/lucidrains/denoising-diffusion-pytorch
 import math
 import pathlib
 from multiprocessing import cpu_count
-from typing import Optional, Sequence, Tuple, Union
+from typing import TYPE_CHECKING, Iterator, Optional, Sequence, Tuple, Union
 
 import gin
 import numpy as np
 import torch
 import torch.nn.functional as F
-import wandb
-from accelerate import Accelerator
 from einops import reduce
-from ema_pytorch import EMA
-from redq.algos.core import ReplayBuffer
 from torch import nn
-from torch.utils.data import DataLoader
-from torchdiffeq import odeint
-from tqdm import tqdm, trange
+from torch.utils.data import DataLoader, IterableDataset, WeightedRandomSampler
+from tqdm import tqdm
 
+from synther.diffusion.autotune import autotune_batch_size
 from synther.diffusion.norm import BaseNormalizer
-from synther.online.utils import make_inputs_from_replay_buffer
 from synther.diffusion.norm import MinMaxNormalizer
+from synther.diffusion.profiling import PhaseTimer
+from synther.diffusion.sigma_sampler import AdaptiveSigmaSampler
+from synther.diffusion.verification import calculate_diffusion_loss
 from synther.early_stopper import EarlyStopper
-import gymnasium as gym
-from dmc2gymnasium import DMCGym
+
+# wandb, accelerate, ema_pytorch, torchdiffeq, redq and the environment packages take seconds to import, so they are
+# imported where they are used and this module stays cheap to load in workers and small scripts.
+if TYPE_CHECKING:
+    import gymnasium as gym
+    from redq.algos.core import ReplayBuffer
 
 import os
 import glob
@@ -45,7 +47,7 @@ def get_latest_model_file(folder_path, pattern="model-*.pt"):
 @gin.configurable
 def split_diffusion_samples(
         samples: Union[np.ndarray, torch.Tensor],
-        env: gym.Env,
+        env: 'gym.Env',
         modelled_terminals: bool = False,
         terminal_threshold: Optional[float] = None,
         num_transition: int = 1,
@@ -83,18 +85,46 @@ class SimpleDiffusionGenerator:
     def __init__(
             self,
             ema_model,
-            env: Optional[gym.Env] = None,
+            env: Optional['gym.Env'] = None,
             num_sample_steps: int = 128,
             sample_batch_size: int = 100000,
+            autotune: bool = False,  # pick the fastest sample batch size that fits in memory
+            start_sigma: Optional[float] = None,  # warm start level when sampling from a source dataset
+            source: Optional[Iterator] = None,  # yields batches of real rows, or (rows, contexts), to warm start from
+            student=None,  # narrow model for the high-noise steps (cascade sampling)
+            handoff_sigma: float = 1.0,
+            early_exit_tol: Optional[float] = None,  # per-sample early exit, see ElucidatedDiffusion.sample
     ):
         self.env = env
         self.diffusion = ema_model
         self.diffusion.eval()
+        self.student = student.eval() if student is not None else None
+        self.handoff_sigma = handoff_sigma
+        self.early_exit_tol = early_exit_tol
         # Clamp samples if normalizer is MinMaxNormalizer
         self.clamp_samples = isinstance(self.diffusion.normalizer, MinMaxNormalizer)
         self.num_sample_steps = num_sample_steps
+        if autotune:
+            sample_batch_size = autotune_batch_size(self.diffusion, mode='sample')
         self.sample_batch_size = sample_batch_size
+        self.start_sigma = start_sigma
+        self.source = source
         print(f'Sampling using: {self.num_sample_steps} steps, {self.sample_batch_size} batch size.')
+        if source is not None:
+            print(f'Warm starting from source transitions at sigma {start_sigma}.')
+
+    # Next num_rows real rows (and their contexts, if the source provides them) from the source iterator.
+    def _take_source(self, num_rows: int):
+        rows, contexts, count = [], [], 0
+        while count < num_rows:
+            batch = next(self.source)
+            batch_rows, batch_contexts = batch if isinstance(batch, (tuple, list)) else (batch, None)
+            rows.append(torch.as_tensor(batch_rows))
+            contexts.append(batch_contexts)
+            count += rows[-1].shape[0]
+        rows = torch.cat(rows)[:num_rows]
+        contexts = torch.cat([torch.as_tensor(c) for c in contexts])[:num_rows] if contexts[0] is not None else None
+        return rows, contexts
 
     def sample(
             self,
@@ -102,25 +132,42 @@ class SimpleDiffusionGenerator:
             cond: torch.Tensor = None,
             num_transition: int = 1,
     ) -> (np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray):
-        assert num_samples % self.sample_batch_size == 0, 'num_samples must be a multiple of sample_batch_size'
-        num_batches = num_samples // self.sample_batch_size // num_transition
+        # The last split is smaller if num_samples is not a multiple of the batch size.
+        num_rows = num_samples // num_transition
+        batch_sizes = [self.sample_batch_size] * (num_rows // self.sample_batch_size)
+        if num_rows % self.sample_batch_size:
+            batch_sizes.append(num_rows % self.sample_batch_size)
+        num_batches = len(batch_sizes)
         observations = []
         actions = []
         rewards = []
         next_observations = []
         terminals = []
-        for i in range(num_batches):
+        from dmc2gymnasium import DMCGym
+        env = DMCGym("cartpole", "swingup", task_kwargs={'random':1})
+        for i, batch_size in enumerate(batch_sizes):
             print(f'Generating split {i + 1} of {num_batches}')
+            init_inputs, batch_cond = None, cond
+            if self.source is not None:
+                # Warm-started rows keep their own context unless a condition is given.
+                init_inputs, source_cond = self._take_source(batch_size)
+                if batch_cond is None and getattr(self.diffusion.net, 'conditional', False):
+                    batch_cond = source_cond
             sampled_outputs = self.diffusion.sample(
-                batch_size=self.sample_batch_size,
+                batch_size=batch_size,
                 num_sample_steps=self.num_sample_steps,
                 clamp=self.clamp_samples,
-                cond=cond,
+                cond=batch_cond,
+                init_inputs=init_inputs,
+                start_sigma=self.start_sigma,
+                student=self.student,
+                handoff_sigma=self.handoff_sigma,
+                early_exit_tol=self.early_exit_tol,
             )
             sampled_outputs = sampled_outputs.cpu().numpy()
 
             # Split samples into (s, a, r, s') format
-            transitions = split_diffusion_samples(sampled_outputs, DMCGym("cartpole", "swingup", task_kwargs={'random':1}), num_transition=num_transition)
+            transitions = split_diffusion_samples(sampled_outputs, env, num_transition=num_transition)
             if len(transitions) == 4:
                 obs, act, rew, next_obs = transitions
                 terminal = np.zeros_like(next_obs[:, 0])
@@ -141,49 +188,6 @@ class SimpleDiffusionGenerator:
 
 # helpers
 
-def _flatten_obs(obs, dtype=np.float32):
-    obs_pieces = []
-    for v in obs.values():
-        flat = np.array([v]) if np.isscalar(v) else v.ravel()
-        obs_pieces.append(flat)
-    return np.concatenate(obs_pieces, axis=0).astype(dtype)
-
-def reset_to_state(env, state):
-    env._reset_next_step = False
-    env._step_count = 0
-    with env._physics.reset_context():
-        env._physics.named.data.qpos[:] = np.array([state[0], state[1]])
-        env._physics.named.data.qvel[:] = np.array([state[2], state[3]])
-    env._task.after_step(env._physics)
-    
-def calculate_diffusion_loss(diffusion_dataset, env, range = None):
-    if range is None:
-        range = diffusion_dataset["observations"].shape[0]
-    reward_loss = np.zeros((range, 1))
-    observation_loss = np.zeros((range, diffusion_dataset["observations"].shape[1]))
-
-    # for transition in trange(diffusion_dataset["observations"].shape[0]):
-    for transition in trange(range):
-        index = np.ones(diffusion_dataset["observations"].shape[1], dtype=bool)
-        index[2] = False
-        observation = diffusion_dataset["observations"][transition]
-        state = observation[index]
-        # state[1] = np.arccos(state[1].clip(-1, 1))
-        state[1] = np.arctan2(observation[2], observation[1])
-        action = diffusion_dataset["actions"][transition]
-        reward = diffusion_dataset["rewards"][transition]
-        next_observation = diffusion_dataset["next_observations"][transition]
-
-        # if transition == 0:
-        #     print(observation, action, reward, next_observation)
-        reset_to_state(env, state)
-        timestamp = env.step(action)
-        reward_true = timestamp.reward
-        next_observation_true = _flatten_obs(timestamp.observation)
-        reward_loss[transition, :] = np.abs(reward - reward_true)
-        observation_loss[transition, :] = np.abs(next_observation - next_observation_true)
-    return observation_loss, reward_loss
-
 
 def exists(val):
     return val is not None
@@ -206,6 +210,9 @@ def log(t, eps=1e-20):
     return torch.log(t.clamp(min=eps))
 
 
+SAMPLERS = ('stochastic', 'deterministic')
+
+
 # main class
 @gin.configurable
 class ElucidatedDiffusion(nn.Module):
@@ -225,6 +232,7 @@ class ElucidatedDiffusion(nn.Module):
             S_tmin: float = 0.05,
             S_tmax: float = 50,
             S_noise: float = 1.003,
+            adaptive_noise: bool = False,  # importance sample the training noise levels by their running loss
     ):
         super().__init__()
         assert net.random_or_learned_sinusoidal_cond
@@ -247,6 +255,11 @@ class ElucidatedDiffusion(nn.Module):
         self.S_tmax = S_tmax
         self.S_noise = S_noise
 
+        if adaptive_noise:
+            self.sigma_sampler = AdaptiveSigmaSampler(P_mean=P_mean, P_std=P_std)
+        else:
+            self.sigma_sampler = None
+
     @property
     def device(self):
         return next(self.net.parameters()).device
@@ -308,46 +321,97 @@ class ElucidatedDiffusion(nn.Module):
             clamp: bool = True,
             cond=None,
             disable_tqdm: bool = False,
+            sampler: str = 'stochastic',  # 'stochastic' (with churn) or 'deterministic' (plain Heun)
+            init_inputs: Optional[torch.Tensor] = None,  # real (unnormalized) rows to warm start from
+            start_sigma: Optional[float] = None,  # noise level the warm start begins at
+            student: Optional['ElucidatedDiffusion'] = None,  # cheap model for the high-noise part of the schedule
+            handoff_sigma: float = 1.0,  # with a student, steps at or below this level use this model
+            early_exit_tol: Optional[float] = None,  # freeze samples whose RMS update falls below this
     ):
+        assert sampler in SAMPLERS, f'Unknown sampler: {sampler}'
+        if exists(student):
+            assert student.event_shape == self.event_shape, 'Student must model the same inputs'
         cond = cond.to(self.device) if exists(cond) else None
         num_sample_steps = default(num_sample_steps, self.num_sample_steps)
+        if exists(init_inputs):
+            batch_size = init_inputs.shape[0]
         shape = (batch_size, *self.event_shape)
 
         # get the schedule, which is returned as (sigma, gamma) tuple, and pair up with the next sigma and gamma
         sigmas = self.sample_schedule(num_sample_steps)
+        S_churn = self.S_churn if sampler == 'stochastic' else 0.
         gammas = torch.where(
             (sigmas >= self.S_tmin) & (sigmas <= self.S_tmax),
-            min(self.S_churn / num_sample_steps, math.sqrt(2) - 1),
+            min(S_churn / num_sample_steps, math.sqrt(2) - 1),
             0.
         )
 
+        if exists(init_inputs):
+            # SDEdit-style warm start: skip the schedule above start_sigma and noise the real rows to the first
+            # remaining level, so only the tail of the schedule is run.
+            start = int((sigmas[:-1] > default(start_sigma, self.sigma_max)).sum())
+            sigmas, gammas = sigmas[start:], gammas[start:]
+
         sigmas_and_gammas = list(zip(sigmas[:-1], sigmas[1:], gammas[:-1]))
 
+        # Early exit only applies once no churn noise is added anymore, freezing a sample before a stochastic step
+        # would change its distribution.
+        churned = torch.nonzero(gammas[:-1] > 0)
+        first_exit_step = int(churned[-1]) + 1 if churned.numel() else 0
+
         # inputs are noise at the beginning
         init_sigma = sigmas[0]
         inputs = init_sigma * torch.randn(shape, device=self.device)
+        if exists(init_inputs):
+            inputs = inputs + self.normalizer.normalize(init_inputs.to(self.device))
+
+        if exists(early_exit_tol):
+            # Converged samples are written to `outputs` and dropped from the active batch.
+            outputs = torch.empty_like(inputs)
+            active = torch.arange(batch_size, device=self.device)
 
         # gradually denoise
-        for sigma, sigma_next, gamma in tqdm(sigmas_and_gammas, desc='sampling time step', mininterval=1,
-                                             disable=disable_tqdm):
+        for step, (sigma, sigma_next, gamma) in enumerate(tqdm(sigmas_and_gammas, desc='sampling time step',
+                                                               mininterval=1, disable=disable_tqdm)):
             sigma, sigma_next, gamma = map(lambda t: t.item(), (sigma, sigma_next, gamma))
 
-            eps = self.S_noise * torch.randn(shape, device=self.device)  # stochastic sampling
-
             sigma_hat = sigma + gamma * sigma
-            inputs_hat = inputs + math.sqrt(sigma_hat ** 2 - sigma ** 2) * eps
+            if gamma > 0:
+                eps = self.S_noise * torch.randn(inputs.shape, device=self.device)  # stochastic sampling
+                inputs_hat = inputs + math.sqrt(sigma_hat ** 2 - sigma ** 2) * eps
+            else:
+                inputs_hat = inputs
 
-            denoised_over_sigma = self.score_fn(inputs_hat, sigma_hat, clamp=clamp, cond=cond)
+            # Cascade: the student handles coarse denoising, the full model refines from handoff_sigma down.
+            model = student if exists(student) and sigma_hat > handoff_sigma else self
+            denoised_over_sigma = model.score_fn(inputs_hat, sigma_hat, clamp=clamp, cond=cond)
             inputs_next = inputs_hat + (sigma_next - sigma_hat) * denoised_over_sigma
 
             # second order correction, if not the last timestep
             if sigma_next != 0:
-                denoised_prime_over_sigma = self.score_fn(inputs_next, sigma_next, clamp=clamp, cond=cond)
+                denoised_prime_over_sigma = model.score_fn(inputs_next, sigma_next, clamp=clamp, cond=cond)
                 inputs_next = inputs_hat + 0.5 * (sigma_next - sigma_hat) * (
                         denoised_over_sigma + denoised_prime_over_sigma)
 
+            if exists(early_exit_tol) and step >= first_exit_step and sigma_next != 0:
+                update = (inputs_next - inputs).flatten(1).pow(2).mean(dim=1).sqrt()
+                done = update < early_exit_tol
+                if done.any():
+                    outputs[active[done]] = inputs_next[done]
+                    keep = ~done
+                    active, inputs_next = active[keep], inputs_next[keep]
+                    if exists(cond) and cond.shape[0] > 1:
+                        cond = cond[keep]
+                    if active.numel() == 0:
+                        inputs = inputs_next
+                        break
+
             inputs = inputs_next
 
+        if exists(early_exit_tol):
+            outputs[active] = inputs
+            inputs = outputs
+
         if clamp:
             inputs = inputs.clamp(-1., 1.)
         return self.normalizer.unnormalize(inputs)
@@ -388,6 +452,7 @@ class ElucidatedDiffusion(nn.Module):
                 d_ll = (v * grad).flatten(1).sum(1)
             return denoised_over_sigma.detach(), d_ll
 
+        from torchdiffeq import odeint
         x_min = x, x.new_zeros([x.shape[0]])
         t = x.new_tensor([self.sigma_min, self.sigma_max])
         sol = odeint(ode_fn, x_min, t, atol=atol, rtol=rtol, method='dopri5')
@@ -410,7 +475,12 @@ class ElucidatedDiffusion(nn.Module):
         assert event_shape == self.event_shape, f'mismatch of event shape, ' \
                                                 f'expected {self.event_shape}, got {event_shape}'
 
-        sigmas = self.noise_distribution(batch_size)
+        # Evaluation always uses the fixed noise distribution so losses stay comparable.
+        use_sampler = self.sigma_sampler is not None and self.training
+        if use_sampler:
+            sigmas, weights, buckets = self.sigma_sampler.sample(batch_size, device=inputs.device)
+        else:
+            sigmas = self.noise_distribution(batch_size)
         padded_sigmas = sigmas.view(batch_size, *([1] * len(self.event_shape)))
 
         noise = torch.randn_like(inputs)
@@ -420,6 +490,9 @@ class ElucidatedDiffusion(nn.Module):
         losses = F.mse_loss(denoised, inputs, reduction='none')
         losses = reduce(losses, 'b ... -> b', 'mean')
         losses = losses * self.loss_weight(sigmas)
+        if use_sampler:
+            self.sigma_sampler.update(buckets, losses)
+            losses = losses * weights
         return losses.mean()
 
 
@@ -448,10 +521,39 @@ class Trainer(object):
             env = None,
             eval_interval = 1000,
             step = 0,
+            train_sample_weights: Optional[Union[np.ndarray, torch.Tensor]] = None,  # per-row sampling weights
+            autotune: bool = False,  # replace the fixed batch size rule with a probed batch size
+            early_stopping: Optional[str] = None,  # None, 'stop' or 'reduce_lr' once the eval loss plateaus
+            early_stopping_patience: int = 4,
+            early_stopping_delta: float = 0.002,
+            lr_reduce_factor: float = 0.1,
+            max_lr_reductions: int = 2,  # with 'reduce_lr', stop after this many reductions
+            profile: bool = False,  # record per-phase step timings
+            profile_window: int = 100,  # number of steps in the rolling timing breakdown
+            profile_log_every: int = 100,
+            export_artifact: bool = True,  # also write an EMA-only sampling artifact (ema-*.pt) on every save
+            fidelity_backend: str = 'mujoco',  # 'mujoco' or 'analytic' (closed-form cartpole) for the fidelity check
     ):
         super().__init__()
-        self.earlystopper = EarlyStopper(patience=4, delta=0.002)
+        self.fidelity_backend = fidelity_backend
+        assert early_stopping in (None, 'stop', 'reduce_lr'), f'Unknown early stopping mode: {early_stopping}'
+        self.early_stopping = early_stopping
+        self.earlystopper = EarlyStopper(
+            patience=early_stopping_patience,
+            delta=early_stopping_delta,
+            plateau=early_stopping is not None,
+        )
+        self.lr_reduce_factor = lr_reduce_factor
+        self.max_lr_reductions = max_lr_reductions
+        self.num_lr_reductions = 0
+        self.best_step = None
+        self.converged_step = None
         self.eval_interval = eval_interval
+        self.timer = PhaseTimer(enabled=profile, window=profile_window)
+        self.profile_log_every = profile_log_every
+        self.export_artifact = export_artifact
+        from accelerate import Accelerator
+        from ema_pytorch import EMA
         self.accelerator = Accelerator(
             split_batches=split_batches,
             mixed_precision='fp16' if fp16 else 'no'
@@ -466,7 +568,23 @@ class Trainer(object):
         self.train_num_steps = train_num_steps
         self.gradient_accumulate_every = gradient_accumulate_every
 
-        if train_dataset is not None:
+        if autotune:
+            train_batch_size = small_batch_size = autotune_batch_size(
+                diffusion_model, mode='train', device=self.accelerator.device)
+
+        if isinstance(train_dataset, IterableDataset):
+            # Streamed datasets have no length and do their own shuffling.
+            self.batch_size = train_batch_size
+            print(f'Using batch size: {self.batch_size}')
+            if hasattr(train_dataset, 'batch_size'):
+                # Streams that batch themselves (TransitionStream) yield whole batches.
+                train_dataset.batch_size = self.batch_size
+                dl = DataLoader(train_dataset, batch_size=None, pin_memory=True, num_workers=4)
+            else:
+                dl = DataLoader(train_dataset, batch_size=self.batch_size, pin_memory=True, num_workers=4)
+            dl = self.accelerator.prepare(dl)
+            self.dl = cycle(dl)
+        elif train_dataset is not None:
             # If dataset size is less than 800K use the small batch size
             if len(train_dataset) < int(8e5):
                 self.batch_size = small_batch_size
@@ -475,7 +593,16 @@ class Trainer(object):
             print(f'Using batch size: {self.batch_size}')
             # dataset and dataloader
             # dl = DataLoader(train_dataset, batch_size=self.batch_size, shuffle=True, pin_memory=True, num_workers=cpu_count()//2)
-            dl = DataLoader(train_dataset, batch_size=self.batch_size, shuffle=True, pin_memory=True, num_workers=4)
+            if train_sample_weights is not None:
+                # Weighted rows (e.g. a coreset) are drawn with replacement in proportion to their weight.
+                sampler = WeightedRandomSampler(
+                    torch.as_tensor(train_sample_weights, dtype=torch.double),
+                    num_samples=len(train_dataset),
+                    replacement=True,
+                )
+                dl = DataLoader(train_dataset, batch_size=self.batch_size, sampler=sampler, pin_memory=True, num_workers=4)
+            else:
+                dl = DataLoader(train_dataset, batch_size=self.batch_size, shuffle=True, pin_memory=True, num_workers=4)
             dl = self.accelerator.prepare(dl)
             self.dl = cycle(dl)
         else:
@@ -537,6 +664,7 @@ class Trainer(object):
             env=env,
             ema_model=self.ema.ema_model,
             sample_batch_size = 1000,
+            autotune=False,
         )
         self.env = env
 
@@ -550,16 +678,32 @@ class Trainer(object):
             'opt': self.opt.state_dict(),
             'ema': self.ema.state_dict(),
             'scaler': self.accelerator.scaler.state_dict() if exists(self.accelerator.scaler) else None,
+            'best_step': self.best_step,
+            'converged_step': self.converged_step,
         }
 
-        torch.save(data, str(self.results_folder / f'model-{milestone}.pt'))
+        # Write to a temporary file and rename it, so processes watching the folder never read a partial checkpoint.
+        path = self.results_folder / self.checkpoint_name(milestone)
+        tmp_path = path.with_name(f'{path.name}.{os.getpid()}.tmp')
+        torch.save(data, str(tmp_path))
+        os.replace(tmp_path, path)
+        if self.export_artifact:
+            from synther.diffusion.artifact import export_sampling_artifact
+            artifact_name = 'best-ema.pt' if milestone == 'best' else f'ema-{milestone}.pt'
+            export_sampling_artifact(self.ema.ema_model, str(self.results_folder / artifact_name))
+
+    # The best snapshot is kept outside the model-*.pt and ema-*.pt patterns, from which resuming and the hot reload of
+    # DiffusionGenerator pick the newest file.
+    @staticmethod
+    def checkpoint_name(milestone) -> str:
+        return 'best.pt' if milestone == 'best' else f'model-{milestone}.pt'
 
     def load(self, milestone: Optional[int] = None):
         accelerator = self.accelerator
         device = accelerator.device
 
         if milestone is not None:
-            data = torch.load(str(self.results_folder / f'model-{milestone}.pt'), map_location=device)
+            data = torch.load(str(self.results_folder / self.checkpoint_name(milestone)), map_location=device)
         else:
             latest_file = get_latest_model_file(self.results_folder)
             data = torch.load(latest_file, map_location=device)
@@ -568,6 +712,8 @@ class Trainer(object):
         model.load_state_dict(data['model'])
 
         self.step = data['step']
+        self.best_step = data.get('best_step')
+        self.converged_step = data.get('converged_step')
         self.opt.load_state_dict(data['opt'])
         self.ema.load_state_dict(data['ema'])
 
@@ -575,40 +721,47 @@ class Trainer(object):
             self.accelerator.scaler.load_state_dict(data['scaler'])
 
 
-    def evaluate(self, accumulate_every = 1000):
+    # Mean eval loss of the online model, or of another model such as the EMA one, logged under log_key.
+    def evaluate(self, accumulate_every = 1000, model: Optional[nn.Module] = None, log_key: str = 'eval_loss'):
+        import wandb
         accelerator = self.accelerator
         device = accelerator.device
-        self.model.eval()
+        model = self.model if model is None else model
+        was_training = model.training
+        model.eval()
         
         eval_loss = 0.
-        for i in range(accumulate_every):
-            with torch.no_grad():
-                if type(next(self.eval_dl)) != torch.Tensor:
-                    data, context = next(self.eval_dl)
-                    data, context = data.to(device), context.to(device)
-                else:
-                    data, context = (next(self.eval_dl)[0]).to(device), None
+        with self.timer.phase('eval'):
+            for i in range(accumulate_every):
+                with torch.no_grad():
+                    batch = next(self.eval_dl)
+                    if type(batch) != torch.Tensor:
+                        data, context = batch
+                        data, context = data.to(device), context.to(device)
+                    else:
+                        data, context = batch[0].to(device), None
 
-                with self.accelerator.autocast():
-                    loss = self.model(data, cond=context)
+                    with self.accelerator.autocast():
+                        loss = model(data, cond=context)
 
-            eval_loss += loss.item()
-        eval_loss /= accumulate_every
-        
-        print(f'Evaluation loss: {eval_loss:.4f}')
-        wandb.log({
-            'eval_loss': eval_loss,
-            'step': self.step
-        })
-        accelerator.wait_for_everyone()
+                eval_loss += loss.item()
+            eval_loss /= accumulate_every
+
+            print(f'Evaluation loss: {eval_loss:.4f}')
+            wandb.log({
+                log_key: eval_loss,
+                'step': self.step
+            })
+            accelerator.wait_for_everyone()
         # accelerator.free_memory()
         
-        self.model.train()
+        model.train(was_training)
         return eval_loss
     
     
     # Train for the full number of steps.
     def train(self):
+        import wandb
         accelerator = self.accelerator
         device = accelerator.device
 
@@ -617,35 +770,47 @@ class Trainer(object):
                 total_loss = 0.
 
                 for _ in range(self.gradient_accumulate_every):
-                    if type(next(self.dl)) != torch.Tensor:
-                        data, context = next(self.dl)
-                        data, context = data.to(device), context.to(device)
-                        # print(context)
-                    else:
-                        data, context = (next(self.dl)[0]).to(device), None
-                    # print(type(next(self.dl)[0]))
-                    # print(next(self.dl)[0])
-                    with self.accelerator.autocast():
-                        loss = self.model(data, cond=context)
-                        loss = loss / self.gradient_accumulate_every
-                        total_loss += loss.item()
+                    with self.timer.phase('fetch'):
+                        batch = next(self.dl)
+                    with self.timer.phase('transfer'):
+                        if type(batch) != torch.Tensor:
+                            data, context = batch
+                            data, context = data.to(device), context.to(device)
+                            # print(context)
+                        else:
+                            data, context = batch[0].to(device), None
+                    with self.timer.phase('forward'):
+                        with self.accelerator.autocast():
+                            loss = self.model(data, cond=context)
+                            loss = loss / self.gradient_accumulate_every
+                            total_loss += loss.item()
                         
                     # breakpoint()
 
-                    self.accelerator.backward(loss)
+                    with self.timer.phase('backward'):
+                        self.accelerator.backward(loss)
 
-                accelerator.clip_grad_norm_(self.model.parameters(), 1.0)
-                pbar.set_description(f'loss: {total_loss:.4f}')
-                wandb.log({
-                    'step': self.step,
-                    'loss': total_loss,
-                    'lr': self.opt.param_groups[0]['lr']
-                })
+                with self.timer.phase('clip'):
+                    accelerator.clip_grad_norm_(self.model.parameters(), 1.0)
+                with self.timer.phase('logging'):
+                    pbar.set_description(f'loss: {total_loss:.4f}')
+                    wandb.log({
+                        'step': self.step,
+                        'loss': total_loss,
+                        'lr': self.opt.param_groups[0]['lr']
+                    })
 
                 if self.step % self.eval_interval == 0:
                     eval_loss = self.evaluate()
-                    self.earlystopper(eval_loss)
-                    if self.earlystopper.early_stop:
+                    if self.early_stopping is not None:
+                        # The best checkpoint is the one sampled from, so the EMA model is scored.
+                        self.ema.to(device)
+                        ema_eval_loss = self.evaluate(model=self.ema.ema_model, log_key='ema_eval_loss')
+                        if self.update_budget(ema_eval_loss):
+                            break
+                    else:
+                        self.earlystopper(eval_loss)
+                    if self.early_stopping is None and self.earlystopper.early_stop:
                         print("Early stopping")
                         self.save(self.step)
                         # break
@@ -658,55 +823,103 @@ class Trainer(object):
                         print("!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!")
                     
                     
-                    for cond in (0.2, 0.4 ,0.6):
-                        observations, actions, rewards, next_observations, terminals = self.generator.sample(
-                            num_samples=self.generator.sample_batch_size,
-                            cond=torch.tensor([cond], dtype=torch.float32)[:, None],
-                            num_transition=1,
-                        )
-                        observation_err, reward_err = calculate_diffusion_loss(
-                            {
-                                "observations": observations,
-                                "actions": actions,
-                                "rewards": rewards,
-                                "next_observations": next_observations,
-                                "terminals": terminals,
-                            },
-                            self.env,
-                        )
-                        wandb.log({
-                            'pos_1_mse_eval_len= ' + str(cond): np.mean(observation_err[0]),
-                            'pos_2_mse_eval_len= ' + str(cond): np.mean(observation_err[1]),
-                            'pos_3_mse_eval_len= ' + str(cond): np.mean(observation_err[2]),
-                            'vel_1_mse_eval_len= ' + str(cond): np.mean(observation_err[3]),
-                            'vel_2_mse_eval_len= ' + str(cond): np.mean(observation_err[4]),
-                            'reward_mse_eval_len= ' + str(cond): np.mean(reward_err),
-                        })
+                    with self.timer.phase('fidelity'):
+                        for cond in (0.2, 0.4 ,0.6):
+                            observations, actions, rewards, next_observations, terminals = self.generator.sample(
+                                num_samples=self.generator.sample_batch_size,
+                                cond=torch.tensor([cond], dtype=torch.float32)[:, None],
+                                num_transition=1,
+                            )
+                            observation_err, reward_err = calculate_diffusion_loss(
+                                {
+                                    "observations": observations,
+                                    "actions": actions,
+                                    "rewards": rewards,
+                                    "next_observations": next_observations,
+                                    "terminals": terminals,
+                                },
+                                self.env,
+                                pole_size=cond,
+                                backend=self.fidelity_backend,
+                            )
+                            wandb.log({
+                                'pos_1_mse_eval_len= ' + str(cond): np.mean(observation_err[:, 0]),
+                                'pos_2_mse_eval_len= ' + str(cond): np.mean(observation_err[:, 1]),
+                                'pos_3_mse_eval_len= ' + str(cond): np.mean(observation_err[:, 2]),
+                                'vel_1_mse_eval_len= ' + str(cond): np.mean(observation_err[:, 3]),
+                                'vel_2_mse_eval_len= ' + str(cond): np.mean(observation_err[:, 4]),
+                                'reward_mse_eval_len= ' + str(cond): np.mean(reward_err),
+                            })
                 
                 accelerator.wait_for_everyone()
 
-                self.opt.step()
-                self.opt.zero_grad()
+                with self.timer.phase('optimizer'):
+                    self.opt.step()
+                    self.opt.zero_grad()
 
                 accelerator.wait_for_everyone()
 
                 self.step += 1
                 if accelerator.is_main_process:
-                    self.ema.to(device)
-                    self.ema.update()
+                    with self.timer.phase('ema'):
+                        self.ema.to(device)
+                        self.ema.update()
 
                     if self.step != 0 and self.step % self.save_and_sample_every == 0:
-                        self.save(self.step)
+                        with self.timer.phase('checkpoint'):
+                            self.save(self.step)
 
                 pbar.update(1)
 
                 if self.lr_scheduler is not None:
                     self.lr_scheduler.step()
+
+                self.timer.step()
+                if self.timer.enabled and self.step % self.profile_log_every == 0:
+                    wandb.log({'step': self.step, **self.timer.summary()})
                     
                 
 
+        if self.converged_step is not None:
+            self.save(self.step)
+            accelerator.print(f'training converged at step {self.converged_step}, best model from step {self.best_step}')
         accelerator.print('training complete')
 
+    def scale_lr(self, factor: float):
+        for group in self.opt.param_groups:
+            group['lr'] *= factor
+            if 'initial_lr' in group:
+                group['initial_lr'] *= factor
+        if self.lr_scheduler is not None:
+            self.lr_scheduler.base_lrs = [lr * factor for lr in self.lr_scheduler.base_lrs]
+
+    # Track the EMA eval loss, checkpoint the best EMA model and act on plateaus. Returns True when training should stop.
+    def update_budget(self, eval_loss: float) -> bool:
+        import wandb
+        self.earlystopper(eval_loss)
+        if self.earlystopper.improved:
+            self.best_step = self.step
+            self.save('best')
+            wandb.log({'best_eval_loss': eval_loss, 'step': self.step})
+
+        if not self.earlystopper.early_stop:
+            return False
+
+        if self.early_stopping == 'reduce_lr' and self.num_lr_reductions < self.max_lr_reductions:
+            self.num_lr_reductions += 1
+            self.scale_lr(self.lr_reduce_factor)
+            self.earlystopper.reset()
+            print(f'Eval loss plateaued at step {self.step}, '
+                  f'lowering learning rate to {self.opt.param_groups[0]["lr"]:.2e}')
+            return False
+
+        self.converged_step = self.best_step
+        print(f'Eval loss plateaued, stopping at step {self.step}. Converged at step {self.converged_step}.')
+        wandb.log({'converged_step': self.converged_step, 'step': self.step})
+        if wandb.run is not None:
+            wandb.run.summary['converged_step'] = self.converged_step
+        return True
+
     # Allow user to pass in external data.
     def train_on_batch(
             self,
@@ -717,59 +930,72 @@ class Trainer(object):
     ):
         accelerator = self.accelerator
         device = accelerator.device
-        data = data.to(device)
+        with self.timer.phase('transfer'):
+            data = data.to(device)
 
         total_loss = 0.
         if splits == 1:
-            with self.accelerator.autocast():
-                loss = self.model(data, **kwargs)
-                total_loss += loss.item()
-            self.accelerator.backward(loss)
+            with self.timer.phase('forward'):
+                with self.accelerator.autocast():
+                    loss = self.model(data, **kwargs)
+                    total_loss += loss.item()
+            with self.timer.phase('backward'):
+                self.accelerator.backward(loss)
         else:
             assert splits > 1 and data.shape[0] % splits == 0
             split_data = torch.split(data, data.shape[0] // splits)
 
             for idx, d in enumerate(split_data):
-                with self.accelerator.autocast():
-                    # Split condition as well
-                    new_kwargs = {}
-                    for k, v in kwargs.items():
-                        if isinstance(v, torch.Tensor):
-                            new_kwargs[k] = torch.split(v, v.shape[0] // splits)[idx]
-                        else:
-                            new_kwargs[k] = v
-
-                    loss = self.model(d, **new_kwargs)
-                    loss = loss / splits
-                    total_loss += loss.item()
-                self.accelerator.backward(loss)
+                with self.timer.phase('forward'):
+                    with self.accelerator.autocast():
+                        # Split condition as well
+                        new_kwargs = {}
+                        for k, v in kwargs.items():
+                            if isinstance(v, torch.Tensor):
+                                new_kwargs[k] = torch.split(v, v.shape[0] // splits)[idx]
+                            else:
+                                new_kwargs[k] = v
+
+                        loss = self.model(d, **new_kwargs)
+                        loss = loss / splits
+                        total_loss += loss.item()
+                with self.timer.phase('backward'):
+                    self.accelerator.backward(loss)
 
-        accelerator.clip_grad_norm_(self.model.parameters(), 1.0)
+        with self.timer.phase('clip'):
+            accelerator.clip_grad_norm_(self.model.parameters(), 1.0)
         if use_wandb:
-            wandb.log({
-                'step': self.step,
-                'loss': total_loss,
-                'lr': self.opt.param_groups[0]['lr'],
-            })
+            import wandb
+            with self.timer.phase('logging'):
+                wandb.log({
+                    'step': self.step,
+                    'loss': total_loss,
+                    'lr': self.opt.param_groups[0]['lr'],
+                    **self.timer.summary(),
+                })
 
         accelerator.wait_for_everyone()
 
-        self.opt.step()
-        self.opt.zero_grad()
+        with self.timer.phase('optimizer'):
+            self.opt.step()
+            self.opt.zero_grad()
 
         accelerator.wait_for_everyone()
 
         self.step += 1
         if accelerator.is_main_process:
-            self.ema.to(device)
-            self.ema.update()
+            with self.timer.phase('ema'):
+                self.ema.to(device)
+                self.ema.update()
 
             if self.step != 0 and self.step % self.save_and_sample_every == 0:
-                self.save(self.step)
+                with self.timer.phase('checkpoint'):
+                    self.save(self.step)
 
         if self.lr_scheduler is not None:
             self.lr_scheduler.step()
 
+        self.timer.step()
         return total_loss
 
 
@@ -815,7 +1041,7 @@ class REDQTrainer(Trainer):
 
         self.model_terminals = model_terminals
 
-    def train_from_redq_buffer(self, buffer: ReplayBuffer, num_steps: Optional[int] = None):
+    def train_from_redq_buffer(self, buffer: 'ReplayBuffer', num_steps: Optional[int] = None):
         num_steps = num_steps or self.train_num_steps
         for j in range(num_steps):
             b = buffer.sample_batch(self.batch_size)
@@ -833,7 +1059,8 @@ class REDQTrainer(Trainer):
             if j % 1000 == 0:
                 print(f'[{j}/{num_steps}] loss: {loss:.4f}')
 
-    def update_normalizer(self, buffer: ReplayBuffer, device=None):
+    def update_normalizer(self, buffer: 'ReplayBuffer', device=None):
+        from synther.online.utils import make_inputs_from_replay_buffer
         data = make_inputs_from_replay_buffer(buffer, self.model_terminals)
         data = torch.from_numpy(data).float()
         self.model.normalizer.reset(data)
@@ -0,0 +1,66 @@
+# Lightweight per-phase wall-time instrumentation for the diffusion trainer.
+
+import contextlib
+import time
+from collections import defaultdict, deque
+from typing import Dict
+
+import torch
+
+_NULL_PHASE = contextlib.nullcontext()
+
+
+# Records the wall time spent in named phases of every training step and reports a rolling breakdown.
+# When disabled, phase() returns a shared no-op context so the instrumentation costs a single function call.
+class PhaseTimer:
+    def __init__(self, enabled: bool = False, window: int = 100, sync_cuda: bool = True):
+        self.enabled = enabled
+        self.window = window
+        # Kernels run asynchronously, so the device is synchronized at phase boundaries to attribute GPU time.
+        self.sync_cuda = sync_cuda and torch.cuda.is_available()
+        self._current = defaultdict(float)
+        self._history = defaultdict(lambda: deque(maxlen=window))
+        self._step_times = deque(maxlen=window)
+        self._last_step = None
+
+    def phase(self, name: str):
+        if not self.enabled:
+            return _NULL_PHASE
+        return self._timed(name)
+
+    @contextlib.contextmanager
+    def _timed(self, name: str):
+        if self.sync_cuda:
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            if self.sync_cuda:
+                torch.cuda.synchronize()
+            self._current[name] += time.perf_counter() - start
+
+    # Close the current step, phases that did not run in it count as zero in the rolling window.
+    def step(self):
+        if not self.enabled:
+            return
+        now = time.perf_counter()
+        if self._last_step is not None:
+            self._step_times.append(now - self._last_step)
+        self._last_step = now
+        for name in set(self._history) | set(self._current):
+            self._history[name].append(self._current.get(name, 0.))
+        self._current.clear()
+
+    def summary(self) -> Dict[str, float]:
+        if not self.enabled or not self._history:
+            return {}
+        means = {name: sum(times) / len(times) for name, times in self._history.items()}
+        total = sum(means.values())
+        stats = {}
+        for name, mean in means.items():
+            stats[f'time/{name}_ms'] = mean * 1e3
+            stats[f'time/{name}_frac'] = mean / total if total > 0 else 0.
+        if self._step_times:
+            stats['time/steps_per_sec'] = len(self._step_times) / sum(self._step_times)
+        return stats
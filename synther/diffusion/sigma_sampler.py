@@ -0,0 +1,102 @@
+# Adaptive noise-level sampling for diffusion training.
+
+import math
+
+import gin
+import torch
+from torch import nn
+
+
+def _ndtr(x: torch.Tensor) -> torch.Tensor:
+    return 0.5 * (1 + torch.erf(x / math.sqrt(2)))
+
+
+# Importance sampler over the log-normal training noise distribution.
+# The real line of log-sigma is split into buckets. A running loss is kept per bucket and buckets are drawn in
+# proportion to (base mass * running loss). Within a bucket sigma is drawn from the truncated log-normal, so the
+# importance weight of a sample is simply base mass / proposal mass of its bucket and the objective stays unbiased.
+@gin.configurable
+class AdaptiveSigmaSampler(nn.Module):
+    def __init__(
+            self,
+            P_mean: float = -1.2,
+            P_std: float = 1.2,
+            num_buckets: int = 32,
+            bucket_range: float = 3.,  # inner bucket edges span P_mean +- bucket_range * P_std in log-sigma
+            ema_decay: float = 0.99,  # decay of the running per-bucket loss
+            uniform_mix: float = 0.1,  # fraction of the proposal kept on the base distribution
+            warmup_steps: int = 1000,  # sample from the base distribution until the running losses are populated
+    ):
+        super().__init__()
+        assert num_buckets >= 2
+        self.P_mean = P_mean
+        self.P_std = P_std
+        self.num_buckets = num_buckets
+        self.ema_decay = ema_decay
+        self.uniform_mix = uniform_mix
+        self.warmup_steps = warmup_steps
+
+        # Bucket edges in standard-normal space, the outer buckets are open-ended.
+        inner = torch.linspace(-bucket_range, bucket_range, num_buckets - 1)
+        edges = torch.cat([torch.tensor([-math.inf]), inner, torch.tensor([math.inf])])
+        cdf = _ndtr(edges)
+        self.register_buffer('cdf_lo', cdf[:-1])
+        self.register_buffer('cdf_hi', cdf[1:])
+        self.register_buffer('base_probs', cdf[1:] - cdf[:-1])
+        self.register_buffer('bucket_loss', torch.ones(num_buckets))
+        self.register_buffer('bucket_seen', torch.zeros(num_buckets, dtype=torch.bool))
+        self.register_buffer('num_updates', torch.zeros((), dtype=torch.long))
+        # Host-side mirrors of num_updates and bucket_seen.all(), so choosing the proposal does not synchronize with
+        # the device on every training step.
+        self._num_updates = 0
+        self._all_seen = False
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+        self._num_updates = int(self.num_updates)
+        self._all_seen = False
+
+    @property
+    def proposal_probs(self) -> torch.Tensor:
+        if self._num_updates < self.warmup_steps:
+            return self.base_probs
+        if not self._all_seen:
+            # Synchronizes once per step only until every bucket has been seen.
+            self._all_seen = bool(self.bucket_seen.all())
+            if not self._all_seen:
+                return self.base_probs
+        probs = self.base_probs * self.bucket_loss.clamp(min=1e-8)
+        probs = probs / probs.sum()
+        return (1 - self.uniform_mix) * probs + self.uniform_mix * self.base_probs
+
+    # Returns sigmas, importance weights and the bucket of every sample.
+    def sample(self, batch_size: int, device=None):
+        device = device or self.base_probs.device
+        proposal = self.proposal_probs
+        buckets = torch.multinomial(proposal, batch_size, replacement=True).to(device)
+
+        lo, hi = self.cdf_lo[buckets], self.cdf_hi[buckets]
+        u = lo + (hi - lo) * torch.rand(batch_size, device=device)
+        z = torch.special.ndtri(u.clamp(1e-7, 1 - 1e-7))
+        sigmas = (self.P_mean + self.P_std * z).exp()
+
+        weights = self.base_probs[buckets] / proposal[buckets]
+        return sigmas, weights, buckets
+
+    @torch.no_grad()
+    def update(self, buckets: torch.Tensor, losses: torch.Tensor):
+        losses = losses.detach().float()
+        totals = torch.zeros_like(self.bucket_loss).scatter_add_(0, buckets, losses)
+        counts = torch.zeros_like(self.bucket_loss).scatter_add_(0, buckets, torch.ones_like(losses))
+        hit = counts > 0
+        means = totals[hit] / counts[hit]
+
+        # The first observation of a bucket replaces its initial value, later ones are averaged in.
+        fresh = hit & ~self.bucket_seen
+        self.bucket_loss[fresh] = (totals[fresh] / counts[fresh])
+        old = hit & self.bucket_seen
+        self.bucket_loss[old] = self.ema_decay * self.bucket_loss[old] + \
+                                (1 - self.ema_decay) * means[old[hit]]
+        self.bucket_seen |= hit
+        self.num_updates += 1
+        self._num_updates += 1
@@ -10,9 +10,11 @@ import numpy as np
 import torch
 import wandb
 
-from synther.diffusion.elucidated_diffusion import Trainer, SimpleDiffusionGenerator
+from synther.diffusion.elucidated_diffusion import Trainer, SimpleDiffusionGenerator, cycle
 
-from synther.diffusion.utils import make_inputs, construct_diffusion_model
+from synther.diffusion.utils import make_inputs, construct_diffusion_model, construct_student, sample_weights
+from synther.diffusion.coreset import build_coreset
+from synther.diffusion.dataloader import TransitionStream
 
 from dmc2gymnasium import DMCGym
 
@@ -46,7 +48,20 @@ if __name__ == '__main__':
     parser.add_argument('--load_checkpoint', type=int, default=int(0))
     parser.add_argument('--minari', type=int, default=int(1))
     parser.add_argument('--cond', type=float, nargs='+', default=None)
+    parser.add_argument('--coreset_fraction', type=float, default=None,
+                        help='fraction of rows per context kept in a weighted k-center coreset; the greedy '
+                             'selection costs ~ centers x min(rows, 131072) distance evaluations per context')
+    parser.add_argument('--coreset_max_centers', type=int, default=None,
+                        help='cap on coreset centers per context, clipping is reported; no cap by default')
+    parser.add_argument('--uniform', type=int, default=int(0))  # rebalance rewards with per-row sampling weights
+    parser.add_argument('--stream', type=int, default=int(0))  # stream train_dataset.npz block by block, memory-mapped
+    parser.add_argument('--normalizer_rows', type=int, default=int(5e5))
+    parser.add_argument('--warm_start_sigma', type=float, default=None)  # save samples warm started from train rows
+    parser.add_argument('--student_width', type=int, default=None)  # also train a narrow model for cascade sampling
+    parser.add_argument('--student_num_steps', type=int, default=None)
     args = parser.parse_args()
+    if args.stream and (args.uniform or args.coreset_fraction is not None):
+        parser.error('--stream does not support --uniform or --coreset_fraction, they need the whole dataset in memory')
     # # 使用正则表达式提取数字
     # match = re.search(r'\*(\d+)episodes\.npz', args.dataset)
     # if match:
@@ -65,6 +80,7 @@ if __name__ == '__main__':
     torch.manual_seed(args.seed)
     if args.use_gpu:
         torch.cuda.manual_seed(args.seed)
+    train_sample_weights = None
 
     # Create the environment and dataset.
     if args.minari:
@@ -80,11 +96,31 @@ if __name__ == '__main__':
         # test_size = len(dataset) - train_size  # 20% 用于测试
         # train_dataset, eval_dataset = random_split(dataset, [train_size, test_size])
         
-        train_dataset = make_inputs("train_dataset.npz", context=True, segment=args.segment)
-        inputs = torch.from_numpy(train_dataset[0]).float(), torch.from_numpy(train_dataset[1]).float()
-        train_dataset = torch.from_numpy(train_dataset[0]).float(), torch.from_numpy(train_dataset[1]).float()
-        
-        train_dataset = torch.utils.data.TensorDataset(*train_dataset)
+        if args.stream:
+            # Same source as the in-memory path, read block by block from the memory-mapped columns.
+            train_dataset = TransitionStream("train_dataset.npz", segment=args.segment, seed=args.seed)
+            # Fit the normalizer on a bounded prefix of the stream.
+            inputs = train_dataset.sample_inputs(args.normalizer_rows)
+            inputs = torch.from_numpy(inputs[0]).float(), torch.from_numpy(inputs[1]).float()
+        else:
+            train_dataset = make_inputs("train_dataset.npz", context=True, segment=args.segment)
+            if args.uniform:
+                train_sample_weights = sample_weights("train_dataset.npz", segment=args.segment)
+            inputs = torch.from_numpy(train_dataset[0]).float(), torch.from_numpy(train_dataset[1]).float()
+            if args.coreset_fraction is not None:
+                # Train on a weighted coreset, the normalizer is still fit on the full dataset.
+                coreset_indices, coreset_weights = build_coreset(
+                    train_dataset[0], train_dataset[1], fraction=args.coreset_fraction,
+                    max_centers=args.coreset_max_centers,
+                    device='cuda' if args.use_gpu and torch.cuda.is_available() else 'cpu', seed=args.seed,
+                )
+                if train_sample_weights is not None:
+                    coreset_weights = coreset_weights * train_sample_weights[coreset_indices]
+                train_sample_weights = coreset_weights
+                train_dataset = train_dataset[0][coreset_indices], train_dataset[1][coreset_indices]
+            train_dataset = torch.from_numpy(train_dataset[0]).float(), torch.from_numpy(train_dataset[1]).float()
+
+            train_dataset = torch.utils.data.TensorDataset(*train_dataset)
         
         eval_dataset = make_inputs("eval_dataset.npz", context=True)
         eval_dataset = torch.from_numpy(eval_dataset[0]).float(), torch.from_numpy(eval_dataset[1]).float()
@@ -110,7 +146,8 @@ if __name__ == '__main__':
         test_dataset=eval_dataset,
         results_folder=args.results_folder,
         train_num_steps=args.train_num_steps,
-        env = suite.load(domain_name="cartpole", task_name="swingup")
+        env = suite.load(domain_name="cartpole", task_name="swingup"),
+        train_sample_weights=train_sample_weights,
     )
     
 
@@ -125,6 +162,29 @@ if __name__ == '__main__':
         )
         # Train model.
         trainer.train()
+
+        if args.student_width is not None:
+            # Cascade student on the same data and normalizer, saved to <results_folder>/student.
+            student = construct_student(trainer.accelerator.unwrap_model(trainer.model), mlp_width=args.student_width)
+            student_trainer = Trainer(
+                student,
+                train_dataset=train_dataset,
+                test_dataset=eval_dataset,
+                results_folder=str(results_folder / 'student'),
+                train_num_steps=args.student_num_steps or args.train_num_steps,
+                env=suite.load(domain_name="cartpole", task_name="swingup"),
+                train_sample_weights=train_sample_weights,
+            )
+            # The student logs the same keys as the main model, so it gets its own run in the same group.
+            wandb.finish()
+            wandb.init(
+                project=args.wandb_project,
+                config=args,
+                group=args.wandb_group,
+                name=args.results_folder.split('/')[-1] + '-student',
+                job_type='student',
+            )
+            student_trainer.train()
     else:
         trainer.ema.to(trainer.accelerator.device)
         # Load the last checkpoint.
@@ -133,9 +193,18 @@ if __name__ == '__main__':
 
     # Generate samples and save them.
     if args.save_samples:
+        source = None
+        if args.warm_start_sigma is not None:
+            if args.stream:
+                # The stream already yields whole batches of the Trainer's batch size.
+                source = cycle(torch.utils.data.DataLoader(train_dataset, batch_size=None))
+            else:
+                source = cycle(torch.utils.data.DataLoader(train_dataset, batch_size=10000, shuffle=True))
         generator = SimpleDiffusionGenerator(
             env=env,
             ema_model=trainer.ema.ema_model,
+            start_sigma=args.warm_start_sigma,
+            source=source,
         )
         observations, actions, rewards, next_observations, terminals = generator.sample(
             num_samples=args.save_num_samples,
@@ -1,9 +1,11 @@
 # Utilities for diffusion.
-from typing import Optional, List, Union
+import heapq
+import os
+import warnings
+from typing import TYPE_CHECKING, Dict, Optional, List, Tuple, Union
 
 # import d4rl
 import gin
-import gym
 import numpy as np
 import torch
 from torch import nn
@@ -12,14 +14,43 @@ from torch import nn
 from synther.diffusion.denoiser_network import ResidualMLPDenoiser
 from synther.diffusion.elucidated_diffusion import ElucidatedDiffusion
 from synther.diffusion.norm import normalizer_factory
+from synther.diffusion.artifact import model_config, model_from_config
+from synther.diffusion.dataset_cache import default_cache
+from synther.diffusion.context_index import ContextIndex, context_order
+
+
+if TYPE_CHECKING:
+    import gym
+
+# Pole-length ranges used to build segment datasets, as (low, high) open intervals.
+SEGMENTS = {
+    'front': [(0.15, 0.45)],
+    'middle': [(0.25, 0.55)],
+    'rear': [(0.35, 0.65)],
+    'extremes': [(-np.inf, 0.25), (0.55, np.inf)],
+}
+
+
+def segment_ranges(segment: str) -> List[Tuple[float, float]]:
+    if segment not in SEGMENTS:
+        raise ValueError(f'Unknown segment: {segment}')
+    return SEGMENTS[segment]
+
+
+# Boolean mask over rows whose context falls into the given segment.
+def segment_mask(contexts: np.ndarray, segment: str) -> np.ndarray:
+    ranges = segment_ranges(segment)
+    contexts = np.asarray(contexts).reshape(contexts.shape[0], -1)[:, 0]
+    mask = np.zeros(contexts.shape[0], dtype=bool)
+    for low, high in ranges:
+        mask |= (contexts > low) & (contexts < high)
+    return mask
 
-import minari
-from collections import Counter
 
 # Make transition dataset from data.
 @gin.configurable
 def make_inputs(
-        env: gym.Env,
+        env: 'gym.Env',
         modelled_terminals: bool = False,
 ) -> np.ndarray:
     dataset = d4rl.qlearning_dataset(env)
@@ -33,38 +64,47 @@ def make_inputs(
         inputs = np.concatenate([inputs, terminals[:, None]], axis=1)
     return inputs
 
-def make_inputs(
-        dataset_name: str,
-        minari: bool = False,
-        modelled_terminals: bool = False,
-        original: bool = False,
-        context: bool = False,
-        top: bool = False,
-        uniform: bool = False,
-        segment: Optional[str] = None
+# Directory of the .npz transition datasets.
+DATASET_DIR = os.environ.get('SYNTHER_DATASET_DIR', '/scratch/work/liub6/diffusionRL/diffuser/synther/dataset/')
 
-) -> np.ndarray:
-    
+
+# Undiscounted return of each episode. Minari 0.4 keeps every episode as a group of main_data.hdf5, so only the
+# reward arrays are read. Other storage layouts fall back to iterating over the episodes.
+def episode_returns(dataset, episode_indices: np.ndarray) -> np.ndarray:
+    data_path = os.path.join(getattr(dataset.spec, 'data_path', ''), 'main_data.hdf5')
+    if not os.path.exists(data_path):
+        episodes = dataset.iterate_episodes(episode_indices=episode_indices)
+        return np.array([np.sum(episode.rewards) for episode in episodes])
+    import h5py
+
+    with h5py.File(data_path, 'r') as f:
+        return np.array([f[f'episode_{i}/rewards'][()].sum() for i in episode_indices])
+
+
+# Indices of the num_top highest-return episodes of each consecutive split of num_ep_per_split episodes, best first
+# within a split. Memory is bounded by one split of returns.
+def top_episode_indices(dataset, num_ep_per_split: int = 250, num_top: int = 50) -> np.ndarray:
+    selected = []
+    for i in range(dataset.total_episodes // num_ep_per_split):
+        indices = np.arange(0, num_ep_per_split) + i * num_ep_per_split
+        returns = episode_returns(dataset, indices)
+        # nlargest keeps the order of sorted(..., reverse=True), ties stay in episode order.
+        selected += heapq.nlargest(num_top, indices.tolist(), key=lambda idx: returns[idx - indices[0]])
+    return np.array(selected, dtype=np.int64)
+
+
+# Transition columns of a Minari dataset or an .npz file in DATASET_DIR.
+def _read_dataset_columns(dataset_name: str, minari: bool = False, top: bool = False) -> Dict[str, np.ndarray]:
     if minari:
-        dataset = minari.load_dataset(dataset_name, download=False)
+        # The `minari` flag shadows the package name, so import the loader directly.
+        from minari import load_dataset
+        dataset = load_dataset(dataset_name, download=False)
         obs, actions, rewards, next_obs, contexts, episode_lens, dones = [], [], [], [], [], [], []
 
         # ********************************************************************************************************************
         if top:
-            num_ep_per_split = 250
-            num_top = 50
-            top_episodes = []
-            n = dataset.total_episodes // num_ep_per_split
-            for i in range(n):
-                indices = np.arange(0, num_ep_per_split) + i * num_ep_per_split
-                episodes_generator = dataset.iterate_episodes(episode_indices=indices)
-                episodes_with_rewards = []
-                for episode in episodes_generator:
-                    total_reward = sum(episode.rewards)
-                    episodes_with_rewards.append((episode, total_reward))
-                episodes_with_rewards.sort(key=lambda x: x[1], reverse=True)
-                top_episodes_with_rewards = episodes_with_rewards[:num_top]
-                top_episodes += [episode for episode, _ in top_episodes_with_rewards]
+            # Select on returns first, then read the full columns of the selected episodes only.
+            top_episodes = dataset.iterate_episodes(episode_indices=top_episode_indices(dataset))
             for episode in top_episodes:
                 obs.append(episode.observations[:-1])
                 actions.append(episode.actions)
@@ -105,7 +145,7 @@ def make_inputs(
         # print(obs.shape, actions.shape, rewards.shape, next_obs.shape)
         
     else:
-        dataset = np.load("/scratch/work/liub6/diffusionRL/diffuser/synther/dataset/" + dataset_name)
+        dataset = np.load(os.path.join(DATASET_DIR, dataset_name))
         dataset = {key: dataset[key] for key in dataset.files}
         obs = dataset['observations']
         actions = dataset['actions']
@@ -113,57 +153,106 @@ def make_inputs(
         next_obs = dataset['next_observations']
         terminals = dataset['terminals']
         contexts = dataset['contexts']
-    
 
+    return {'observations': obs, 'actions': actions, 'rewards': rewards, 'next_observations': next_obs,
+            'terminals': terminals, 'contexts': contexts}
+
+
+def _dataset_sources(dataset_name: str, minari: bool) -> List[str]:
+    if minari:
+        root = os.environ.get('MINARI_DATASETS_PATH', os.path.join('~', '.minari', 'datasets'))
+        return [os.path.join(root, dataset_name)]
+    return [os.path.join(DATASET_DIR, dataset_name)]
+
+
+# Rows in context order, so that ContextIndex resolves segments and pole lengths to slices.
+def _context_sorted_columns(dataset_name: str, minari: bool, top: bool) -> Dict[str, np.ndarray]:
+    columns = _read_dataset_columns(dataset_name, minari=minari, top=top)
+    order = context_order(columns['contexts'])
+    if np.array_equal(order, np.arange(order.shape[0])):
+        return columns
+    return ContextIndex.take(columns, order)
+
+
+# Columns of a dataset before rebalancing and segment selection, from the dataset cache when it is enabled.
+# Rows are sorted by context (stably, so episodes stay contiguous and in order).
+def load_dataset_columns(dataset_name: str, minari: bool = False, top: bool = False) -> Dict[str, np.ndarray]:
+    cache = default_cache()
+    if cache is None:
+        return _context_sorted_columns(dataset_name, minari, top)
+    return cache.get_or_create(
+        dataset_name,
+        {'minari': minari, 'top': top},
+        _dataset_sources(dataset_name, minari),
+        lambda: _context_sorted_columns(dataset_name, minari, top),
+    )
+
+
+# Per-row sampling weights that rebalance the rewards over num_bins bins in [0, 1]: bins holding fewer rows than
+# 1 / ratio of the largest bin are weighted up to that level, the same expected mass as oversampling them with
+# replacement. One bincount pass over the rows.
+def uniform_weights(rewards: np.ndarray, num_bins: int = 50, ratio: int = 10) -> np.ndarray:
+    bins = np.linspace(0, 1, num_bins + 1)
+    digitized = np.digitize(np.asarray(rewards).reshape(-1), bins)
+    counts = np.bincount(digitized)
+    target = counts.max() // ratio
+    bin_weights = np.where(counts < target, target / np.maximum(counts, 1), 1.)
+    return bin_weights[digitized]
+
+
+def make_inputs(
+        dataset_name: str,
+        minari: bool = False,
+        modelled_terminals: bool = False,
+        original: bool = False,
+        context: bool = False,
+        top: bool = False,
+        segment: Optional[str] = None,
+        uniform: bool = False,  # deprecated, use sample_weights
+
+) -> np.ndarray:
     
+    columns = load_dataset_columns(dataset_name, minari=minari, top=top)
+    weights = None
     if uniform:
-        cat = np.concatenate([obs, actions, rewards[..., None], next_obs, terminals[..., None], contexts], axis=1)
-        original_data = rewards
-        num_bins =50
-        bins = np.linspace(0, 1, num_bins + 1)
-        digitized = np.digitize(original_data, bins) - 1  # 将数据分配到桶中
-        data_counter = Counter(digitized)
-        target_frequency = max(data_counter.values()) // 10
-        
-        new_data = cat[0:1, :]
-        for bin_index, count in data_counter.items():
-            index = np.where(digitized == bin_index)
-            if count < target_frequency:
-                new_data = np.concatenate([new_data, cat[np.random.choice(index[0], target_frequency, replace=True), :]], axis=0)
-            else:
-                new_data = np.concatenate([new_data, cat[index[0]]], axis=0)
-
-        new_data = np.array(new_data)
-
-        obs = new_data[:, 0:5]
-        actions =  new_data[:, 5:6]
-        rewards =  new_data[:, 6]
-        next_obs =  new_data[:, 7:12]
-        terminals =  new_data[:, 12]
-        contexts =  new_data[:, 13:14]
-    
+        warnings.warn('make_inputs(uniform=True) is deprecated, use sample_weights() with the same arguments',
+                      DeprecationWarning, stacklevel=2)
+        weights = uniform_weights(columns['rewards'])
+    obs = columns['observations']
+    actions = columns['actions']
+    rewards = columns['rewards']
+    next_obs = columns['next_observations']
+    terminals = columns['terminals']
+    contexts = columns['contexts']
+
     # print("#" + segment + "#")
     if segment is not None:
-        if segment == 'front':
-            index = np.where((contexts > 0.15) & (contexts < 0.45))
-        elif segment == 'middle':
-            index = np.where((contexts > 0.25) & (contexts < 0.55))
-        elif segment == 'rear':
-            index = np.where((contexts > 0.35) & (contexts < 0.65))
-        elif segment == 'extremes':
-            index = np.where((contexts < 0.25) | (contexts > 0.55))
-        
-        obs = obs[index[0]]
-        actions = actions[index[0]]
-        rewards = rewards[index[0]]
-        next_obs = next_obs[index[0]]
-        terminals = terminals[index[0]]
-        contexts = contexts[index[0]]
+        # The columns are in context order, so a segment is a slice and the columns below are views.
+        rows = ContextIndex(contexts).select(ranges=segment_ranges(segment))
+
+        obs = obs[rows]
+        actions = actions[rows]
+        rewards = rewards[rows]
+        next_obs = next_obs[rows]
+        terminals = terminals[rows]
+        contexts = contexts[rows]
+        if weights is not None:
+            weights = weights[rows]
         
     
     if original:
-        return {'observations': obs, 'actions': actions, 'rewards': rewards, 'next_observations': next_obs, 'terminals': terminals, 'contexts': contexts}   
+        dataset = {'observations': obs, 'actions': actions, 'rewards': rewards, 'next_observations': next_obs,
+                   'terminals': terminals, 'contexts': contexts}
+        if weights is not None:
+            # ReplayBuffer.load_dataset samples the rows with these weights.
+            dataset['sample_weights'] = weights
+        return dataset
     else:
+        if weights is not None:
+            # Arrays carry no weights, so rare reward bins are oversampled by repeating each row round(weight) times.
+            repeats = np.repeat(np.arange(weights.shape[0]), np.maximum(np.rint(weights), 1).astype(np.int64))
+            obs, actions, rewards, next_obs = obs[repeats], actions[repeats], rewards[repeats], next_obs[repeats]
+            terminals, contexts = terminals[repeats], contexts[repeats]
         inputs = np.concatenate([obs, actions, rewards[:, None], next_obs], axis=1)
         # inputs = np.concatenate([obs[0:-1], actions[0:-1], rewards[:, None][0:-1], next_obs[0:-1]], axis=1)
         # inputs_next = np.concatenate([actions[1:], rewards[:, None][1:], next_obs[1:]], axis=1)
@@ -181,6 +270,21 @@ def make_inputs(
             return inputs
 
 
+# Reward-rebalancing weights (uniform_weights over the whole dataset) of the rows make_inputs returns for the same
+# dataset and segment. Rebalancing keeps every row and weights the sampling instead of duplicating rows.
+def sample_weights(
+        dataset_name: str,
+        minari: bool = False,
+        top: bool = False,
+        segment: Optional[str] = None,
+) -> np.ndarray:
+    columns = load_dataset_columns(dataset_name, minari=minari, top=top)
+    weights = uniform_weights(columns['rewards'])
+    if segment is not None:
+        weights = weights[ContextIndex(columns['contexts']).select(ranges=segment_ranges(segment))]
+    return weights
+
+
 @gin.configurable
 def construct_diffusion_model(
         inputs: Union[torch.Tensor, list],
@@ -210,3 +314,19 @@ def construct_diffusion_model(
         normalizer=normalizer,
         event_shape=[event_dim],
     )
+
+
+# Narrow copy of a diffusion model for cascade sampling. It shares the normalizer and the noise parameterization,
+# only the denoiser is smaller.
+def construct_student(
+        diffusion: ElucidatedDiffusion,
+        mlp_width: int = 256,
+        num_layers: Optional[int] = None,
+) -> ElucidatedDiffusion:
+    config = model_config(diffusion)
+    config['denoiser'] = dict(config['denoiser'], mlp_width=mlp_width)
+    if num_layers is not None:
+        config['denoiser']['num_layers'] = num_layers
+    student = model_from_config(config)
+    student.normalizer.load_state_dict(diffusion.normalizer.state_dict())
+    return student
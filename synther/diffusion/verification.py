@@ -0,0 +1,162 @@
+# Physics-consistency checks of generated cartpole transitions.
+# Every (s, a) pair is simulated from its own state and the result is compared with the generated reward and next
+# state. Rows are converted to MuJoCo states in one step, grouped by pole size and every group is simulated by a single
+# mujoco.rollout call (mujoco>=3.1), which steps all rows in C from one physics instance per pole size.
+from typing import Dict, Optional, Tuple, Union
+
+import numpy as np
+
+
+def _flatten_obs(obs, dtype=np.float32):
+    obs_pieces = []
+    for v in obs.values():
+        flat = np.array([v]) if np.isscalar(v) else v.ravel()
+        obs_pieces.append(flat)
+    return np.concatenate(obs_pieces, axis=0).astype(dtype)
+
+
+# dm_control cartpole swingup with the pole capsule size set to a context value, like set_pole_length in the CORL
+# scripts but without rewriting the installed XML.
+def make_cartpole_env(pole_size: Optional[float] = None, random=None):
+    import xml.etree.ElementTree as ET
+    from dm_control.rl import control
+    from dm_control.suite import cartpole
+
+    xml, assets = cartpole.get_model_and_assets()
+    if pole_size is not None:
+        root = ET.fromstring(xml)
+        root.find('.//geom').attrib['size'] = str(pole_size)
+        xml = ET.tostring(root)
+    physics = cartpole.Physics.from_xml_string(xml, assets)
+    task = cartpole.Balance(swing_up=True, sparse=False, random=random)
+    return control.Environment(physics, task, time_limit=cartpole._DEFAULT_TIME_LIMIT)
+
+
+# The context value of an environment: the size set_pole_length edits is the one the pole geoms inherit.
+def pole_size_of(env) -> float:
+    return float(env.physics.named.model.geom_size['pole_1', 0])
+
+
+def reset_to_state(env, state):
+    env._reset_next_step = False
+    env._step_count = 0
+    with env._physics.reset_context():
+        env._physics.named.data.qpos[:] = np.array([state[0], state[1]])
+        env._physics.named.data.qvel[:] = np.array([state[2], state[3]])
+    env._task.after_step(env._physics)
+
+
+# Observations are [cart position, cos, sin, cart velocity, pole angular velocity].
+def observations_to_state(observations: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    observations = np.asarray(observations, dtype=np.float64)
+    qpos = np.stack([observations[:, 0], np.arctan2(observations[:, 2], observations[:, 1])], axis=1)
+    return qpos, observations[:, 3:5]
+
+
+# Reference next observations and rewards: env.step after reset_to_state, one row at a time.
+def suite_step(env, qpos: np.ndarray, qvel: np.ndarray, actions: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    next_observations = []
+    rewards = np.empty(qpos.shape[0])
+    for i in range(qpos.shape[0]):
+        reset_to_state(env, np.concatenate([qpos[i], qvel[i]]))
+        time_step = env.step(actions[i])
+        rewards[i] = time_step.reward
+        next_observations.append(_flatten_obs(time_step.observation))
+    return np.stack(next_observations), rewards
+
+
+# The same step for all rows at once with mujoco.rollout: each row starts from its own full physics state and is
+# stepped env._n_sub_steps times under its action. The observation and reward of the reached state follow the
+# cartpole task, whose pole body frame rotates by the hinge angle only.
+def simulate(env, qpos: np.ndarray, qvel: np.ndarray, actions: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    import mujoco
+    from mujoco import rollout
+
+    from synther.diffusion.cartpole_dynamics import observations_from_state, reward
+
+    model, data = env.physics.model.ptr, env.physics.data.ptr
+    spec = mujoco.mjtState.mjSTATE_FULLPHYSICS
+    template = np.empty(mujoco.mj_stateSize(model, spec))
+    mujoco.mj_resetData(model, data)
+    mujoco.mj_getState(model, data, template, spec)
+    # The full physics state is laid out as [time, qpos, qvel, act, ...].
+    offset = mujoco.mj_stateSize(model, mujoco.mjtState.mjSTATE_TIME)
+    initial_state = np.tile(template, (qpos.shape[0], 1))
+    initial_state[:, offset:offset + model.nq] = qpos
+    initial_state[:, offset + model.nq:offset + model.nq + model.nv] = qvel
+    control = np.repeat(actions[:, None, :model.nu], env._n_sub_steps, axis=1)
+    state, _ = rollout.rollout(model, data, initial_state, control)
+    next_qpos = state[:, -1, offset:offset + model.nq]
+    next_qvel = state[:, -1, offset + model.nq:offset + model.nq + model.nv]
+    return observations_from_state(next_qpos, next_qvel), reward(next_qpos, next_qvel, actions)
+
+
+VERIFY_BACKENDS = ('mujoco', 'analytic')
+
+_ENVS: Dict[Optional[float], object] = {}  # by pole size
+
+
+def _env(pole_size: Optional[float]):
+    if pole_size not in _ENVS:
+        _ENVS[pole_size] = make_cartpole_env(pole_size)
+    return _ENVS[pole_size]
+
+
+# Absolute errors of the generated next observations [N, obs_dim] and rewards [N, 1].
+def verify_transitions(
+        observations: np.ndarray,
+        actions: np.ndarray,
+        rewards: np.ndarray,
+        next_observations: np.ndarray,
+        pole_size: Union[None, float, np.ndarray] = None,  # one value, one per row, or None for the default pole
+) -> Tuple[np.ndarray, np.ndarray]:
+    qpos, qvel = observations_to_state(observations)
+    num_rows = qpos.shape[0]
+    actions = np.asarray(actions, dtype=np.float64).reshape(num_rows, -1)
+    next_observations = np.asarray(next_observations)
+    if num_rows == 0:
+        return np.zeros((0, next_observations.shape[-1])), np.zeros((0, 1))
+
+    if pole_size is None or np.isscalar(pole_size):
+        groups = {None if pole_size is None else float(pole_size): np.arange(num_rows)}
+    else:
+        values, inverse = np.unique(np.asarray(pole_size).reshape(num_rows), return_inverse=True)
+        groups = {float(v): np.flatnonzero(inverse == i) for i, v in enumerate(values)}
+
+    true_next_observations = np.empty((num_rows, next_observations.reshape(num_rows, -1).shape[1]))
+    true_rewards = np.empty(num_rows)
+    for p, idx in groups.items():
+        true_next_observations[idx], true_rewards[idx] = simulate(_env(p), qpos[idx], qvel[idx], actions[idx])
+    observation_err = np.abs(next_observations.reshape(num_rows, -1) - true_next_observations)
+    reward_err = np.abs(np.asarray(rewards).reshape(num_rows) - true_rewards)[:, None]
+    return observation_err, reward_err
+
+
+# Errors of the first `range` transitions of a dataset dict. The pole size comes from `env` unless it is given, as
+# one value or one per row (e.g. the dataset contexts). The 'analytic' backend evaluates the closed-form cartpole
+# model in cartpole_dynamics.py instead of simulating, which is orders of magnitude faster.
+def calculate_diffusion_loss(diffusion_dataset, env=None, range=None, pole_size=None, backend: str = 'mujoco'):
+    assert backend in VERIFY_BACKENDS, f'Unknown backend {backend}, expected one of {VERIFY_BACKENDS}'
+    if range is None:
+        range = diffusion_dataset["observations"].shape[0]
+    if pole_size is None and env is not None:
+        pole_size = pole_size_of(env)
+    elif pole_size is not None and not np.isscalar(pole_size):
+        pole_size = np.asarray(pole_size).reshape(len(pole_size), -1)[:range, 0]
+    if backend == 'analytic':
+        from synther.diffusion.cartpole_dynamics import dynamics_error
+
+        return dynamics_error(
+            diffusion_dataset["observations"][:range],
+            diffusion_dataset["actions"][:range],
+            diffusion_dataset["rewards"][:range],
+            diffusion_dataset["next_observations"][:range],
+            pole_size=pole_size,
+        )
+    return verify_transitions(
+        diffusion_dataset["observations"][:range],
+        diffusion_dataset["actions"][:range],
+        diffusion_dataset["rewards"][:range],
+        diffusion_dataset["next_observations"][:range],
+        pole_size=pole_size,
+    )
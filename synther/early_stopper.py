@@ -1,21 +1,41 @@
 class EarlyStopper:
-    def __init__(self, patience=3, delta=0.003):
+    def __init__(self, patience=3, delta=0.003, plateau=False):
         self.patience = patience
         self.delta = delta
+        # By default only losses rising above the best count against patience. In plateau mode every evaluation
+        # that fails to improve on the best loss by at least delta does.
+        self.plateau = plateau
         self.best_loss = None
         self.early_stop = False
+        self.improved = False
         self.counter = 0
 
     def __call__(self, val_loss):
         loss = val_loss
+        self.improved = False
 
         if self.best_loss is None:
             self.best_loss = loss
+            self.improved = True
+        elif self.plateau:
+            if loss < self.best_loss - self.delta:
+                self.best_loss = loss
+                self.improved = True
+                self.counter = 0
+            else:
+                self.counter += 1
+                if self.counter >= self.patience:
+                    self.early_stop = True
         elif loss > self.best_loss + self.delta:
             self.counter += 1
             if self.counter >= self.patience:
                 self.early_stop = True
         else:
+            self.improved = loss < self.best_loss
             self.best_loss = loss
             self.counter = 0
-            
\ No newline at end of file
+
+    # Start a fresh patience window, e.g. after the learning rate was lowered.
+    def reset(self):
+        self.early_stop = False
+        self.counter = 0
@@ -0,0 +1,89 @@
+# Import-time budget for the synther modules used by workers and command line scripts.
+# Each module is imported in a fresh interpreter after the core numerical stack, and the check fails if the import
+# pulls in one of the heavy optional packages or takes longer than the budget.
+# Usage: python -m synther.import_budget [--budget 1.0]. tests/test_import_budget.py enforces the same budget.
+import argparse
+import json
+import pathlib
+import subprocess
+import sys
+from typing import Dict, List, Sequence, Tuple
+
+# Packages that must only be imported by the feature that needs them.
+HEAVY_PACKAGES = (
+    'wandb', 'accelerate', 'ema_pytorch', 'torchdiffeq', 'redq',
+    'gym', 'gymnasium', 'dmc2gymnasium', 'dm_control', 'mujoco', 'minari',
+)
+
+CHECKED_MODULES = (
+    'synther.diffusion.elucidated_diffusion',
+    'synther.diffusion.utils',
+    'synther.diffusion.dataloader',
+    'synther.diffusion.autotune',
+    'synther.corl.shared.buffer',
+    'synther.corl.shared.sample_cache',
+)
+
+# Repository root, so the probes import this checkout of synther whatever the caller's working directory.
+ROOT = pathlib.Path(__file__).resolve().parents[1]
+
+# torch, numpy and gin are needed by everything, so they are loaded before the clock starts.
+_PROBE = '''
+import json, sys, time
+import gin, numpy, torch
+start = time.perf_counter()
+import {module}
+seconds = time.perf_counter() - start
+print(json.dumps({{'seconds': seconds, 'modules': sorted(sys.modules)}}))
+'''
+
+
+def probe(module: str) -> Dict:
+    out = subprocess.run(
+        [sys.executable, '-c', _PROBE.format(module=module)],
+        capture_output=True, text=True, check=True, cwd=ROOT,
+    )
+    return json.loads(out.stdout.strip().splitlines()[-1])
+
+
+# Slowest imports by cumulative time, from the interpreter's own import profiler.
+def slowest_imports(module: str, top: int = 10) -> List[str]:
+    out = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+        capture_output=True, text=True, cwd=ROOT,
+    )
+    rows = []
+    for line in out.stderr.splitlines():
+        parts = line.split('|')
+        if len(parts) == 3 and parts[1].strip().isdigit():
+            rows.append((int(parts[1]), parts[2].strip()))
+    return [f'{us / 1e3:8.1f} ms  {name}' for us, name in sorted(rows, reverse=True)[:top]]
+
+
+# Fastest import time over repeats, so a busy machine does not fail the budget, and the heavy packages it pulls in.
+def measure(module: str, repeats: int = 3) -> Tuple[float, List[str]]:
+    results = [probe(module) for _ in range(repeats)]
+    seconds = min(r['seconds'] for r in results)
+    heavy = sorted({m.split('.')[0] for m in results[0]['modules']} & set(HEAVY_PACKAGES))
+    return seconds, heavy
+
+
+def check(modules: Sequence[str], budget: float, repeats: int = 3) -> bool:
+    ok = True
+    for module in modules:
+        seconds, heavy = measure(module, repeats)
+        passed = seconds <= budget and not heavy
+        ok &= passed
+        print(f'{"ok  " if passed else "FAIL"} {module}: {seconds:.3f}s' + (f', imports {heavy}' if heavy else ''))
+        if not passed:
+            print('\n'.join(slowest_imports(module)))
+    return ok
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--budget', type=float, default=1.0, help='seconds per module on top of torch/numpy/gin')
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--modules', nargs='+', default=list(CHECKED_MODULES))
+    args = parser.parse_args()
+    sys.exit(0 if check(args.modules, args.budget, args.repeats) else 1)
@@ -0,0 +1,50 @@
+# Agreement of the closed-form cartpole model (synther/diffusion/cartpole_dynamics.py) and the batched MuJoCo check
+# (synther/diffusion/verification.py) with dm_control's cartpole swingup, stepped one row at a time from the same
+# states and actions. Actions reach outside the control range to cover clamping and the control cost.
+import pytest
+
+np = pytest.importorskip('numpy')
+pytest.importorskip('torch')
+pytest.importorskip('mujoco')
+suite = pytest.importorskip('dm_control.suite')
+
+from synther.diffusion import cartpole_dynamics  # noqa: E402
+from synther.diffusion.verification import make_cartpole_env, pole_size_of, simulate, suite_step  # noqa: E402
+
+ATOL = 1e-4
+
+
+def random_transitions(num_states: int = 500, seed: int = 0):
+    rng = np.random.default_rng(seed)
+    qpos = np.stack([rng.uniform(-1.5, 1.5, num_states), rng.uniform(-np.pi, np.pi, num_states)], -1)
+    qvel = np.stack([rng.uniform(-3, 3, num_states), rng.uniform(-10, 10, num_states)], -1)
+    actions = rng.uniform(-1.2, 1.2, (num_states, 1))
+    return qpos, qvel, actions
+
+
+def env_for(pole_size):
+    if pole_size is None:
+        return suite.load('cartpole', 'swingup')
+    return make_cartpole_env(pole_size)
+
+
+@pytest.mark.parametrize('pole_size', [None, 0.2, 0.6])
+def test_analytic_model_matches_suite(pole_size):
+    env = env_for(pole_size)
+    qpos, qvel, actions = random_transitions()
+    next_observations, rewards = suite_step(env, qpos, qvel, actions)
+    observations = cartpole_dynamics.observations_from_state(qpos, qvel)
+    # The size the installed XML gives the pole, which set_pole_length may have edited.
+    predicted_next_observations, predicted_rewards = cartpole_dynamics.transition(
+        observations, actions, pole_size_of(env))
+    np.testing.assert_allclose(predicted_next_observations, next_observations, atol=ATOL)
+    np.testing.assert_allclose(predicted_rewards, rewards, atol=ATOL)
+
+
+@pytest.mark.parametrize('pole_size', [None, 0.2, 0.6])
+def test_rollout_matches_suite(pole_size):
+    qpos, qvel, actions = random_transitions()
+    next_observations, rewards = suite_step(env_for(pole_size), qpos, qvel, actions)
+    rollout_next_observations, rollout_rewards = simulate(make_cartpole_env(pole_size), qpos, qvel, actions)
+    np.testing.assert_allclose(rollout_next_observations, next_observations, atol=ATOL)
+    np.testing.assert_allclose(rollout_rewards, rewards, atol=ATOL)
@@ -0,0 +1,22 @@
+# Import-time budget of the modules the CORL scripts and workers import (see synther/import_budget.py).
+# Every check runs in a fresh interpreter with torch, numpy and gin loaded first, so the measured time is what the
+# synther module itself adds. SYNTHER_IMPORT_BUDGET overrides the budget in seconds.
+import os
+
+import pytest
+
+pytest.importorskip('torch')
+pytest.importorskip('numpy')
+pytest.importorskip('gin')
+
+from synther.import_budget import CHECKED_MODULES, measure, slowest_imports  # noqa: E402
+
+BUDGET = float(os.environ.get('SYNTHER_IMPORT_BUDGET', '1.0'))
+
+
+@pytest.mark.parametrize('module', CHECKED_MODULES)
+def test_import_budget(module):
+    seconds, heavy = measure(module)
+    assert not heavy, f'{module} imports {heavy} eagerly'
+    assert seconds <= BUDGET, f'{module} takes {seconds:.3f}s to import, budget {BUDGET}s. Slowest:\n' + \
+        '\n'.join(slowest_imports(module))